@@ -1,7 +1,35 @@
-from flask import Flask, jsonify, render_template, request, session, redirect
+from flask import Flask, jsonify, render_template, request, session, redirect, url_for
+from flask.sessions import SecureCookieSession, SessionInterface
+import click
+import fcntl
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import json
+import math
+import os
+import queue
+import random
+import re
+import secrets
 import sqlite3
+import threading
+import time
+from itertools import islice
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from prometheus_client import Counter, Gauge, Histogram
 from prometheus_flask_exporter import PrometheusMetrics
+try:
+    import qrcode
+    from qrcode.image.pure import PyPNGImage
+except ImportError:
+    # optional: without it /qr/ only serves the pre-rendered static/qr files
+    qrcode = None
 
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
@@ -9,43 +37,1280 @@ app.secret_key = "smartlibrary_secret_key"
 # =========================================================
 # PROMETHEUS METRICS
 # =========================================================
-metrics = PrometheusMetrics(app)
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    # gunicorn workers write to a shared directory; /metrics aggregates them
+    from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+    metrics = GunicornInternalPrometheusMetrics(app)
+else:
+    metrics = PrometheusMetrics(app)
 metrics.info('smart_library_app', 'Application Info', version='1.0')
 
-DB = "library.db"
+DB_POOL_IN_USE = Gauge('smart_library_db_pool_in_use', 'SQLite connections currently checked out',
+                       multiprocess_mode='livesum')
+DB_POOL_OPEN = Gauge('smart_library_db_pool_open', 'SQLite connections currently open',
+                     multiprocess_mode='livesum')
+DB_POOL_WAITS = Counter('smart_library_db_pool_waits', 'Checkouts that had to wait for a free connection')
+DB_POOL_WAIT_SECONDS = Histogram('smart_library_db_pool_wait_seconds', 'Time spent waiting for a free connection')
+LOGIN_HASH_SECONDS = Histogram('smart_library_login_hash_seconds', 'Time spent computing a password hash')
+STOCK_DRIFT = Gauge('smart_library_stock_drift', 'Books whose available_stock disagreed with their copies at the last reconciliation',
+                    multiprocess_mode='livemax')
+STOCK_DRIFT_FIXED = Counter('smart_library_stock_drift_fixed', 'available_stock values corrected by reconciliation')
+LOGIN_CACHE_HITS = Counter('smart_library_login_cache_hits', 'Logins verified from the recent-login cache')
+LOGIN_HASH_REJECTED = Counter('smart_library_login_hash_rejected', 'Logins turned away because the hash backlog was full')
+HOLDS_SERVED = Counter('smart_library_holds_served', 'Holds turned into prebooks when a copy was freed')
+# per statement, labelled by SQL constant name (or verb and table for ad-hoc SQL)
+DB_QUERY_SECONDS = Histogram('smart_library_db_query_seconds', 'Time spent executing a SQL statement', ['query'],
+                             buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+DB_QUERY_ROWS = Counter('smart_library_db_query_rows', 'Rows changed by SQL statements', ['query'])
+DB_QUERY_BUSY = Counter('smart_library_db_query_busy', 'SQL statements that failed with SQLITE_BUSY', ['query'])
+DB_SLOW_QUERIES = Counter('smart_library_db_slow_queries', 'SQL statements slower than SLOW_QUERY_MS', ['query'])
+
+DB = os.environ.get("DATABASE", "library.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+# optional copy of DB that staff reports read from, refreshed with the backup API
+DB_READ_SNAPSHOT = os.environ.get("DB_READ_SNAPSHOT")
+DB_SNAPSHOT_INTERVAL = float(os.environ.get("DB_SNAPSHOT_INTERVAL", 300))
+# per-statement metrics on pooled connections; statements slower than
+# SLOW_QUERY_MS are logged with their query plan (0 turns the log off)
+DB_TRACE = os.environ.get("DB_TRACE", "1") != "0"
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+
+PREBOOK_TTL = timedelta(hours=1)
+PREBOOK_EXPIRY_MAX_SLEEP = 60
+# per-book FIFO waitlist served when a return or expiry frees a copy;
+# most books one user may be queued for at once
+HOLD_LIMIT = 5
+# incremental stock reconciliation over books whose copies changed
+STOCK_RECONCILE_INTERVAL = float(os.environ.get("STOCK_RECONCILE_INTERVAL", 60))
+# bounded exponential backoff when a write transaction hits SQLITE_BUSY
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.02
+# upper bound on how stale another worker's catalog snapshot can be
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", 30))
+
+CATALOG_PAGE_SIZE = 50
+CATALOG_MAX_PAGE_SIZE = 200
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+# server-sent events: per-client backlog, keepalive interval, streams per
+# process. A sync stream holds a request thread, so keep EVENT_MAX_STREAMS
+# below the thread count there. "memory" only reaches streams in the
+# publishing process; "sqlite" passes events through the events table so
+# every worker's streams see them, polled every EVENT_POLL_INTERVAL seconds
+EVENT_QUEUE_SIZE = 256
+EVENT_KEEPALIVE = 15
+EVENT_MAX_STREAMS = int(os.environ.get("EVENT_MAX_STREAMS", 64))
+EVENT_BUS = os.environ.get("EVENT_BUS", "memory")
+EVENT_POLL_INTERVAL = 0.5
+EVENT_RETENTION = 300
+
+# scrypt cost for stored passwords (n=2**14, r=8 needs 16 MiB per hash)
+PASSWORD_SCRYPT_N = 2**14
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+# hashing runs on its own small pool so a login burst can't take every core
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+# hashes queued or running per process; past that logins get a 503 with
+# Retry-After instead of parking a request thread behind the queue
+PASSWORD_HASH_BACKLOG = int(os.environ.get("PASSWORD_HASH_BACKLOG", 8))
+PASSWORD_HASH_TIMEOUT = 30
+# recently verified logins skip the hash until the entry ages out
+LOGIN_CACHE_SIZE = 1024
+LOGIN_CACHE_TTL = 300
+
+# on-demand QR images; the defaults match the pre-rendered static/qr files
+QR_CACHE_DIR = os.environ.get("QR_CACHE_DIR", "qr_cache")
+QR_STATIC_DIR = os.path.join("static", "qr")
+QR_MEMORY_ITEMS = 512
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+
+# most copies one kiosk request may look up or check out
+BORROW_BATCH_MAX = 50
+
+# fine per started day past return_by; librarians can return and report for anyone
+FINE_PER_DAY = 10
+STAFF_ROLES = ("librarian",)
+# rows pulled from the cursor per step while streaming a report
+REPORT_FETCH_SIZE = 500
+
+# server-side sessions: the cookie holds only an id. "memory" is per process;
+# "sqlite" shares the sessions table between workers, each keeping a local
+# copy for up to SESSION_CACHE_TTL seconds
+SESSION_STORE = os.environ.get("SESSION_STORE", "memory")
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 86400))
+SESSION_MEMORY_SIZE = 10000
+SESSION_CACHE_TTL = 30
+SESSION_PURGE_INTERVAL = 3600
+
+# rows per write transaction in the bulk importer
+IMPORT_BATCH_SIZE = 1000
+
+# browser cache lifetimes for static images; a QR image never changes for its code
+COVER_MAX_AGE = 86400
+QR_MAX_AGE = 31536000
+
+# applied once when a pooled connection is opened
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+# read-only connections can't change the journal mode and never write
+DB_READ_PRAGMAS = (
+    "PRAGMA query_only=ON",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
 
 
 # =========================================================
 # MODEL LAYER
 # =========================================================
 
+# SQL constant text -> name, filled in once the SQL class below is defined
+QUERY_NAMES = {}
+
+def query_name(sql):
+    name = QUERY_NAMES.get(sql)
+    if name is None:
+        # ad-hoc statements (catalog/history pages, BEGIN, PRAGMA) are named
+        # by verb and first table so the label set stays small
+        words = sql.split(None, 2)
+        table = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF (?:NOT )?EXISTS\s+)?([\w.]+)", sql, re.I)
+        name = words[0].upper() + " " + (table.group(1) if table else words[1] if len(words) > 1 else "")
+    return name.strip()
+
+def log_slow_query(con, name, sql, params, elapsed):
+    # parameters are left out of the log; some of them are password hashes
+    DB_SLOW_QUERIES.labels(name).inc()
+    try:
+        rows = con.execute("EXPLAIN QUERY PLAN " + sql, params or ()).fetchall()
+    except sqlite3.Error:
+        rows = []
+    depth, plan = {}, []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        plan.append("  " * (depth[node] + 1) + detail)
+    app.logger.warning("slow query %s took %.1f ms\n%s", name, elapsed * 1000,
+                       "\n".join(plan) or "  (no plan)")
+
+# Cursor that times every statement into the DB_QUERY_* metrics.
+class TracedCursor:
+    def __init__(self, raw):
+        self._raw = raw
+        self._returning = None
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+    def __iter__(self):
+        return iter(self._raw)
+
+    @property
+    def row_factory(self):
+        return self._raw.row_factory
+    @row_factory.setter
+    def row_factory(self, factory):
+        self._raw.row_factory = factory
+
+    def execute(self, sql, params=()):
+        return self._traced(self._raw.execute, sql, params, params)
+
+    def executemany(self, sql, seq):
+        # the plan of a slow batch is explained with its first row
+        first = seq[0] if isinstance(seq, (list, tuple)) and seq else None
+        return self._traced(self._raw.executemany, sql, seq, first)
+
+    def fetchall(self):
+        rows = self._raw.fetchall()
+        if self._returning:
+            # an UPDATE ... RETURNING only knows its row count once drained
+            self._count(self._returning)
+            self._returning = None
+        return rows
+
+    def _count(self, name):
+        if self._raw.rowcount > 0:
+            DB_QUERY_ROWS.labels(name).inc(self._raw.rowcount)
+
+    def _traced(self, run, sql, params, sample):
+        name = query_name(sql)
+        # BEGIN IMMEDIATE's time is the wait for the write lock
+        start = time.perf_counter()
+        try:
+            run(sql, params)
+        except sqlite3.OperationalError as e:
+            if is_busy(e):
+                DB_QUERY_BUSY.labels(name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            DB_QUERY_SECONDS.labels(name).observe(elapsed)
+        self._returning = name if "RETURNING" in sql else None
+        if not self._returning:
+            self._count(name)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            log_slow_query(self._raw.connection, name, sql, sample, elapsed)
+        return self
+
+# sqlite3 connection borrowed from the pool; close() hands it back
+class PooledConnection:
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._raw, name)
+    def cursor(self):
+        cur = self.__getattr__("cursor")()
+        return TracedCursor(cur) if DB_TRACE else cur
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+    # "with db.connect() as con:" always hands the connection back, rolling
+    # back anything left uncommitted; it does not commit
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def close(self):
+        self._pool._release(self)
+
 class Database:
     _instance = None
-    def __new__(cls, path):
+    def __new__(cls, path, pool_size=DB_POOL_SIZE):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance.path = path
+            cls._instance.pool_size = pool_size
+            cls._instance._reset()
         return cls._instance
+
+    def _reset(self):
+        self._idle = []
+        self._opened = 0
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def reset_after_fork(self):
+        # SQLite connections must not be used across fork(); the child starts
+        # an empty pool and keeps inherited handles referenced but untouched
+        self._inherited = self._idle
+        self._reset()
+
+    def _open(self):
+        con = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            con.execute(pragma)
+        return con
+
     def connect(self):
-        return sqlite3.connect(self.path)
+        # a thread that already holds a connection keeps using it
+        local = self._local
+        held = getattr(local, "con", None)
+        if held is not None:
+            local.depth += 1
+            return held
+        local.con = PooledConnection(self, self._checkout())
+        local.depth = 1
+        return local.con
+
+    def _checkout(self):
+        with self._cond:
+            if not self._idle and self._opened >= self.pool_size:
+                start = time.perf_counter()
+                self._waits += 1
+                DB_POOL_WAITS.inc()
+                ready = self._cond.wait_for(
+                    lambda: self._idle or self._opened < self.pool_size, DB_POOL_TIMEOUT)
+                waited = time.perf_counter() - start
+                self._wait_time += waited
+                DB_POOL_WAIT_SECONDS.observe(waited)
+                if not ready:
+                    raise sqlite3.OperationalError("connection pool exhausted")
+            self._in_use += 1
+            DB_POOL_IN_USE.inc()
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+            DB_POOL_OPEN.inc()
+        try:
+            return self._open()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._in_use -= 1
+                DB_POOL_OPEN.dec()
+                DB_POOL_IN_USE.dec()
+                self._cond.notify()
+            raise
+
+    def _release(self, con):
+        local = self._local
+        if getattr(local, "con", None) is not con:
+            return
+        local.depth -= 1
+        if local.depth:
+            return
+        local.con = None
+        raw, con._raw = con._raw, None
+        if raw.in_transaction:
+            raw.rollback()
+        with self._cond:
+            self._in_use -= 1
+            DB_POOL_IN_USE.dec()
+            if self._reusable(raw):
+                self._idle.append(raw)
+            else:
+                raw.close()
+                self._opened -= 1
+                DB_POOL_OPEN.dec()
+            self._cond.notify()
+
+    def _reusable(self, raw):
+        return True
+
+    def prefill(self, n):
+        # open connections ahead of the first requests
+        with self._cond:
+            n = max(0, min(n, self.pool_size) - self._opened)
+            self._opened += n
+            DB_POOL_OPEN.inc(n)
+        for _ in range(n):
+            raw = self._open()
+            with self._cond:
+                self._idle.append(raw)
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.pool_size,
+                "open": self._opened,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waits": self._waits,
+                "wait_time": self._wait_time
+            }
+
+    def close_all(self):
+        with self._cond:
+            for raw in self._idle:
+                raw.close()
+            self._opened -= len(self._idle)
+            DB_POOL_OPEN.dec(len(self._idle))
+            self._idle = []
+
+# Pool for services that only read. Connections open the primary with
+# mode=ro, so a stray write fails instead of queueing on the write lock.
+class ReadOnlyDatabase(Database):
+    _instance = None
+    connection_class = sqlite3.Connection
+
+    def _open(self):
+        con = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False,
+                              factory=self.connection_class)
+        for pragma in DB_READ_PRAGMAS:
+            con.execute(pragma)
+        return con
+
+class SnapshotConnection(sqlite3.Connection):
+    generation = 0
+
+# Read-only pool over a copy of the primary taken with the backup API, for
+# long staff reports that shouldn't pin a read snapshot on the primary's WAL.
+# refresh() swaps a new copy in under the same name: connections already open
+# keep reading the old file until they go back to the pool, where they are
+# closed instead of reused. Every worker shares the one file; a lock file
+# lets a single process take each copy and the others only pick it up.
+class SnapshotDatabase(ReadOnlyDatabase):
+    _instance = None
+    connection_class = SnapshotConnection
+
+    def __new__(cls, path, source, pool_size=DB_POOL_SIZE):
+        pool = super().__new__(cls, path, pool_size)
+        pool.source = source
+        return pool
+
+    def _reset(self):
+        super()._reset()
+        self.generation = 0
+        self._copy = None
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            self.refresh()
+        if self._copy is None:
+            self._copy = self._identity()
+        con = super()._open()
+        con.generation = self.generation
+        return con
+
+    def _reusable(self, raw):
+        return raw.generation == self.generation
+
+    def _identity(self):
+        # os.replace gives each copy a new inode
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def refresh(self, max_age=0):
+        # copies the primary unless some process already did within max_age
+        # seconds, then moves this pool onto whichever copy is current
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                age = time.time() - os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                age = None
+            if age is None or age >= max_age:
+                self._backup()
+        self.pick_up()
+
+    def pick_up(self):
+        current = self._identity()
+        if current is None or current == self._copy: return
+        self._copy = current
+        with self._cond:
+            self.generation += 1
+        self.close_all()
+
+    def _backup(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        src = sqlite3.connect(self.source)
+        dst = sqlite3.connect(tmp)
+        try:
+            src.backup(dst)
+            # readers of the copy then need no -wal/-shm files
+            dst.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            dst.close()
+            src.close()
+        os.replace(tmp, self.path)
+
+def is_busy(err):
+    code = getattr(err, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(err)
+
+def retry_busy(fn, *args):
+    for attempt in range(BUSY_RETRIES):
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == BUSY_RETRIES - 1:
+                raise
+            time.sleep(BUSY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.0))
+
+# Write transactions are written once as generator bodies that yield
+# (mode, sql, params) and are sent back the result: "one" a row, "all"
+# every row, "run" and "many" (executemany) the rowcount. transact() runs a
+# body here in a BEGIN IMMEDIATE transaction on the write pool; asgi.py
+# drives the same bodies on aiosqlite. A dict result with "error" in it is
+# rolled back, anything else is committed.
+def run_tx(cur, body):
+    result = None
+    while True:
+        try:
+            mode, sql, params = body.send(result)
+        except StopIteration as stop:
+            return stop.value
+        if mode == "many":
+            result = cur.executemany(sql, params).rowcount
+        else:
+            cur.execute(sql, params)
+            result = cur.fetchone() if mode == "one" else cur.fetchall() if mode == "all" else cur.rowcount
+
+def transact(body):
+    with db.connect() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        result = run_tx(cur, body)
+        if not (isinstance(result, dict) and "error" in result):
+            con.commit()
+    return result
+
+# stock maps book_id to the (available, version) a stock statement returned
+def stock_of(rows):
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+def stock_changed(stock):
+    catalog_cache.update(stock)
+    event_hub.publish_stock((book_id, available) for book_id, (available, _) in stock.items())
 
 db = Database(DB)
+read_db = ReadOnlyDatabase(DB)
+report_db = SnapshotDatabase(DB_READ_SNAPSHOT, DB) if DB_READ_SNAPSHOT else read_db
+
+def reset_pools_after_fork():
+    for pool in {db, read_db, report_db}:
+        pool.reset_after_fork()
+
+# =========================================================
+# SCHEMA MIGRATIONS
+# =========================================================
+
+# (version, statements), applied in order and tracked in PRAGMA user_version.
+# Never edit a released entry; append a new version instead.
+MIGRATIONS = [
+    (1, (
+        "CREATE INDEX IF NOT EXISTS idx_copies_book_status ON book_copies(book_id,status)",
+        "CREATE INDEX IF NOT EXISTS idx_borrows_user_borrowed ON borrows(user_id,borrowed_at)",
+        # my-prebooks lists a user's live prebooks ordered by deadline
+        """CREATE INDEX IF NOT EXISTS idx_requests_user_status_expiry
+           ON borrow_requests(user_id,status,expires_at)""",
+        # only live prebooks are ever looked up by deadline or copy, so
+        # partial indexes stay small as expired/completed rows pile up
+        """CREATE INDEX IF NOT EXISTS idx_requests_prebooked_expiry
+           ON borrow_requests(expires_at) WHERE status='prebooked'""",
+        """CREATE INDEX IF NOT EXISTS idx_requests_prebooked_copy
+           ON borrow_requests(copy_id,user_id) WHERE status='prebooked'""",
+    )),
+    (2, (
+        # bumped with every stock change; drives the per-book ETag
+        "ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    )),
+    (3, (
+        # title/author prefix search for the paged catalog API
+        """CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+               title, author, content='books', content_rowid='id', prefix='2 3')""",
+        """CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+               INSERT INTO books_fts(rowid,title,author) VALUES (new.id,new.title,new.author);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+               INSERT INTO books_fts(books_fts,rowid,title,author)
+               VALUES ('delete',old.id,old.title,old.author);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF title,author ON books BEGIN
+               INSERT INTO books_fts(books_fts,rowid,title,author)
+               VALUES ('delete',old.id,old.title,old.author);
+               INSERT INTO books_fts(rowid,title,author) VALUES (new.id,new.title,new.author);
+           END""",
+        "INSERT INTO books_fts(books_fts) VALUES ('rebuild')",
+        # keyset paging when sorted by title
+        "CREATE INDEX IF NOT EXISTS idx_books_title ON books(title,id)",
+    )),
+    (4, (
+        # scrypt hashes; the plaintext column is cleared as each user logs in
+        "ALTER TABLE users ADD COLUMN password_hash TEXT",
+    )),
+    (5, (
+        # natural key for the bulk importer; existing rows stay NULL
+        "ALTER TABLE books ADD COLUMN isbn TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_books_isbn ON books(isbn)",
+    )),
+    (6, (
+        # open loans only: the copy being returned and the overdue report
+        """CREATE INDEX IF NOT EXISTS idx_borrows_open_copy
+           ON borrows(copy_id) WHERE returned_at IS NULL""",
+        """CREATE INDEX IF NOT EXISTS idx_borrows_open_due
+           ON borrows(return_by) WHERE returned_at IS NULL""",
+    )),
+    (7, (
+        # full-history export in borrowed order without a sort step
+        "CREATE INDEX IF NOT EXISTS idx_borrows_borrowed ON borrows(borrowed_at)",
+    )),
+    (8, (
+        # books whose copies changed since the last reconciliation. NOT EXISTS
+        # rather than OR IGNORE: an upsert's conflict clause would override it
+        "CREATE TABLE IF NOT EXISTS stock_changes (book_id INTEGER PRIMARY KEY)",
+        """CREATE TRIGGER IF NOT EXISTS copies_stock_ai AFTER INSERT ON book_copies BEGIN
+               INSERT INTO stock_changes SELECT new.book_id
+               WHERE new.book_id IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM stock_changes WHERE book_id=new.book_id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS copies_stock_ad AFTER DELETE ON book_copies BEGIN
+               INSERT INTO stock_changes SELECT old.book_id
+               WHERE old.book_id IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM stock_changes WHERE book_id=old.book_id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS copies_stock_au AFTER UPDATE OF status,book_id ON book_copies BEGIN
+               INSERT INTO stock_changes SELECT new.book_id
+               WHERE new.book_id IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM stock_changes WHERE book_id=new.book_id);
+               INSERT INTO stock_changes SELECT old.book_id
+               WHERE old.book_id IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM stock_changes WHERE book_id=old.book_id);
+           END""",
+    )),
+    (9, (
+        # server-side sessions for SESSION_STORE=sqlite, keyed by a digest of the cookie id
+        """CREATE TABLE IF NOT EXISTS sessions (
+               id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)",
+    )),
+    (10, (
+        # hold queue; id order is queue order and max_prebooks is the
+        # user's prebook limit when they joined
+        """CREATE TABLE IF NOT EXISTS holds (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               user_id TEXT NOT NULL,
+               book_id INTEGER NOT NULL,
+               max_prebooks INTEGER NOT NULL,
+               created_at DATETIME NOT NULL)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_user_book ON holds(user_id,book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_holds_book ON holds(book_id,id)",
+    )),
+    (11, (
+        # event log for EVENT_BUS=sqlite; AUTOINCREMENT so purging never
+        # lets an id come round again behind a worker's read position
+        """CREATE TABLE IF NOT EXISTS events (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               user_id TEXT,
+               payload TEXT NOT NULL,
+               created_at REAL NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS idx_events_created ON events(created_at)",
+    )),
+]
+
+class Migrator:
+    def __init__(self, db, migrations=MIGRATIONS):
+        self.db = db
+        self.migrations = migrations
+
+    def version(self):
+        with self.db.connect() as con:
+            return con.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        with self.db.connect() as con:
+            cur = con.cursor()
+            # the write lock serialises concurrent workers starting up together
+            cur.execute("BEGIN IMMEDIATE")
+            current = cur.execute("PRAGMA user_version").fetchone()[0]
+            for version, statements in self.migrations:
+                if version <= current: continue
+                for sql in statements:
+                    cur.execute(sql)
+                cur.execute(f"PRAGMA user_version={version}")
+                current = version
+            con.commit()
+        return current
+
+migrator = Migrator(db)
+migrator.migrate()
+# nothing opened at import time may leak into a preforked worker
+db.close_all()
+
+# =========================================================
+# SQL
+# =========================================================
+
+# Every statement the services run, shared by the sync services below and
+# the aiosqlite ones in asgi.py so both serving modes hit the same queries.
+class SQL:
+    CREDENTIALS = """
+        SELECT user_id,name,role,department,year,password_hash,password
+        FROM users WHERE user_id=? AND role=?
+    """
+    # only replaces the hash that was verified, so concurrent logins can't
+    # overwrite each other's upgrade with an older one
+    STORE_PASSWORD_HASH = """
+        UPDATE users SET password_hash=?,password=''
+        WHERE user_id=? AND password_hash IS ?
+    """
+    COPY_BY_QR = "SELECT copy_id,book_id,status FROM book_copies WHERE qr_code=?"
+    TITLE_BY_QR = """
+        SELECT b.title FROM book_copies bc
+        JOIN books b ON bc.book_id=b.id
+        WHERE bc.qr_code=?
+    """
+    # batch lookups take the codes as one JSON array so the text stays fixed
+    TITLES_BY_QR = """
+        SELECT bc.qr_code,b.title FROM json_each(?) AS j
+        JOIN book_copies bc ON bc.qr_code=j.value
+        JOIN books b ON bc.book_id=b.id
+    """
+    MARK_BORROWED = "UPDATE book_copies SET status='borrowed' WHERE copy_id=?"
+    ALL_QR_CODES = "SELECT qr_code FROM book_copies ORDER BY copy_id"
+
+    CATALOG = "SELECT id,title,available_stock,cover,version FROM books"
+    BOOK_DETAIL = """
+        SELECT id,title,author,description,available_stock,cover,version
+        FROM books WHERE id=?
+    """
+
+    CREATE_BORROW = """
+        INSERT INTO borrows (user_id,copy_id,borrowed_at,return_by)
+        VALUES (?,?,?,?)
+    """
+    # the last column says whether the copy is held by this user's prebook
+    COPIES_FOR_BORROW = """
+        SELECT bc.qr_code,bc.copy_id,bc.book_id,bc.status,EXISTS(
+            SELECT 1 FROM borrow_requests br
+            WHERE br.copy_id=bc.copy_id AND br.user_id=? AND br.status='prebooked'
+        )
+        FROM json_each(?) AS j
+        JOIN book_copies bc ON bc.qr_code=j.value
+    """
+    # only a free copy, or one held by this user's prebook, can be taken
+    CLAIM_FOR_BORROW = """
+        UPDATE book_copies SET status='borrowed'
+        WHERE copy_id=? AND (
+            status='available' OR (status='prebooked' AND EXISTS (
+                SELECT 1 FROM borrow_requests
+                WHERE copy_id=? AND user_id=? AND status='prebooked'
+            ))
+        )
+    """
+    TAKE_STOCK = """
+        UPDATE books SET available_stock=available_stock-1,version=version+1
+        WHERE id=? AND available_stock>0
+        RETURNING id,available_stock,version
+    """
+    COMPLETE_PREBOOK = """
+        UPDATE borrow_requests SET status='completed'
+        WHERE copy_id=? AND user_id=? AND status='prebooked'
+    """
+
+    OPEN_LOANS_BY_QR = """
+        SELECT bc.qr_code,bc.copy_id,bc.book_id,br.id,br.user_id,br.return_by
+        FROM json_each(?) AS j
+        JOIN book_copies bc ON bc.qr_code=j.value
+        LEFT JOIN borrows br ON br.copy_id=bc.copy_id AND br.returned_at IS NULL
+    """
+    CLOSE_BORROW = "UPDATE borrows SET returned_at=? WHERE id=? AND returned_at IS NULL"
+    RELEASE_BORROWED_COPY = "UPDATE book_copies SET status='available' WHERE copy_id=? AND status='borrowed'"
+    RETURN_STOCK = """
+        UPDATE books SET available_stock=available_stock+1,version=version+1
+        WHERE id=?
+        RETURNING id,available_stock,version
+    """
+    OVERDUE = """
+        SELECT b.title,bc.qr_code,br.return_by,br.user_id
+        FROM borrows br
+        JOIN book_copies bc ON br.copy_id=bc.copy_id
+        JOIN books b ON bc.book_id=b.id
+        WHERE br.returned_at IS NULL AND br.return_by<?
+        ORDER BY br.return_by
+    """
+    OVERDUE_FOR_USER = """
+        SELECT b.title,bc.qr_code,br.return_by,br.user_id
+        FROM borrows br
+        JOIN book_copies bc ON br.copy_id=bc.copy_id
+        JOIN books b ON bc.book_id=b.id
+        WHERE br.returned_at IS NULL AND br.return_by<? AND br.user_id=?
+        ORDER BY br.return_by
+    """
+
+    ANY_EXPIRED = """
+        SELECT 1 FROM borrow_requests
+        WHERE status='prebooked' AND expires_at < ? LIMIT 1
+    """
+    # who to tell, read before the updates below and only while someone listens
+    EXPIRED_HOLDERS = """
+        SELECT DISTINCT br.user_id,bc.book_id
+        FROM borrow_requests br
+        JOIN book_copies bc ON br.copy_id=bc.copy_id
+        WHERE br.status='prebooked' AND br.expires_at < ?
+    """
+    # one set-based UPDATE per table; requests are flipped last since
+    # the first two statements select on status='prebooked'. Only the stock
+    # update returns rows, one per book, so a large expiry never streams
+    # per-request rows back into Python
+    EXPIRE_RESTORE_STOCK = """
+        UPDATE books SET available_stock=available_stock+e.n,version=version+1
+        FROM (
+            SELECT bc.book_id,COUNT(*) AS n
+            FROM borrow_requests br
+            JOIN book_copies bc ON br.copy_id=bc.copy_id
+            WHERE br.status='prebooked' AND br.expires_at < ?
+            GROUP BY bc.book_id
+        ) AS e
+        WHERE books.id=e.book_id
+        RETURNING books.id,books.available_stock,books.version
+    """
+    EXPIRE_RELEASE_COPIES = """
+        UPDATE book_copies SET status='available'
+        WHERE copy_id IN (
+            SELECT copy_id FROM borrow_requests
+            WHERE status='prebooked' AND expires_at < ?
+        )
+    """
+    EXPIRE_REQUESTS = """
+        UPDATE borrow_requests SET status='expired'
+        WHERE status='prebooked' AND expires_at < ?
+    """
+    NEXT_EXPIRY = "SELECT MIN(expires_at) FROM borrow_requests WHERE status='prebooked'"
+
+    ACTIVE_PREBOOKS = """
+        SELECT COUNT(*) FROM borrow_requests
+        WHERE user_id=? AND status='prebooked'
+    """
+    CLAIM_FOR_PREBOOK = """
+        UPDATE book_copies SET status='prebooked'
+        WHERE copy_id=(
+            SELECT copy_id FROM book_copies
+            WHERE book_id=? AND status='available' LIMIT 1
+        ) AND status='available'
+        RETURNING copy_id
+    """
+    CREATE_PREBOOK = """
+        INSERT INTO borrow_requests (user_id,copy_id,request_time,expires_at,status)
+        VALUES (?,?,?,?, 'prebooked')
+    """
+    MY_PREBOOK = """
+        SELECT bc.qr_code,br.expires_at
+        FROM borrow_requests br
+        JOIN book_copies bc ON br.copy_id=bc.copy_id
+        WHERE br.user_id=? AND bc.book_id=? AND br.status='prebooked' AND br.expires_at>?
+    """
+    MY_PREBOOKS = """
+        SELECT bc.qr_code, br.expires_at, b.title
+        FROM borrow_requests br
+        JOIN book_copies bc ON br.copy_id = bc.copy_id
+        JOIN books b ON bc.book_id = b.id
+        WHERE br.user_id=?
+        AND br.status='prebooked'
+        AND br.expires_at > ?
+        ORDER BY br.expires_at ASC
+    """
+
+    # (free copy, user's prebook on the book, user's holds); no row for an unknown book
+    HOLD_CHECK = """
+        SELECT EXISTS(
+            SELECT 1 FROM book_copies WHERE book_id=b.id AND status='available'
+        ),EXISTS(
+            SELECT 1 FROM borrow_requests br
+            JOIN book_copies bc ON br.copy_id=bc.copy_id
+            WHERE br.user_id=? AND bc.book_id=b.id AND br.status='prebooked'
+        ),(SELECT COUNT(*) FROM holds WHERE user_id=?)
+        FROM books b WHERE b.id=?
+    """
+    PLACE_HOLD = """
+        INSERT INTO holds (user_id,book_id,max_prebooks,created_at) VALUES (?,?,?,?)
+        ON CONFLICT(user_id,book_id) DO NOTHING
+    """
+    HOLD_POSITION = """
+        SELECT COUNT(*) FROM holds
+        WHERE book_id=? AND id<=(SELECT id FROM holds WHERE user_id=? AND book_id=?)
+    """
+    CANCEL_HOLD = "DELETE FROM holds WHERE user_id=? AND book_id=?"
+    # oldest hold on the book whose user is under their prebook limit;
+    # users at the limit keep their place for the next copy
+    NEXT_HOLD = """
+        SELECT h.id,h.user_id FROM holds h
+        WHERE h.book_id=? AND (
+            SELECT COUNT(*) FROM borrow_requests br
+            WHERE br.user_id=h.user_id AND br.status='prebooked'
+        ) < h.max_prebooks
+        ORDER BY h.id LIMIT 1
+    """
+    DELETE_HOLD = "DELETE FROM holds WHERE id=?"
+    # the freed books anyone is waiting for, so an empty queue costs one lookup
+    HELD_BOOKS = """
+        SELECT DISTINCT book_id FROM holds
+        WHERE book_id IN (SELECT value FROM json_each(?))
+        ORDER BY book_id
+    """
+    MY_HOLDS = """
+        SELECT h.book_id,b.title,h.created_at,(
+            SELECT COUNT(*) FROM holds q WHERE q.book_id=h.book_id AND q.id<=h.id
+        )
+        FROM holds h
+        JOIN books b ON h.book_id=b.id
+        WHERE h.user_id=?
+        ORDER BY h.id
+    """
+
+    # unchanged rows are left alone, so only real edits bump the version
+    IMPORT_BOOK = """
+        INSERT INTO books (isbn,title,author,description,cover,total_stock,available_stock)
+        VALUES (?,?,?,?,?,0,0)
+        ON CONFLICT(isbn) DO UPDATE SET
+            title=excluded.title,author=excluded.author,
+            description=excluded.description,cover=excluded.cover,version=version+1
+        WHERE title IS NOT excluded.title OR author IS NOT excluded.author
+        OR description IS NOT excluded.description OR cover IS NOT excluded.cover
+    """
+    # rows for an unknown ISBN select nothing and are counted as skipped;
+    # an existing copy keeps its status and only moves to the new book
+    IMPORT_COPY = """
+        INSERT INTO book_copies (book_id,qr_code,status)
+        SELECT id,?,'available' FROM books WHERE isbn=?
+        ON CONFLICT(qr_code) DO UPDATE SET book_id=excluded.book_id
+    """
+    # lost marks a book a copy is about to move away from
+    IMPORT_TOUCHED_TABLE = """
+        CREATE TEMP TABLE IF NOT EXISTS import_books (id INTEGER PRIMARY KEY, lost INTEGER NOT NULL DEFAULT 0)
+    """
+    IMPORT_TOUCH = "INSERT OR IGNORE INTO temp.import_books(id) SELECT id FROM books WHERE isbn=?"
+    IMPORT_TOUCH_MOVED = """
+        INSERT INTO temp.import_books(id,lost)
+        SELECT bc.book_id,1 FROM book_copies bc JOIN books b ON b.isbn=?
+        WHERE bc.qr_code=? AND bc.book_id IS NOT b.id
+        ON CONFLICT(id) DO UPDATE SET lost=1
+    """
+    # books that never had copies keep the counts they had; one whose last
+    # copy moved away drops to zero
+    IMPORT_RECOUNT = """
+        UPDATE books SET total_stock=c.total,available_stock=c.available,version=version+1
+        FROM (
+            SELECT t.id AS book_id,COUNT(bc.copy_id) AS total,
+                   COALESCE(SUM(bc.status='available'),0) AS available
+            FROM temp.import_books t
+            LEFT JOIN book_copies bc ON bc.book_id=t.id
+            GROUP BY t.id
+            HAVING COUNT(bc.copy_id) OR MAX(t.lost)
+        ) AS c
+        WHERE books.id=c.book_id
+        AND (books.total_stock IS NOT c.total OR books.available_stock IS NOT c.available)
+    """
+
+    # books with copies whose stored count differs from their available copies
+    STOCK_DRIFT_ALL = """
+        SELECT b.id,b.available_stock,c.available
+        FROM books b
+        JOIN (
+            SELECT book_id,SUM(status='available') AS available
+            FROM book_copies GROUP BY book_id
+        ) AS c ON c.book_id=b.id
+        WHERE b.available_stock IS NOT c.available
+    """
+    STOCK_DRIFT_BOOKS = """
+        SELECT b.id,b.available_stock,c.available
+        FROM books b
+        JOIN (
+            SELECT book_id,SUM(status='available') AS available
+            FROM book_copies
+            WHERE book_id IN (SELECT value FROM json_each(?))
+            GROUP BY book_id
+        ) AS c ON c.book_id=b.id
+        WHERE b.available_stock IS NOT c.available
+    """
+    STOCK_CHANGES = "SELECT book_id FROM stock_changes"
+    CLEAR_STOCK_CHANGES = "DELETE FROM stock_changes"
+    FIX_STOCK = """
+        UPDATE books SET available_stock=?,version=version+1
+        WHERE id=? AND available_stock IS ?
+    """
+    SESSION_GET = "SELECT data,expires_at FROM sessions WHERE id=? AND expires_at>?"
+    SESSION_SET = """
+        INSERT INTO sessions(id,data,expires_at) VALUES (?,?,?)
+        ON CONFLICT(id) DO UPDATE SET data=excluded.data,expires_at=excluded.expires_at
+    """
+    SESSION_DELETE = "DELETE FROM sessions WHERE id=?"
+    SESSION_PURGE = "DELETE FROM sessions WHERE expires_at<=?"
+
+    EVENT_APPEND = "INSERT INTO events(user_id,payload,created_at) VALUES (?,?,?)"
+    EVENTS_SINCE = "SELECT id,user_id,payload FROM events WHERE id>? ORDER BY id"
+    EVENT_LAST = "SELECT COALESCE(MAX(id),0) FROM events"
+    EVENT_PURGE = "DELETE FROM events WHERE created_at<=?"
+
+    # staff export of every loan, oldest first, straight off idx_borrows_borrowed
+    HISTORY_EXPORT = """
+        SELECT br.id,b.title,bc.qr_code,br.borrowed_at,br.return_by,br.returned_at,br.user_id
+        FROM borrows br
+        JOIN book_copies bc ON br.copy_id=bc.copy_id
+        JOIN books b ON bc.book_id=b.id
+        ORDER BY br.borrowed_at,br.id
+    """
+
+QUERY_NAMES.update((sql, name) for name, sql in vars(SQL).items()
+                   if name.isupper() and isinstance(sql, str))
+
+# =========================================================
+# ROW MODELS
+# =========================================================
+
+def iso(value):
+    return None if value is None else datetime.fromisoformat(str(value)).isoformat()
+
+def cover_url(cover):
+    return f"/static/covers/{cover}"
+
+# Compiles the API shape of one statement into a row factory: one name per
+# result column ("key" or "key:converter", None to leave the column out)
+# becomes a dict display over the tuple sqlite3 hands over, so list
+# endpoints go from cursor to JSON-ready dict with nothing in between.
+def row_serializer(*columns):
+    items = []
+    for i, column in enumerate(columns):
+        if column is None: continue
+        key, _, convert = column.partition(":")
+        items.append(f"{key!r}:{convert}(row[{i}])" if convert else f"{key!r}:row[{i}]")
+    return eval(f"lambda cursor, row: {{{','.join(items)}}}", {"iso": iso, "cover_url": cover_url})
+
+# Slotted rows a cursor builds directly: with cur.row_factory=Model.from_row
+# sqlite3 hands each result tuple to the constructor, so fields follow the
+# column order of the statement noted on each model. API is the serializer
+# for that statement; list endpoints use the serializers without the model.
+class Row:
+    __slots__ = ()
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
 
-class User:
-    def __init__(self, user_id, name, role, department, year):
-        self.user_id = user_id
-        self.name = name
-        self.role = role
-        self.department = department
-        self.year = year
     def to_dict(self):
-        return {
-            "id": self.user_id,
-            "name": self.name,
-            "role": self.role,
-            "department": self.department,
-            "year": self.year
-        }
+        return type(self).API(None, tuple(getattr(self, f) for f in self.__slots__))
+
+@dataclass(slots=True)
+class User(Row):
+    # SQL.CREDENTIALS, first five columns
+    user_id: str
+    name: str
+    role: str
+    department: str = None
+    year: int = None
+
+    API = row_serializer("id", "name", "role", "department", "year")
+
+@dataclass(slots=True)
+class Book(Row):
+    # SQL.BOOK_DETAIL
+    id: int
+    title: str
+    author: str
+    description: str
+    available_stock: int
+    cover: str
+    version: int
+
+    API = row_serializer(None, "title", "author", "description", "available", "cover:cover_url", None)
+
+    @property
+    def etag(self):
+        return f"book-{self.id}-v{self.version}"
+
+@dataclass(slots=True)
+class BookCopy(Row):
+    # SQL.COPY_BY_QR
+    copy_id: int
+    book_id: int
+    status: str
+
+@dataclass(slots=True)
+class BorrowRequest(Row):
+    # SQL.MY_PREBOOK; SQL.MY_PREBOOKS adds the title
+    qr_code: str
+    expires_at: datetime
+    title: str = None
+
+    API = row_serializer("qr", "expires_at:iso")
+    LISTED = row_serializer("qr", "expires_at:iso", "title")
+
+@dataclass(slots=True)
+class Hold(Row):
+    # SQL.MY_HOLDS
+    book_id: int
+    title: str
+    created_at: datetime
+    position: int
+
+    API = row_serializer("book_id", "title", "created_at:iso", "position")
+
+@dataclass(slots=True)
+class Borrow(Row):
+    # HistoryService.plan; SQL.HISTORY_EXPORT adds the borrower
+    id: int
+    title: str
+    qr_code: str
+    borrowed_at: datetime
+    return_by: datetime
+    returned_at: datetime
+    user_id: str = None
+
+    API = row_serializer("id", "title", "qr", "borrowed_at:iso", "return_by:iso", "returned_at:iso")
+    EXPORTED = row_serializer("id", "title", "qr", "borrowed_at:iso", "return_by:iso", "returned_at:iso", "user_id")
+
+# =========================================================
+# REPOSITORIES
+# =========================================================
+
+# Lookups on the read pool. Single rows come back as models; listings come
+# back as API dicts through the model's serializer. Writes stay in the
+# services, whose transactions span several tables.
+class Repository:
+    model = Row
+
+    def _execute(self, con, sql, params, factory=None):
+        cur = con.cursor()
+        cur.row_factory = factory or self.model.from_row
+        cur.execute(sql, params)
+        return cur
+
+    def one(self, sql, params=()):
+        with read_db.connect() as con:
+            return self._execute(con, sql, params).fetchone()
+
+    def all(self, sql, params=(), factory=None):
+        with read_db.connect() as con:
+            return self._execute(con, sql, params, factory).fetchall()
+
+    def stream(self, pool, sql, params=(), factory=None):
+        with pool.connect() as con:
+            cur = self._execute(con, sql, params, factory)
+            while True:
+                rows = cur.fetchmany(REPORT_FETCH_SIZE)
+                if not rows: break
+                yield from rows
+
+class BookRepository(Repository):
+    model = Book
+
+    def get(self, book_id):
+        return self.one(SQL.BOOK_DETAIL, (book_id,))
+
+    def title_by_qr(self, qr):
+        with read_db.connect() as con:
+            row = con.execute(SQL.TITLE_BY_QR, (qr,)).fetchone()
+        return row[0] if row else None
+
+    def titles_by_qr(self, codes):
+        with read_db.connect() as con:
+            return dict(con.execute(SQL.TITLES_BY_QR, (json.dumps(codes),)).fetchall())
+
+class CopyRepository(Repository):
+    model = BookCopy
+
+    def by_qr(self, qr):
+        return self.one(SQL.COPY_BY_QR, (qr,))
+
+class PrebookRepository(Repository):
+    model = BorrowRequest
+
+    def for_book(self, user_id, book_id):
+        return self.one(SQL.MY_PREBOOK, (user_id, book_id, datetime.now()))
+
+    def active(self, user_id):
+        return self.all(SQL.MY_PREBOOKS, (user_id, datetime.now()), BorrowRequest.LISTED)
+
+class LoanRepository(Repository):
+    model = Borrow
+
+    def page(self, plan):
+        # plain tuples; HistoryService.shape needs the raw sort key
+        return self.all(plan.sql, plan.params, lambda cursor, row: row)
+
+    def export(self):
+        # every user's loans in borrowed order, off the report pool
+        return self.stream(report_db, SQL.HISTORY_EXPORT, factory=Borrow.EXPORTED)
+
+class HoldRepository(Repository):
+    model = Hold
+
+    def mine(self, user_id):
+        return self.all(SQL.MY_HOLDS, (user_id,), Hold.API)
+
+book_repository = BookRepository()
+copy_repository = CopyRepository()
+prebook_repository = PrebookRepository()
+hold_repository = HoldRepository()
+loan_repository = LoanRepository()
+
+# =========================================================
+# PASSWORD HASHING
+# =========================================================
+
+# Hashes are stored as scrypt$n$r$p$salt$digest. hash() and verify() return
+# futures from a bounded worker pool. Successful verifications are remembered
+# for a short while under a keyed digest of (user, password, stored hash),
+# so no plaintext is kept and a changed password never hits the cache.
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, cache_size=LOGIN_CACHE_SIZE, cache_ttl=LOGIN_CACHE_TTL,
+                 backlog=PASSWORD_HASH_BACKLOG):
+        self.workers = workers
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(backlog)
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._key = os.urandom(32)
+        self._dummy = None
+
+    def _executor(self):
+        # started on first use so a preforking master never owns the threads
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="password-hash")
+            return self._pool
+
+    def make(self, password):
+        n, r, p = PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P
+        salt = os.urandom(16)
+        with LOGIN_HASH_SECONDS.time():
+            digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p)
+        return "$".join(("scrypt", str(n), str(r), str(p),
+                         base64.b64encode(salt).decode(), base64.b64encode(digest).decode()))
+
+    def check(self, password, stored):
+        try:
+            algo, n, r, p, salt, digest = stored.split("$")
+            expected = base64.b64decode(digest)
+            with LOGIN_HASH_SECONDS.time():
+                actual = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt),
+                                        n=int(n), r=int(r), p=int(p), dklen=len(expected))
+        except ValueError:
+            return False
+        return algo == "scrypt" and hmac.compare_digest(actual, expected)
+
+    def needs_rehash(self, stored):
+        current = f"scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}$"
+        return not stored or not stored.startswith(current)
+
+    def dummy(self):
+        # checked for unknown users so they cost one hash like everyone else
+        if self._dummy is None:
+            self._dummy = self.make(secrets.token_urlsafe())
+        return self._dummy
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            LOGIN_HASH_REJECTED.inc()
+            raise HasherBusy()
+        try:
+            future = self._executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def hash(self, password):
+        return self._submit(self.make, password)
+
+    def verify(self, user_id, password, stored):
+        key = hmac.new(self._key, "\0".join((user_id, password, stored)).encode(), "blake2b").digest()
+        with self._lock:
+            seen = self._recent.pop(key, None)
+            if seen is not None and time.monotonic() - seen < self.cache_ttl:
+                self._recent[key] = seen
+                LOGIN_CACHE_HITS.inc()
+                done = Future()
+                done.set_result(True)
+                return done
+        future = self._submit(self.check, password, stored)
+        future.add_done_callback(lambda f: f.exception() is None and f.result() and self._remember(key))
+        return future
+
+    def _remember(self, key):
+        with self._lock:
+            self._recent[key] = time.monotonic()
+            while len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+
+    def forget(self):
+        with self._lock:
+            self._recent.clear()
+
+password_hasher = PasswordHasher()
 
 class LoginService:
     _instance=None
@@ -54,50 +1319,528 @@ class LoginService:
             cls._instance=super().__new__(cls)
             cls._instance.db=db
         return cls._instance
+    # raises HasherBusy when the hash backlog is full
     def authenticate(self, user_id, password, role):
-        con=db.connect()
-        cur=con.cursor()
-        cur.execute("""
-            SELECT user_id,name,role,department,year
-            FROM users WHERE user_id=? AND password=? AND role=?
-        """,(user_id,password,role))
-        row=cur.fetchone()
-        con.close()
-        return User(*row) if row else None
+        if not password: return None
+        with db.connect() as con:
+            row=con.execute(SQL.CREDENTIALS,(user_id,role)).fetchone()
+        stored=row[5] if row else None
+        if stored:
+            ok=password_hasher.verify(user_id,password,stored).result(PASSWORD_HASH_TIMEOUT)
+        else:
+            # users who haven't logged in since hashing was added
+            ok=row is not None and hmac.compare_digest(row[6].encode(),password.encode())
+            if not ok:
+                # unknown users wait for a hash too, so timing doesn't tell
+                # which accounts exist
+                password_hasher.verify(user_id,password,password_hasher.dummy()).result(PASSWORD_HASH_TIMEOUT)
+        if not ok: return None
+        if password_hasher.needs_rehash(stored):
+            try:
+                self.store_hash(user_id,stored,password_hasher.hash(password).result(PASSWORD_HASH_TIMEOUT))
+            except HasherBusy:
+                # the login already succeeded; the next one retries the upgrade
+                pass
+        return User(*row[:5])
+
+    def store_hash(self, user_id, old, new):
+        try:
+            retry_busy(self._store_hash,user_id,old,new)
+        except sqlite3.OperationalError as e:
+            # the login already succeeded; the next one retries the upgrade
+            if not is_busy(e): raise
+
+    def _store_hash(self, user_id, old, new):
+        with db.connect() as con:
+            con.execute(SQL.STORE_PASSWORD_HASH,(new,user_id,old))
+            con.commit()
 
 login_service=LoginService(db)
 
 class BookCopyService:
     def __init__(self,db): self.db=db
     def get_by_qr(self,qr):
-        con=db.connect()
-        cur=con.cursor()
-        cur.execute("SELECT copy_id,book_id,status FROM book_copies WHERE qr_code=?",(qr,))
-        r=cur.fetchone()
-        con.close()
-        return r
+        return copy_repository.by_qr(qr)
     def mark_borrowed(self,copy_id):
-        con=db.connect()
-        cur=con.cursor()
-        cur.execute("UPDATE book_copies SET status='borrowed' WHERE copy_id=?",(copy_id,))
-        con.commit()
-        con.close()
+        with db.connect() as con:
+            con.execute(SQL.MARK_BORROWED,(copy_id,))
+            con.commit()
 
 copy_service=BookCopyService(db)
 
-class NormalBorrow:
+# QR images rendered on demand. A rendering is stored on disk under a hash of
+# the code and the render settings, so a settings change can never serve a
+# stale file and the hash doubles as the ETag. Recent images are also kept in
+# an in-memory LRU; only codes already validated against book_copies get there.
+class QRCodeService:
+    def __init__(self, cache_dir=QR_CACHE_DIR, memory_items=QR_MEMORY_ITEMS):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, code):
+        spec = f"{code}|{QR_BOX_SIZE}|{QR_BORDER}"
+        return hashlib.blake2b(spec.encode(), digest_size=16).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".png")
+
+    def render(self, code):
+        if qrcode is None:
+            # fall back to the file the offline step left behind
+            legacy = os.path.join(QR_STATIC_DIR, code + ".png")
+            if not os.path.isfile(legacy): return None
+            with open(legacy, "rb") as f:
+                return f.read()
+        img = qrcode.make(code, image_factory=PyPNGImage, box_size=QR_BOX_SIZE, border=QR_BORDER)
+        out = io.BytesIO()
+        img.save(out)
+        return out.getvalue()
+
+    def store(self, key, png):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # concurrent renderers of the same code write identical bytes
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(png)
+        os.replace(tmp, path)
+
+    def image(self, code):
+        # (etag, png) for a code that is known to exist, or None
+        key = self.key(code)
+        with self._lock:
+            png = self._memory.pop(key, None)
+            if png is not None:
+                self._memory[key] = png
+                return key, png
+        try:
+            with open(self.path(key), "rb") as f:
+                png = f.read()
+        except FileNotFoundError:
+            png = self.render(code)
+            if png is None: return None
+            self.store(key, png)
+        self._remember(key, png)
+        return key, png
+
+    def _remember(self, key, png):
+        with self._lock:
+            self._memory[key] = png
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def cached(self, code):
+        with self._lock:
+            return self.key(code) in self._memory
+
+    def get(self, code):
+        if not self.cached(code) and copy_service.get_by_qr(code) is None: return None
+        return self.image(code)
+
+    def pregenerate(self, codes):
+        # renders codes missing from the disk cache; returns how many
+        rendered = 0
+        for code in codes:
+            key = self.key(code)
+            if os.path.exists(self.path(key)): continue
+            png = self.render(code)
+            if png is None: continue
+            self.store(key, png)
+            rendered += 1
+        return rendered
+
+qr_service=QRCodeService()
+
+CatalogSnapshot = namedtuple("CatalogSnapshot", "version body etag built_at")
+
+# Pre-serialized /api/books body, kept as one JSON fragment per book.
+# Writers hand update() the (available, version) their stock statement
+# returned and only that book's fragment is re-encoded; books.version orders
+# the updates, so one arriving late can't roll a count back. The TTL covers
+# writes made by other workers, and invalidate() drops everything.
+class CatalogCache:
+    def __init__(self, ttl=CATALOG_CACHE_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self._books = None
+        self._frags = None
+        self._loaded_at = 0.0
+        self._seen = {}
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def get(self):
+        snap = self.peek()
+        if snap: return snap
+        with self._build_lock:
+            snap = self.peek()
+            if snap: return snap
+            version = self.version
+            with read_db.connect() as con:
+                rows = con.execute(SQL.CATALOG).fetchall()
+            return self.offer(version, rows)
+
+    def peek(self):
+        # a patched catalog is reassembled here without touching the database
+        with self._lock:
+            if self._frags is None or time.monotonic() - self._loaded_at >= self.ttl:
+                return None
+            if self._snapshot is None:
+                self._snapshot = self._assemble(self.version, self._frags, self._loaded_at)
+            return self._snapshot
+
+    @staticmethod
+    def _assemble(version, frags, built_at):
+        body = b"[" + b",".join(frags.values()) + b"]"
+        return CatalogSnapshot(version, body, hashlib.blake2b(body, digest_size=12).hexdigest(), built_at)
+
+    @staticmethod
+    def _encode(book_id, title, available, cover):
+        return json.dumps({"id":book_id,"title":title,"available":available,"cover":f"/static/covers/{cover}"},
+                          separators=(",", ":")).encode()
+
+    def offer(self, version, rows):
+        # version is self.version as read before the rows were fetched
+        books = {r[0]: (r[1], r[3], r[4]) for r in rows}
+        frags = {r[0]: self._encode(*r[:4]) for r in rows}
+        with self._lock:
+            if version != self.version:
+                # invalidated while we were reading; serve it but don't keep it
+                return self._assemble(version, frags, time.monotonic())
+            # counts written after the read are newer than the rows
+            for book_id, (available, seen) in self._seen.items():
+                book = books.get(book_id)
+                if book and book[2] < seen:
+                    books[book_id] = (book[0], book[1], seen)
+                    frags[book_id] = self._encode(book_id, book[0], available, book[1])
+            self._books, self._frags = books, frags
+            self._loaded_at = time.monotonic()
+            self._snapshot = None
+        return self.peek()
+
+    def update(self, stock):
+        # {book_id: (available, version)} from a committed write
+        with self._lock:
+            for book_id, (available, version) in stock.items():
+                if book_id in self._seen and self._seen[book_id][1] >= version: continue
+                self._seen[book_id] = (available, version)
+                if self._books is None: continue
+                book = self._books.get(book_id)
+                if book is None:
+                    # added since the load, by another worker or a direct write
+                    self._books = self._frags = self._snapshot = None
+                elif book[2] < version:
+                    self._books[book_id] = (book[0], book[1], version)
+                    self._frags[book_id] = self._encode(book_id, book[0], available, book[1])
+                    self._snapshot = None
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._books = self._frags = self._snapshot = None
+
+catalog_cache = CatalogCache()
+
+CatalogPlan = namedtuple("CatalogPlan", "sql params columns keys fields limit")
+
+# One server-sent-events stream; deliver() never blocks the publisher. A
+# client that falls EVENT_QUEUE_SIZE events behind gets a single "resync"
+# telling it to refetch instead of the backlog.
+class EventSubscription:
+    RESYNC = "event: resync\ndata: {}\n\n"
+
+    def __init__(self, user_id=None, maxsize=EVENT_QUEUE_SIZE):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize)
+
+    def deliver(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            try:
+                while True: self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(self.RESYNC)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+# In-process pub/sub behind /api/events: each change is serialized once and
+# fanned out to every open stream, or only to its user's streams.
+class EventHub:
+    def __init__(self):
+        self._subs = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, sub):
+        with self._lock:
+            if len(self._subs) >= EVENT_MAX_STREAMS:
+                return None
+            self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.discard(sub)
+
+    def listening(self):
+        # whether per-user events are worth collecting at all
+        with self._lock:
+            return bool(self._subs)
+
+    def publish(self, event, data, user_id=None):
+        self.publish_many([(event, data, user_id)])
+
+    def publish_stock(self, rows):
+        self.publish_many([("stock", {"book_id": book_id, "available": available}, None)
+                           for book_id, available in rows])
+
+    def publish_many(self, events):
+        # (event, data, user_id) triples, serialized once each
+        with self._lock:
+            if not self._subs: return
+        self.deliver([(user_id, self.payload(event, data)) for event, data, user_id in events])
+
+    @staticmethod
+    def payload(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def deliver(self, events):
+        with self._lock:
+            subs = list(self._subs)
+        for user_id, payload in events:
+            for sub in subs:
+                if user_id is None or sub.user_id == user_id:
+                    sub.deliver(payload)
+
+# EVENT_BUS=sqlite: publish appends to the events table and every process
+# tails it with poll(), so a stream sees changes made by any worker.
+# Delivery to local streams goes through the table as well, keeping one
+# order for everyone.
+class SqliteEventHub(EventHub):
+    def __init__(self):
+        super().__init__()
+        self._last = None
+
+    def listening(self):
+        # streams in other processes can't be seen from here
+        return True
+
+    def publish_many(self, events):
+        if not events: return
+        now = time.time()
+        rows = [(user_id, self.payload(event, data), now) for event, data, user_id in events]
+        try:
+            retry_busy(self._append, rows)
+        except sqlite3.Error:
+            # the change itself is committed; streams resync on reconnect
+            app.logger.exception("could not publish %d events", len(rows))
+
+    def _append(self, rows):
+        with db.connect() as con:
+            con.executemany(SQL.EVENT_APPEND, rows)
+            con.commit()
+
+    def poll(self):
+        # delivers events logged since the last poll; with no streams open
+        # the read position is dropped so a new stream starts from now
+        with self._lock:
+            listening = bool(self._subs)
+        if not listening:
+            self._last = None
+            return 0
+        with read_db.connect() as con:
+            if self._last is None:
+                self._last = con.execute(SQL.EVENT_LAST).fetchone()[0]
+                return 0
+            rows = con.execute(SQL.EVENTS_SINCE, (self._last,)).fetchall()
+        if rows:
+            self._last = rows[-1][0]
+            self.deliver([(user_id, payload) for _, user_id, payload in rows])
+        return len(rows)
+
+    def purge(self):
+        with db.connect() as con:
+            purged = con.execute(SQL.EVENT_PURGE, (time.time() - EVENT_RETENTION,)).rowcount
+            con.commit()
+        return purged
+
+event_hub = SqliteEventHub() if EVENT_BUS == "sqlite" else EventHub()
+
+# Keyset-paged, filterable view of the catalog. Cursors are the sort key of
+# the last row returned, so each page is an index range scan however deep.
+class CatalogService:
+    FIELDS = {
+        "id": "id",
+        "title": "title",
+        "author": "author",
+        "available": "available_stock",
+        "cover": "cover"
+    }
+    SORTS = {"id": ("id",), "title": ("title", "id")}
+
     def __init__(self,db): self.db=db
+
+    @staticmethod
+    def encode_cursor(key):
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor, size):
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        except ValueError:
+            raise ValueError("Invalid cursor")
+        if not isinstance(key, list) or len(key) != size:
+            raise ValueError("Invalid cursor")
+        # only values sqlite can bind; bool is left out with the rest
+        if not all(type(k) in (str, int, float) for k in key):
+            raise ValueError("Invalid cursor")
+        return key
+
+    @staticmethod
+    def match_query(q):
+        # every word must prefix-match a word of the title or author
+        words = re.findall(r"\w+", q)
+        return " ".join(f'"{w}"*' for w in words)
+
+    def page(self, q=None, available=None, sort="id", after=None,
+             limit=CATALOG_PAGE_SIZE, fields=None):
+        plan = self.plan(q, available, sort, after, limit, fields)
+        if plan is None:
+            return [], None
+        with read_db.connect() as con:
+            rows=con.execute(plan.sql,plan.params).fetchall()
+        return self.shape(plan, rows)
+
+    def plan(self, q=None, available=None, sort="id", after=None,
+             limit=CATALOG_PAGE_SIZE, fields=None):
+        if sort not in self.SORTS:
+            raise ValueError("Invalid sort")
+        fields = fields or ["id", "title", "available", "cover"]
+        unknown = [f for f in fields if f not in self.FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown field: {unknown[0]}")
+        limit = max(1, min(limit, CATALOG_MAX_PAGE_SIZE))
+        keys = self.SORTS[sort]
+
+        columns = list(keys) + [self.FIELDS[f] for f in fields if self.FIELDS[f] not in keys]
+        where, params = [], []
+        if q:
+            match = self.match_query(q)
+            if not match:
+                return None
+            where.append("id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)")
+            params.append(match)
+        if available is not None:
+            where.append("available_stock>0" if available else "available_stock<=0")
+        if after:
+            where.append(f"({','.join(keys)}) > ({','.join('?' * len(keys))})")
+            params.extend(self.decode_cursor(after, len(keys)))
+
+        sql = f"SELECT {','.join(columns)} FROM books"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {','.join(keys)} LIMIT ?"
+        params.append(limit + 1)
+        return CatalogPlan(sql, params, columns, keys, fields, limit)
+
+    def shape(self, plan, rows):
+        cursor = None
+        if len(rows) > plan.limit:
+            rows = rows[:plan.limit]
+            cursor = self.encode_cursor(list(rows[-1][:len(plan.keys)]))
+        index = {c: i for i, c in enumerate(plan.columns)}
+        items = []
+        for r in rows:
+            item = {f: r[index[self.FIELDS[f]]] for f in plan.fields}
+            if "cover" in item:
+                item["cover"] = f"/static/covers/{item['cover']}"
+            items.append(item)
+        return items, cursor
+
+catalog_service = CatalogService(db)
+
+class BorrowService:
+    loan_days=7
+    def __init__(self,db): self.db=db
+
     def create_borrow(self,user_id,copy_id,book_id):
         now=datetime.now()
-        ret=now+timedelta(days=7)
-        con=db.connect()
-        cur=con.cursor()
-        cur.execute("""
-            INSERT INTO borrows (user_id,copy_id,borrowed_at,return_by)
-            VALUES (?,?,?,?)
-        """,(user_id,copy_id,now,ret))
-        con.commit()
-        con.close()
+        ret=now+timedelta(days=self.loan_days)
+        with db.connect() as con:
+            con.execute(SQL.CREATE_BORROW,(user_id,copy_id,now,ret))
+            con.commit()
+
+    def borrow(self,user_id,qr_code):
+        result=self.borrow_batch(user_id,[qr_code])[0]
+        del result["qr_code"]
+        return result
+
+    @staticmethod
+    def plan(qr_codes,rows,ret):
+        # per-scan outcome from copies read under the write lock, plus the
+        # (qr,copy_id,book_id,status) claims that are safe to write
+        found={r[0]:r[1:] for r in rows}
+        results,claims,seen=[],[],set()
+        for qr in qr_codes:
+            copy=found.get(qr)
+            if qr in seen:
+                result={"error":"Scanned twice"}
+            elif not copy:
+                result={"error":"Invalid QR"}
+            else:
+                copy_id,book_id,status,mine=copy
+                if status=="available" or (status=="prebooked" and mine):
+                    claims.append((qr,copy_id,book_id,status))
+                    result={"status":"borrowed","copy_id":copy_id,"book_id":book_id,"return_by":ret.isoformat()}
+                elif status=="prebooked":
+                    result={"error":"Copy is reserved by another user","conflict":True}
+                else:
+                    result={"error":"Copy already borrowed","conflict":True}
+            seen.add(qr)
+            result["qr_code"]=qr
+            results.append(result)
+        return results,claims
+
+    def borrow_batch(self,user_id,qr_codes):
+        now=datetime.now()
+        results,claims,stock=retry_busy(lambda: transact(
+            self.borrow_tx(user_id,qr_codes,now,now+timedelta(days=self.loan_days))))
+        self.announce(user_id,claims,stock)
+        return results
+
+    @classmethod
+    def borrow_tx(cls,user_id,qr_codes,now,ret):
+        # every scan is resolved and checked out in one write transaction;
+        # holding the lock from the read on means no claim below can lose a race
+        rows=yield "all",SQL.COPIES_FOR_BORROW,(user_id,json.dumps(qr_codes))
+        results,claims=cls.plan(qr_codes,rows,ret)
+        stock={}
+        yield "many",SQL.CLAIM_FOR_BORROW,[(c[1],c[1],user_id) for c in claims]
+        for qr,copy_id,book_id,status in claims:
+            if status=="available":
+                stock.update(stock_of((yield "all",SQL.TAKE_STOCK,(book_id,))))
+        yield "many",SQL.COMPLETE_PREBOOK,[(c[1],user_id) for c in claims if c[3]=="prebooked"]
+        yield "many",SQL.CREATE_BORROW,[(user_id,c[1],now,ret) for c in claims]
+        return results,claims,stock
+
+    @staticmethod
+    def announce(user_id,claims,stock):
+        stock_changed(stock)
+        for qr,copy_id,book_id,status in claims:
+            if status=="prebooked":
+                event_hub.publish("prebook",{"status":"completed","book_id":book_id,"qr":qr},user_id=user_id)
+
+class NormalBorrow(BorrowService):
+    loan_days=7
 
 class BorrowFactory:
     @staticmethod
@@ -105,67 +1848,231 @@ class BorrowFactory:
 
 borrow_service=BorrowFactory.get_service(db)
 
+class ReturnService:
+    def __init__(self,db): self.db=db
+
+    @staticmethod
+    def fine(due,now):
+        # (days late, fine); every started day past return_by counts
+        if isinstance(due,str): due=datetime.fromisoformat(due)
+        late=(now-due).total_seconds()
+        days=math.ceil(late/86400) if late>0 else 0
+        return days,days*FINE_PER_DAY
+
+    @staticmethod
+    def plan(qr_codes,rows,user_id,staff,now):
+        # per-scan outcome from open loans read under the write lock, plus
+        # the (qr,copy_id,book_id,borrow_id) loans to close
+        found={r[0]:r[1:] for r in rows}
+        results,closes,seen=[],[],set()
+        for qr in qr_codes:
+            loan=found.get(qr)
+            if qr in seen:
+                result={"error":"Scanned twice"}
+            elif not loan:
+                result={"error":"Invalid QR"}
+            else:
+                copy_id,book_id,borrow_id,borrower,due=loan
+                if borrow_id is None:
+                    result={"error":"Copy is not on loan","conflict":True}
+                elif borrower!=user_id and not staff:
+                    result={"error":"Copy is on loan to another user","conflict":True}
+                else:
+                    days,fine=ReturnService.fine(due,now)
+                    closes.append((qr,copy_id,book_id,borrow_id))
+                    result={"status":"returned","copy_id":copy_id,"book_id":book_id,
+                            "returned_at":now.isoformat(),"overdue_days":days,"fine":fine}
+            seen.add(qr)
+            result["qr_code"]=qr
+            results.append(result)
+        return results,closes
+
+    def return_copy(self,user_id,qr_code,staff=False):
+        result=self.return_batch(user_id,[qr_code],staff)[0]
+        del result["qr_code"]
+        return result
+
+    def return_batch(self,user_id,qr_codes,staff=False):
+        results,stock,served=retry_busy(lambda: transact(self.return_tx(user_id,qr_codes,staff,datetime.now())))
+        self.announce(stock,served)
+        return results
+
+    @classmethod
+    def return_tx(cls,user_id,qr_codes,staff,now):
+        # closing the loan, freeing the copy, restoring stock and handing the
+        # copy to the hold queue commit together
+        rows=yield "all",SQL.OPEN_LOANS_BY_QR,(json.dumps(qr_codes),)
+        results,closes=cls.plan(qr_codes,rows,user_id,staff,now)
+        yield "many",SQL.CLOSE_BORROW,[(now,c[3]) for c in closes]
+        stock={}
+        for qr,copy_id,book_id,borrow_id in closes:
+            # stock only comes back for a copy that was still out; one
+            # already freed or written off keeps the count where it is
+            if (yield "run",SQL.RELEASE_BORROWED_COPY,(copy_id,)):
+                stock.update(stock_of((yield "all",SQL.RETURN_STOCK,(book_id,))))
+        served=yield from HoldService.serve_tx(list({c[2] for c in closes}),now,stock)
+        return results,stock,served
+
+    @staticmethod
+    def announce(stock,served):
+        stock_changed(stock)
+        HoldService.announce(served)
+
+    def overdue(self,user_id=None):
+        # yields report rows straight off the cursor; the connection goes
+        # back to the pool when the generator finishes or is closed
+        now=datetime.now()
+        with report_db.connect() as con:
+            cur=con.cursor()
+            if user_id is None:
+                cur.execute(SQL.OVERDUE,(now,))
+            else:
+                cur.execute(SQL.OVERDUE_FOR_USER,(now,user_id))
+            while True:
+                rows=cur.fetchmany(REPORT_FETCH_SIZE)
+                if not rows: break
+                for title,qr,due,borrower in rows:
+                    days,fine=self.fine(due,now)
+                    yield {"title":title,"qr":qr,"due":datetime.fromisoformat(str(due)).isoformat(),
+                           "overdue_days":days,"fine":fine,"user_id":borrower}
+
+return_service=ReturnService(db)
+
+HistoryPlan = namedtuple("HistoryPlan", "sql params limit")
+
+# A user's loans newest first, keyset-paged on (borrowed_at, id) so each page
+# is a range of idx_borrows_user_borrowed. The cursor holds the raw stored
+# key of the last row so it compares exactly against the column.
+class HistoryService:
+    STATES = {
+        None: "",
+        "borrowed": " AND br.returned_at IS NULL",
+        "returned": " AND br.returned_at IS NOT NULL"
+    }
+
+    def __init__(self,db): self.db=db
+
+    def page(self, user_id, state=None, after=None, limit=HISTORY_PAGE_SIZE):
+        plan=self.plan(user_id,state,after,limit)
+        return self.shape(plan,loan_repository.page(plan))
+
+    def plan(self, user_id, state=None, after=None, limit=HISTORY_PAGE_SIZE):
+        if state not in self.STATES:
+            raise ValueError("Invalid state")
+        limit=max(1,min(limit,HISTORY_MAX_PAGE_SIZE))
+        sql="""
+            SELECT br.id,b.title,bc.qr_code,br.borrowed_at,br.return_by,br.returned_at
+            FROM borrows br
+            JOIN book_copies bc ON br.copy_id=bc.copy_id
+            JOIN books b ON bc.book_id=b.id
+            WHERE br.user_id=?"""+self.STATES[state]
+        params=[user_id]
+        if after:
+            sql+=" AND (br.borrowed_at,br.id) < (?,?)"
+            params.extend(CatalogService.decode_cursor(after,2))
+        sql+=" ORDER BY br.borrowed_at DESC,br.id DESC LIMIT ?"
+        params.append(limit+1)
+        return HistoryPlan(sql,params,limit)
+
+    def shape(self, plan, rows):
+        # rows are plain tuples in Borrow column order
+        cursor=None
+        if len(rows)>plan.limit:
+            rows=rows[:plan.limit]
+            cursor=CatalogService.encode_cursor([rows[-1][3],rows[-1][0]])
+        return [Borrow.API(None,row) for row in rows],cursor
+
+    def export(self):
+        # every user's loans as NDJSON lines, streamed off the cursor
+        loans=loan_repository.export()
+        try:
+            for loan in loans:
+                yield json.dumps(loan)+"\n"
+        finally:
+            loans.close()
+
+history_service=HistoryService(db)
+
 class PrebookService:
     def __init__(self,db): self.db=db
 
     def expire_prebooks(self):
+        # runs inline on the prebook, hold and borrow paths as well as from
+        # the scheduler, so a busy write lock is retried like any other writer
+        return retry_busy(self._expire)
+
+    def _expire(self):
         now=datetime.now()
-        con=db.connect()
-        cur=con.cursor()
-        cur.execute("""
-            SELECT id,copy_id FROM borrow_requests
-            WHERE status='prebooked' AND expires_at < ?
-        """,(now,))
-        for rid,copy_id in cur.fetchall():
-            cur.execute("UPDATE borrow_requests SET status='expired' WHERE id=?",(rid,))
-            cur.execute("UPDATE book_copies SET status='available' WHERE copy_id=?",(copy_id,))
-            cur.execute("""
-                UPDATE books SET available_stock=available_stock+1
-                WHERE id=(SELECT book_id FROM book_copies WHERE copy_id=?)
-            """,(copy_id,))
-        con.commit()
-        con.close()
+        # leaving the block rolls back and releases the connection if any
+        # statement fails, "database is locked" included; transact() below
+        # reuses this thread's connection
+        with db.connect() as con:
+            # cheap read first so an idle check never takes the write lock
+            if not con.execute(SQL.ANY_EXPIRED,(now,)).fetchone():
+                return 0
+            stock,expired,holders,served=transact(self.expire_tx(now,event_hub.listening()))
+        self.announce_expired(stock,holders,served)
+        return expired
+
+    @staticmethod
+    def expire_tx(now,notify=False):
+        holders=(yield "all",SQL.EXPIRED_HOLDERS,(now,)) if notify else []
+        stock=stock_of((yield "all",SQL.EXPIRE_RESTORE_STOCK,(now,)))
+        yield "run",SQL.EXPIRE_RELEASE_COPIES,(now,)
+        expired=yield "run",SQL.EXPIRE_REQUESTS,(now,)
+        # the books whose stock came back are the ones with freed copies
+        served=yield from HoldService.serve_tx(list(stock),now,stock)
+        return stock,expired,holders,served
+
+    @staticmethod
+    def announce_expired(stock,holders,served):
+        stock_changed(stock)
+        event_hub.publish_many([("prebook",{"status":"expired","book_id":book_id},user_id)
+                                for user_id,book_id in holders])
+        HoldService.announce(served)
+
+    def next_expiry(self):
+        with db.connect() as con:
+            exp=con.execute(SQL.NEXT_EXPIRY).fetchone()[0]
+        if isinstance(exp,str):
+            exp=datetime.fromisoformat(exp)
+        return exp
 
     def prebook(self,user_id,role,book_id):
         self.expire_prebooks()
-        con=db.connect()
-        cur=con.cursor()
-
-        max_pre=1 if role=="student" else 2
-        cur.execute("""
-            SELECT COUNT(*) FROM borrow_requests
-            WHERE user_id=? AND status='prebooked'
-        """,(user_id,))
-        if cur.fetchone()[0]>=max_pre:
-            con.close()
+        result=retry_busy(lambda: transact(self.claim_tx(user_id,self.limit(role),book_id,datetime.now())))
+        self.announce(user_id,book_id,result)
+        return result
+
+    @staticmethod
+    def announce(user_id,book_id,result):
+        if "error" in result: return
+        expiry_scheduler.notify(datetime.fromisoformat(result["expires_at"]))
+        stock_changed(result.pop("stock"))
+        event_hub.publish("prebook",{"status":"prebooked","book_id":book_id,**result},user_id=user_id)
+
+    @staticmethod
+    def limit(role):
+        return 1 if role=="student" else 2
+
+    @staticmethod
+    def claim_tx(user_id,max_pre,book_id,now):
+        # limit check and copy claim share one write transaction, so two
+        # requests can neither exceed the limit nor take the same copy
+        exp=now+PREBOOK_TTL
+        if (yield "one",SQL.ACTIVE_PREBOOKS,(user_id,))[0]>=max_pre:
             return {"error":"Prebook limit reached"}
 
-        cur.execute("""
-            SELECT copy_id FROM book_copies
-            WHERE book_id=? AND status='available' LIMIT 1
-        """,(book_id,))
-        row=cur.fetchone()
+        row=yield "all",SQL.CLAIM_FOR_PREBOOK,(book_id,)
         if not row:
-            con.close()
             return {"error":"No copy available"}
+        copy_id=row[0][0]
 
-        copy_id=row[0]
-        now=datetime.now()
-        exp=now+timedelta(hours=1)
-
-        cur.execute("UPDATE book_copies SET status='prebooked' WHERE copy_id=?",(copy_id,))
-        cur.execute("""
-            UPDATE books SET available_stock=available_stock-1
-            WHERE id=? AND available_stock>0
-        """,(book_id,))
-        cur.execute("""
-            INSERT INTO borrow_requests (user_id,copy_id,request_time,expires_at,status)
-            VALUES (?,?,?,?, 'prebooked')
-        """,(user_id,copy_id,now,exp))
-        con.commit()
-        con.close()
-
-        return {"status":"prebooked","copy_id":copy_id,"expires_at":exp.isoformat()}
+        stock=stock_of((yield "all",SQL.TAKE_STOCK,(book_id,)))
+        yield "run",SQL.CREATE_PREBOOK,(user_id,copy_id,now,exp)
+        # a copy that got past the queue still settles this user's hold
+        yield "run",SQL.CANCEL_HOLD,(user_id,book_id)
+        return {"status":"prebooked","copy_id":copy_id,"expires_at":exp.isoformat(),"stock":stock}
 
 class PrebookFactory:
     @staticmethod
@@ -174,6 +2081,368 @@ class PrebookFactory:
 
 prebook_service = PrebookService(db)
 
+# Per-book FIFO waitlist. Users queue only while no copy is free; whatever
+# frees a copy (a return, an expired prebook) calls serve() inside its own
+# write transaction, so the copy becomes the next user's prebook before any
+# other request can see it on the shelf.
+class HoldService:
+    def __init__(self,db): self.db=db
+
+    def place(self,user_id,role,book_id):
+        prebook_service.expire_prebooks()
+        return retry_busy(lambda: transact(self.place_tx(user_id,PrebookService.limit(role),book_id,datetime.now())))
+
+    @staticmethod
+    def place_tx(user_id,max_pre,book_id,now):
+        row=yield "one",SQL.HOLD_CHECK,(user_id,user_id,book_id)
+        if not row:
+            return {"error":"Book not found"}
+        free,prebooked,holds=row
+        if free:
+            return {"error":"A copy is available, prebook it instead"}
+        if prebooked:
+            return {"error":"Already prebooked"}
+        # an error result rolls the insert back
+        if (yield "run",SQL.PLACE_HOLD,(user_id,book_id,max_pre,now)) and holds>=HOLD_LIMIT:
+            return {"error":"Hold limit reached"}
+        position=(yield "one",SQL.HOLD_POSITION,(book_id,user_id,book_id))[0]
+        return {"status":"queued","book_id":book_id,"position":position}
+
+    def cancel(self,user_id,book_id):
+        return retry_busy(lambda: transact(self.cancel_tx(user_id,book_id)))
+
+    @staticmethod
+    def cancel_tx(user_id,book_id):
+        if (yield "run",SQL.CANCEL_HOLD,(user_id,book_id)):
+            return {"status":"cancelled"}
+        return {"error":"No hold"}
+
+    @staticmethod
+    def serve_tx(book_ids,now,stock):
+        # runs inside the caller's body once copies are back to available;
+        # each freed copy goes to the oldest eligible hold on its book.
+        # stock picks up the new counts, and the returned (user_id,book_id,
+        # copy_id,expires_at) allocations are announced after commit
+        served=[]
+        if not book_ids: return served
+        exp=now+PREBOOK_TTL
+        for book_id, in (yield "all",SQL.HELD_BOOKS,(json.dumps(book_ids),)):
+            while True:
+                hold=yield "one",SQL.NEXT_HOLD,(book_id,)
+                if not hold: break
+                row=yield "all",SQL.CLAIM_FOR_PREBOOK,(book_id,)
+                if not row: break
+                hold_id,user_id=hold
+                stock.update(stock_of((yield "all",SQL.TAKE_STOCK,(book_id,))))
+                yield "run",SQL.CREATE_PREBOOK,(user_id,row[0][0],now,exp)
+                yield "run",SQL.DELETE_HOLD,(hold_id,)
+                served.append((user_id,book_id,row[0][0],exp))
+        return served
+
+    @staticmethod
+    def announce(served):
+        for user_id,book_id,copy_id,exp in served:
+            HOLDS_SERVED.inc()
+            expiry_scheduler.notify(exp)
+            event_hub.publish("prebook",{"status":"prebooked","book_id":book_id,"copy_id":copy_id,
+                                         "expires_at":exp.isoformat(),"hold":True},user_id=user_id)
+
+hold_service = HoldService(db)
+
+# Expires prebooks at their deadline so read endpoints never take the
+# write lock; sleeps until the earliest pending expires_at or a notify().
+class ExpiryScheduler:
+    def __init__(self, service, max_sleep=PREBOOK_EXPIRY_MAX_SLEEP):
+        self.service = service
+        self.max_sleep = max_sleep
+        self.next_deadline = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def ensure_started(self):
+        if self.running(): return
+        with self._lock:
+            if self.running(): return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="prebook-expiry", daemon=True)
+            self._thread.start()
+
+    def notify(self, expires_at):
+        if self.next_deadline is None or expires_at < self.next_deadline:
+            self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.service.expire_prebooks()
+                self.next_deadline = self.service.next_expiry()
+            except sqlite3.Error:
+                app.logger.exception("prebook expiry failed")
+                self.next_deadline = None
+            sleep = self.max_sleep
+            if self.next_deadline is not None:
+                wait = (self.next_deadline - datetime.now()).total_seconds()
+                sleep = min(max(wait, 0.05), self.max_sleep)
+            self._wake.wait(sleep)
+            self._wake.clear()
+
+expiry_scheduler = ExpiryScheduler(prebook_service)
+
+# Recomputes available_stock from book_copies and fixes books that drifted.
+# The full pass is one grouped query over idx_copies_book_status, run without
+# the write lock; the books it flags are recounted under the lock before they
+# are fixed. The incremental pass only recounts books in stock_changes, which
+# triggers on book_copies fill in, and clears the log in the same transaction.
+class StockReconciler:
+    def __init__(self, db): self.db = db
+
+    def run(self, full=False, fix=True):
+        # returns [(book_id, stored, actual)] for every drifted book
+        with db.connect() as con:
+            cur = con.cursor()
+            if full:
+                suspects = [r[0] for r in cur.execute(SQL.STOCK_DRIFT_ALL)]
+                cur.execute("BEGIN IMMEDIATE")
+            else:
+                cur.execute("BEGIN IMMEDIATE")
+                suspects = [r[0] for r in cur.execute(SQL.STOCK_CHANGES)]
+                cur.execute(SQL.CLEAR_STOCK_CHANGES)
+            drift = cur.execute(SQL.STOCK_DRIFT_BOOKS, (json.dumps(suspects),)).fetchall() if suspects else []
+            if fix:
+                cur.executemany(SQL.FIX_STOCK, [(actual, book_id, stored) for book_id, stored, actual in drift])
+                con.commit()
+
+        STOCK_DRIFT.set(len(drift))
+        if fix and drift:
+            STOCK_DRIFT_FIXED.inc(len(drift))
+            catalog_cache.invalidate()
+            event_hub.publish_stock((book_id, actual) for book_id, stored, actual in drift)
+        return drift
+
+stock_reconciler = StockReconciler(db)
+
+# Calls fn every interval seconds on a daemon thread; errors are logged.
+class PeriodicJob:
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def ensure_started(self):
+        if self.running(): return
+        with self._lock:
+            if self.running(): return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.fn()
+            except sqlite3.Error:
+                app.logger.exception("%s failed", self.name)
+
+def reconcile_changed_stock():
+    drift = stock_reconciler.run()
+    if drift:
+        app.logger.warning("fixed available_stock drift on books %s", [d[0] for d in drift])
+
+reconcile_scheduler = PeriodicJob("stock-reconcile", STOCK_RECONCILE_INTERVAL, reconcile_changed_stock)
+# every worker checks in four times per interval, so a copy taken by another
+# one is picked up quickly, and only the first check past the interval copies
+snapshot_refresher = PeriodicJob("db-snapshot", DB_SNAPSHOT_INTERVAL / 4,
+                                 lambda: report_db.refresh(DB_SNAPSHOT_INTERVAL))
+app.config.setdefault("EXPIRY_SCHEDULER", True)
+app.config.setdefault("STOCK_RECONCILE", True)
+
+def warm_up(connections=2):
+    # run by each worker before it takes traffic (gunicorn post_worker_init)
+    db.prefill(connections)
+    catalog_cache.get()
+    password_hasher.dummy()
+    start_background_jobs()
+
+@app.before_request
+def start_background_jobs():
+    # started lazily so every worker process (including forked ones) runs one
+    if app.config["EXPIRY_SCHEDULER"]:
+        expiry_scheduler.ensure_started()
+    if app.config["STOCK_RECONCILE"]:
+        reconcile_scheduler.ensure_started()
+    if DB_READ_SNAPSHOT:
+        snapshot_refresher.ensure_started()
+    if SESSION_STORE == "sqlite":
+        session_purger.ensure_started()
+    if EVENT_BUS == "sqlite":
+        event_poller.ensure_started()
+        event_purger.ensure_started()
+
+# =========================================================
+# SESSIONS
+# =========================================================
+
+class MemorySessionStore:
+    def __init__(self, size=SESSION_MEMORY_SIZE):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None: return None
+            expires, data = item
+            if expires <= time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return data
+
+    def set(self, key, data, ttl):
+        with self._lock:
+            self._items[key] = (time.time() + ttl, data)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+class SqliteSessionStore:
+    def __init__(self, cache_ttl=SESSION_CACHE_TTL):
+        self.cache_ttl = cache_ttl
+        self.cache = MemorySessionStore()
+
+    def get(self, key):
+        data = self.cache.get(key)
+        if data is not None: return data
+        now = time.time()
+        with read_db.connect() as con:
+            row = con.execute(SQL.SESSION_GET, (key, now)).fetchone()
+        if row is None: return None
+        data = json.loads(row[0])
+        self.cache.set(key, data, min(self.cache_ttl, row[1] - now))
+        return data
+
+    def set(self, key, data, ttl):
+        with db.connect() as con:
+            con.execute(SQL.SESSION_SET, (key, json.dumps(data), time.time() + ttl))
+            con.commit()
+        self.cache.set(key, data, min(self.cache_ttl, ttl))
+
+    def delete(self, key):
+        with db.connect() as con:
+            con.execute(SQL.SESSION_DELETE, (key,))
+            con.commit()
+        self.cache.delete(key)
+
+    def purge(self):
+        with db.connect() as con:
+            purged = con.execute(SQL.SESSION_PURGE, (time.time(),)).rowcount
+            con.commit()
+        return purged
+
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+
+# The cookie carries only a random id. Stores are keyed by its digest, so
+# the sessions table can't be replayed as cookies. load()/commit() hold
+# all the logic so the Quart interface in asgi.py can share it.
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store, ttl=SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    @staticmethod
+    def key(sid):
+        return hashlib.sha256(sid.encode()).hexdigest()
+
+    def issue(self, data):
+        sid = secrets.token_urlsafe(32)
+        self.store.set(self.key(sid), data, self.ttl)
+        return sid
+
+    def load(self, sid):
+        data = self.store.get(self.key(sid)) if sid else None
+        return ServerSession() if data is None else ServerSession(data, sid)
+
+    def regenerate(self, session):
+        # on login, so an id planted before authentication is never promoted
+        if session.sid:
+            self.store.delete(self.key(session.sid))
+            session.sid = None
+        session.modified = True
+
+    def commit(self, session):
+        # the cookie value to set, "" to delete the cookie, None to leave it
+        if not session:
+            if session.sid and session.modified:
+                self.store.delete(self.key(session.sid))
+                return ""
+            return None
+        if not session.modified:
+            return None
+        if session.sid:
+            self.store.set(self.key(session.sid), dict(session), self.ttl)
+            return None
+        session.sid = self.issue(dict(session))
+        return session.sid
+
+    def write_cookie(self, app, session, response, value):
+        if session.accessed or value is not None:
+            response.vary.add("Cookie")
+        if value is None: return
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if value == "":
+            response.delete_cookie(name, domain=domain, path=path)
+            return
+        response.set_cookie(name, value, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def open_session(self, app, request):
+        return self.load(request.cookies.get(self.get_cookie_name(app)))
+
+    def save_session(self, app, session, response):
+        self.write_cookie(app, session, response, self.commit(session))
+
+session_store = SqliteSessionStore() if SESSION_STORE == "sqlite" else MemorySessionStore()
+app.session_interface = ServerSessionInterface(session_store)
+session_purger = PeriodicJob("session-purge", SESSION_PURGE_INTERVAL, lambda: session_store.purge())
+
+event_poller = PeriodicJob("event-poll", EVENT_POLL_INTERVAL, lambda: event_hub.poll())
+event_purger = PeriodicJob("event-purge", EVENT_RETENTION, lambda: event_hub.purge())
+
 # =========================================================
 # VIEW
 # =========================================================
@@ -181,47 +2450,93 @@ prebook_service = PrebookService(db)
 @app.route("/")
 def home(): return render_template("login.html")
 
+# pages embed the signed-in user (detail also its live prebooks) instead
+# of fetching /api/me after load
 @app.route("/dashboard")
 def dashboard():
     if "user" not in session: return redirect("/")
-    return render_template("main.html")
+    return render_template("main.html",user=session["user"])
 
 @app.route("/borrow")
 def borrow_page():
     if "user" not in session: return redirect("/")
-    return render_template("borrow.html")
+    return render_template("borrow.html",batch_max=BORROW_BATCH_MAX)
 
 @app.route("/detail")
 def detail_page():
     if "user" not in session: return redirect("/")
-    return render_template("detail.html")
+    return render_template("detail.html",user=session["user"],prebooks=my_prebooks(session["user"]["id"]))
+
+@app.after_request
+def static_cache_headers(resp):
+    if request.path.startswith("/static/covers/"):
+        resp.cache_control.no_cache=None
+        resp.cache_control.public=True
+        resp.cache_control.max_age=COVER_MAX_AGE
+    elif request.path.startswith("/static/qr/"):
+        resp.cache_control.no_cache=None
+        resp.cache_control.public=True
+        resp.cache_control.max_age=QR_MAX_AGE
+        resp.cache_control.immutable=True
+    return resp
 
 # =========================================================
 # CONTROLLER
 # =========================================================
 
+@app.route("/qr/<code>.png")
+def qr_image(code):
+    found=qr_service.get(code)
+    if not found: return jsonify({"error":"Invalid QR"}),404
+    etag,png=found
+    resp=app.response_class(png,mimetype="image/png")
+    resp.set_etag(etag)
+    resp.cache_control.public=True
+    resp.cache_control.max_age=QR_MAX_AGE
+    resp.cache_control.immutable=True
+    return resp.make_conditional(request)
+
 @app.route("/api/book-by-qr/<qr>")
 def book_by_qr(qr):
-    con = db.connect()
-    cur = con.cursor()
-    cur.execute("""
-        SELECT b.title FROM book_copies bc
-        JOIN books b ON bc.book_id=b.id
-        WHERE bc.qr_code=?
-    """,(qr,))
-    r = cur.fetchone()
-    con.close()
-
-    if not r:
+    title = book_repository.title_by_qr(qr)
+    if title is None:
         return jsonify({"error":"Invalid QR"}),404
+    return jsonify({"title": title})
+
+def batch_codes(data):
+    codes=(data or {}).get("qr_codes")
+    if not isinstance(codes,list) or not 0<len(codes)<=BORROW_BATCH_MAX \
+            or not all(isinstance(c,str) for c in codes):
+        return None
+    return codes
+
+def login_fields(data):
+    # anything but strings would reach the hasher and fail there
+    if not isinstance(data,dict): return None
+    fields=[data.get(k) for k in ("id","password","role")]
+    if not all(isinstance(f,str) for f in fields): return None
+    return fields
 
-    return jsonify({"title": r[0]})
+@app.route("/api/book-by-qr/batch",methods=["POST"])
+def books_by_qr():
+    codes=batch_codes(request.get_json(silent=True))
+    if codes is None:
+        return jsonify({"error":f"Send 1-{BORROW_BATCH_MAX} qr_codes"}),400
+    titles=book_repository.titles_by_qr(codes)
+    return jsonify({"books":[{"qr_code":c,"title":titles[c]} if c in titles else {"qr_code":c,"error":"Invalid QR"}
+                             for c in codes]})
 
 @app.route("/api/login",methods=["POST"])
 def api_login():
-    data=request.json
-    user=login_service.authenticate(data["id"],data["password"],data["role"])
+    fields=login_fields(request.get_json(silent=True))
+    if fields is None:
+        return jsonify({"error":"Send id, password and role as strings"}),400
+    try:
+        user=login_service.authenticate(*fields)
+    except HasherBusy:
+        return jsonify({"error":"Too many logins, try again shortly"}),503,{"Retry-After":"1"}
     if not user: return jsonify({"status":"fail"}),401
+    app.session_interface.regenerate(session)
     session["user"]=user.to_dict()
     return jsonify({"status":"success","user":user.to_dict()})
 
@@ -231,51 +2546,56 @@ def api_me():
         return jsonify({"error":"Not logged in"}),401
     return jsonify(session["user"])
 
+CATALOG_ARGS = ("q", "available", "sort", "after", "limit", "fields")
+
 @app.route("/api/books")
 def get_books():
-    prebook_service.expire_prebooks()
-    con=db.connect()
-    cur=con.cursor()
-    cur.execute("SELECT id,title,available_stock,cover FROM books")
-    rows=cur.fetchall()
-    con.close()
-    return jsonify([{"id":r[0],"title":r[1],"available":r[2],"cover":f"/static/covers/{r[3]}"} for r in rows])
+    if any(arg in request.args for arg in CATALOG_ARGS):
+        return get_books_page()
+    snap=catalog_cache.get()
+    resp=app.response_class(snap.body,mimetype="application/json")
+    resp.set_etag(snap.etag)
+    resp.cache_control.no_cache=True
+    return resp.make_conditional(request)
+
+def get_books_page():
+    args=request.args
+    available=args.get("available")
+    fields=args.get("fields")
+    try:
+        items,cursor=catalog_service.page(
+            q=args.get("q"),
+            available=None if available is None else available.lower() in ("1","true","yes"),
+            sort=args.get("sort","id"),
+            after=args.get("after"),
+            limit=args.get("limit",CATALOG_PAGE_SIZE,type=int),
+            fields=[f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        )
+    except ValueError as e:
+        return jsonify({"error":str(e)}),400
+    resp=jsonify(items)
+    if cursor:
+        resp.headers["X-Next-Cursor"]=cursor
+        resp.headers["Link"]=f'<{url_for("get_books",**{**args.to_dict(),"after":cursor})}>; rel="next"'
+    return resp
 
 @app.route("/api/book/<int:bid>")
 def get_book(bid):
-    prebook_service.expire_prebooks()
-    con=db.connect()
-    cur=con.cursor()
-    cur.execute("""
-        SELECT title,author,description,available_stock,cover
-        FROM books WHERE id=?
-    """,(bid,))
-    r=cur.fetchone()
-    con.close()
-    if not r: return jsonify({"error":"Not found"}),404
-    return jsonify({"title":r[0],"author":r[1],"description":r[2],"available":r[3],"cover":f"/static/covers/{r[4]}"})
+    book=book_repository.get(bid)
+    if not book: return jsonify({"error":"Not found"}),404
+    if request.if_none_match.contains(book.etag):
+        resp=app.response_class(status=304)
+    else:
+        resp=jsonify(book.to_dict())
+    resp.set_etag(book.etag)
+    resp.cache_control.no_cache=True
+    return resp
 
 @app.route("/api/my-prebook/<int:book_id>")
 def api_my_prebook(book_id):
     if "user" not in session: return jsonify({})
-    prebook_service.expire_prebooks()
-    user_id=session["user"]["id"]
-    now=datetime.now()
-    con=db.connect()
-    cur=con.cursor()
-    cur.execute("""
-        SELECT bc.qr_code,br.expires_at
-        FROM borrow_requests br
-        JOIN book_copies bc ON br.copy_id=bc.copy_id
-        WHERE br.user_id=? AND bc.book_id=? AND br.status='prebooked' AND br.expires_at>?
-    """,(user_id,book_id,now))
-    row=cur.fetchone()
-    con.close()
-    if not row: return jsonify({})
-    exp=row[1]
-    if isinstance(exp,str):
-        exp=datetime.fromisoformat(exp)
-    return jsonify({"qr":row[0],"expires_at":exp.isoformat()})
+    prebook=prebook_repository.for_book(session["user"]["id"],book_id)
+    return jsonify(prebook.to_dict() if prebook else {})
 
 @app.route("/api/prebook/<int:book_id>",methods=["POST"])
 def api_prebook(book_id):
@@ -288,45 +2608,39 @@ def api_prebook(book_id):
         return jsonify(result),400
     return jsonify(result)
 
+def my_prebooks(user_id):
+    return prebook_repository.active(user_id)
+
 @app.route("/api/my-prebooks")
 def api_my_prebooks():
     if "user" not in session:
         return jsonify([])
+    return jsonify(my_prebooks(session["user"]["id"]))
 
-    prebook_service.expire_prebooks()
-
-    user_id = session["user"]["id"]
-    now = datetime.now()
-
-    con = db.connect()
-    cur = con.cursor()
-
-    cur.execute("""
-        SELECT b.title, bc.qr_code, br.expires_at
-        FROM borrow_requests br
-        JOIN book_copies bc ON br.copy_id = bc.copy_id
-        JOIN books b ON bc.book_id = b.id
-        WHERE br.user_id=? 
-        AND br.status='prebooked'
-        AND br.expires_at > ?
-        ORDER BY br.expires_at ASC
-    """, (user_id, now))
-
-    rows = cur.fetchall()
-    con.close()
-
-    result = []
-    for title, qr, exp in rows:
-        if isinstance(exp, str):
-            exp = datetime.fromisoformat(exp)
-        result.append({
-            "title": title,
-            "qr": qr,
-            "expires_at": exp.isoformat()
-        })
+@app.route("/api/hold/<int:book_id>",methods=["POST"])
+def api_hold(book_id):
+    if "user" not in session:
+        return jsonify({"error":"Not logged in"}),401
+    result=hold_service.place(session["user"]["id"],session["user"]["role"],book_id)
+    if "error" in result:
+        return jsonify(result),404 if result["error"]=="Book not found" else 400
+    return jsonify(result)
 
+@app.route("/api/hold/<int:book_id>",methods=["DELETE"])
+def api_cancel_hold(book_id):
+    if "user" not in session:
+        return jsonify({"error":"Not logged in"}),401
+    result=hold_service.cancel(session["user"]["id"],book_id)
+    if "error" in result:
+        return jsonify(result),404
     return jsonify(result)
 
+@app.route("/api/my-holds")
+def api_my_holds():
+    if "user" not in session:
+        return jsonify([])
+    return jsonify(hold_repository.mine(session["user"]["id"]))
+
 
 @app.route("/api/borrow", methods=["POST"])
 def api_borrow():
@@ -338,56 +2652,259 @@ def api_borrow():
     qr_code = request.json.get("qr_code")
     user_id = session["user"]["id"]
 
-    copy = copy_service.get_by_qr(qr_code)
-    if not copy:
-        return jsonify({"error":"Invalid QR"}),400
+    result = borrow_service.borrow(user_id, qr_code)
+    if "error" in result:
+        return jsonify(result), 409 if result.pop("conflict", False) else 400
+    return jsonify(result)
 
-    copy_id, book_id, status = copy
+@app.route("/api/borrow/batch", methods=["POST"])
+def api_borrow_batch():
+    if "user" not in session:
+        return jsonify({"error":"Not logged in"}),401
+    codes=batch_codes(request.get_json(silent=True))
+    if codes is None:
+        return jsonify({"error":f"Send 1-{BORROW_BATCH_MAX} qr_codes"}),400
 
-    con = db.connect()
-    cur = con.cursor()
+    prebook_service.expire_prebooks()
 
-    # IMPORTANT: if book was NOT prebooked reduce stock now
-    if status == "available":
-        cur.execute("""
-            UPDATE books
-            SET available_stock = available_stock - 1
-            WHERE id=? AND available_stock > 0
-        """, (book_id,))
+    results=borrow_service.borrow_batch(session["user"]["id"],codes)
+    borrowed=sum(1 for r in results if "error" not in r)
+    return jsonify({"borrowed":borrowed,"results":results})
 
-    # if prebook existed mark completed
-    cur.execute("""
-        UPDATE borrow_requests
-        SET status='completed'
-        WHERE copy_id=? AND user_id=? AND status='prebooked'
-    """, (copy_id, user_id))
+def is_staff():
+    return session["user"]["role"] in STAFF_ROLES
+
+@app.route("/api/return", methods=["POST"])
+def api_return():
+    if "user" not in session:
+        return jsonify({"error":"Not logged in"}),401
+    data=request.get_json(silent=True) or {}
+    result=return_service.return_copy(session["user"]["id"],data.get("qr_code"),is_staff())
+    if "error" in result:
+        return jsonify(result), 409 if result.pop("conflict", False) else 400
+    return jsonify(result)
+
+@app.route("/api/return/batch", methods=["POST"])
+def api_return_batch():
+    if "user" not in session:
+        return jsonify({"error":"Not logged in"}),401
+    codes=batch_codes(request.get_json(silent=True))
+    if codes is None:
+        return jsonify({"error":f"Send 1-{BORROW_BATCH_MAX} qr_codes"}),400
+    results=return_service.return_batch(session["user"]["id"],codes,is_staff())
+    returned=sum(1 for r in results if "error" not in r)
+    return jsonify({"returned":returned,"results":results})
+
+def json_array(items):
+    # streams a JSON array one element at a time
+    yield "["
+    for n,item in enumerate(items):
+        yield ("," if n else "")+json.dumps(item)
+    yield "]"
+
+@app.route("/api/overdue")
+def api_overdue():
+    if "user" not in session:
+        return jsonify({"error":"Not logged in"}),401
+    # librarians get the whole library's report, everyone else their own
+    user_id=None if is_staff() else session["user"]["id"]
+    return app.response_class(json_array(return_service.overdue(user_id)),mimetype="application/json")
 
-    con.commit()
-    con.close()
+@app.route("/api/events")
+def api_events():
+    user_id = session["user"]["id"] if "user" in session else None
+    sub = event_hub.subscribe(EventSubscription(user_id))
+    if sub is None:
+        # clients fall back to fetching on demand
+        return jsonify({"error":"Too many event streams"}),503
 
-    copy_service.mark_borrowed(copy_id)
-    borrow_service.create_borrow(user_id, copy_id, book_id)
+    def stream():
+        try:
+            yield f"retry: {EVENT_KEEPALIVE * 1000}\n\n"
+            while True:
+                payload = sub.get(EVENT_KEEPALIVE)
+                yield payload if payload is not None else ": keepalive\n\n"
+        finally:
+            event_hub.unsubscribe(sub)
 
-    return jsonify({"status":"borrowed"})
+    resp = app.response_class(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+def history_response(endpoint, state=None):
+    if "user" not in session:
+        return jsonify({"error":"Not logged in"}),401
+    args=request.args
+    try:
+        items,cursor=history_service.page(
+            session["user"]["id"],state,
+            after=args.get("after"),
+            limit=args.get("limit",HISTORY_PAGE_SIZE,type=int)
+        )
+    except ValueError as e:
+        return jsonify({"error":str(e)}),400
+    resp=jsonify(items)
+    if cursor:
+        resp.headers["X-Next-Cursor"]=cursor
+        resp.headers["Link"]=f'<{url_for(endpoint,**{**args.to_dict(),"after":cursor})}>; rel="next"'
+    return resp
 
 @app.route("/api/history")
 def api_history():
+    return history_response("api_history")
+
+@app.route("/api/borrowed")
+def api_borrowed():
+    return history_response("api_borrowed","borrowed")
+
+@app.route("/api/returned")
+def api_returned():
+    return history_response("api_returned","returned")
+
+@app.route("/api/history/export")
+def api_history_export():
     if "user" not in session:
         return jsonify({"error":"Not logged in"}),401
-    user_id=session["user"]["id"]
-    con=db.connect()
-    cur=con.cursor()
-    cur.execute("""
-        SELECT b.title,bc.qr_code,br.borrowed_at,br.return_by,br.returned_at
-        FROM borrows br
-        JOIN book_copies bc ON br.copy_id=bc.copy_id
-        JOIN books b ON bc.book_id=b.id
-        WHERE br.user_id=?
-        ORDER BY br.borrowed_at DESC
-    """,(user_id,))
-    rows=cur.fetchall()
-    con.close()
-    return jsonify(rows)
+    if not is_staff():
+        return jsonify({"error":"Staff only"}),403
+    resp=app.response_class(history_service.export(),mimetype="application/x-ndjson")
+    resp.headers["Content-Disposition"]="attachment; filename=history.ndjson"
+    return resp
+
+# =========================================================
+# BULK IMPORT
+# =========================================================
+
+def read_import_rows(f, fmt):
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+        return
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+# Streams books and their copies into the catalog. A row is a book keyed by
+# isbn with an optional qr_codes list (space or ';' separated in CSV); a row
+# without a title only adds copies. Every batch is its own short write
+# transaction so the live app keeps getting the lock between them, and stock
+# is recounted from book_copies once at the end for every book touched.
+class CatalogImporter:
+    def __init__(self, db, batch_size=IMPORT_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.stats = {"rows": 0, "books": 0, "copies": 0, "skipped": 0, "recounted": 0}
+
+    def run(self, rows, progress=None):
+        rows = iter(rows)
+        with self.db.connect() as con:
+            try:
+                con.execute(SQL.IMPORT_TOUCHED_TABLE)
+                for batch in iter(lambda: list(islice(rows, self.batch_size)), []):
+                    retry_busy(self._load, con, batch)
+                    if progress: progress(self.stats)
+                self.stats["recounted"] = retry_busy(self._recount, con)
+            finally:
+                con.execute("DROP TABLE IF EXISTS temp.import_books")
+        # other workers pick the new stock up within CATALOG_CACHE_TTL
+        catalog_cache.invalidate()
+        return self.stats
+
+    def _load(self, con, batch):
+        books, copies, isbns, skipped = [], [], set(), 0
+        for row in batch:
+            isbn = (row.get("isbn") or "").strip()
+            if not isbn:
+                skipped += 1
+                continue
+            isbns.add(isbn)
+            if row.get("title"):
+                books.append((isbn, row["title"], row.get("author"), row.get("description"), row.get("cover")))
+            codes = row.get("qr_codes") or []
+            if isinstance(codes, str):
+                codes = codes.replace(";", " ").split()
+            copies.extend((code, isbn) for code in codes)
+        cur = con.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            cur.executemany(SQL.IMPORT_BOOK, books)
+            cur.executemany(SQL.IMPORT_TOUCH_MOVED, ((isbn, code) for code, isbn in copies))
+            cur.executemany(SQL.IMPORT_COPY, copies)
+            placed = cur.rowcount
+            cur.executemany(SQL.IMPORT_TOUCH, ((i,) for i in isbns))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        # counted only once the batch is committed, so a busy retry can't double up
+        self.stats["rows"] += len(batch)
+        self.stats["books"] += len(books)
+        self.stats["copies"] += placed
+        self.stats["skipped"] += skipped + len(copies) - placed
+
+    def _recount(self, con):
+        cur = con.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute(SQL.IMPORT_RECOUNT)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        return cur.rowcount
+
+# =========================================================
+# CLI
+# =========================================================
+
+@app.cli.command("qr-pregen")
+def qr_pregen():
+    """Render QR images for every copy not yet in the disk cache."""
+    with read_db.connect() as con:
+        codes=[r[0] for r in con.execute(SQL.ALL_QR_CODES)]
+    start=time.perf_counter()
+    rendered=qr_service.pregenerate(codes)
+    elapsed=time.perf_counter()-start
+    click.echo(f"{rendered} rendered, {len(codes)-rendered} already cached in {elapsed:.1f}s")
+
+@app.cli.command("import-catalog")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+              help="Defaults to the file extension.")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True)
+def import_catalog(source, fmt, batch_size):
+    """Upsert books (by isbn) and copies (by qr_code) from CSV or JSONL."""
+    fmt=fmt or ("jsonl" if source.name.endswith((".jsonl", ".ndjson")) else "csv")
+    start=time.perf_counter()
+    def progress(stats):
+        elapsed=time.perf_counter()-start
+        click.echo(f"\r{stats['rows']} rows ({stats['rows']/elapsed:.0f} rows/s)", nl=False, err=True)
+    stats=CatalogImporter(db,batch_size).run(read_import_rows(source,fmt),progress)
+    elapsed=time.perf_counter()-start
+    click.echo("", err=True)
+    click.echo(f"{stats['rows']} rows in {elapsed:.1f}s ({stats['rows']/max(elapsed,1e-9):.0f} rows/s): "
+               f"{stats['books']} books, {stats['copies']} copies, {stats['skipped']} skipped, "
+               f"{stats['recounted']} books recounted")
+
+@app.cli.command("overdue-report")
+def overdue_report():
+    """Write every overdue loan as CSV to stdout."""
+    out=csv.writer(click.get_text_stream("stdout"))
+    out.writerow(("user_id","title","qr","due","overdue_days","fine"))
+    for r in return_service.overdue():
+        out.writerow((r["user_id"],r["title"],r["qr"],r["due"],r["overdue_days"],r["fine"]))
+
+@app.cli.command("reconcile-stock")
+@click.option("--full", is_flag=True, help="Recount every book, not just those with changed copies.")
+@click.option("--dry-run", is_flag=True, help="Report drift without fixing it.")
+def reconcile_stock(full, dry_run):
+    """Recompute available_stock from book_copies and fix drift."""
+    start=time.perf_counter()
+    drift=stock_reconciler.run(full=full,fix=not dry_run)
+    for book_id,stored,actual in drift:
+        click.echo(f"book {book_id}: stored {stored}, copies say {actual}")
+    verb="found" if dry_run else "fixed"
+    click.echo(f"{len(drift)} drifted books {verb} in {time.perf_counter()-start:.2f}s")
 
 if __name__=="__main__":
     app.run(debug=True)
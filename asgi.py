@@ -0,0 +1,669 @@
+"""Async serving mode for the library API.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Serves the same routes, templates and session cookies as the Flask app in
+app.py, running the statements from app.SQL through aiosqlite so an idle
+kiosk connection costs a coroutine instead of a request thread. That makes
+it the place to serve /api/events from; next to gunicorn workers, run both
+with EVENT_BUS=sqlite so its streams see their changes.
+Needs quart, aiosqlite and an ASGI server such as uvicorn.
+"""
+import asyncio
+import contextlib
+import hmac
+import json
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import aiosqlite
+from prometheus_client import make_asgi_app
+from quart import Quart, jsonify, redirect, render_template, request, session, url_for
+from quart.sessions import SessionInterface
+
+import app as sync
+from app import (
+    BORROW_BATCH_MAX, BUSY_BACKOFF, BUSY_RETRIES, CATALOG_ARGS, CATALOG_PAGE_SIZE, COVER_MAX_AGE,
+    DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_PRAGMAS, DB_READ_PRAGMAS, EVENT_KEEPALIVE, HISTORY_PAGE_SIZE,
+    QR_MAX_AGE, REPORT_FETCH_SIZE, SQL, Book, BookCopy, Borrow, BorrowRequest, Hold, User, is_busy
+)
+
+
+asgi_app = Quart(__name__, template_folder=sync.app.template_folder,
+                 static_folder=sync.app.static_folder)
+asgi_app.secret_key = sync.app.secret_key
+
+
+# =========================================================
+# MODEL LAYER
+# =========================================================
+
+class AsyncDatabase:
+    def __init__(self, path, pool_size=DB_POOL_SIZE, readonly=False):
+        self.path = path
+        self.pool_size = pool_size
+        self.readonly = readonly
+        self._idle = []
+        self._opened = 0
+        self._cond = None
+
+    async def _open(self):
+        # read-only pools open the primary with mode=ro, like app.ReadOnlyDatabase
+        if self.readonly:
+            con = await aiosqlite.connect(f"file:{self.path}?mode=ro", uri=True)
+        else:
+            con = await aiosqlite.connect(self.path)
+        for pragma in DB_READ_PRAGMAS if self.readonly else DB_PRAGMAS:
+            await con.execute(pragma)
+        return con
+
+    async def _checkout(self):
+        if self._cond is None:
+            # created lazily so it binds to the serving event loop
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            try:
+                await asyncio.wait_for(self._cond.wait_for(
+                    lambda: self._idle or self._opened < self.pool_size), DB_POOL_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise sqlite3.OperationalError("connection pool exhausted")
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        try:
+            return await self._open()
+        except Exception:
+            async with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def connect(self):
+        con = await self._checkout()
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                await con.rollback()
+            async with self._cond:
+                self._idle.append(con)
+                self._cond.notify()
+
+    async def transact(self, body):
+        # drives an app.py transaction body (see app.run_tx) on aiosqlite
+        async with self.connect() as con:
+            await con.execute("BEGIN IMMEDIATE")
+            result = None
+            while True:
+                try:
+                    mode, sql, params = body.send(result)
+                except StopIteration as stop:
+                    result = stop.value
+                    break
+                if mode == "many":
+                    result = (await con.executemany(sql, params)).rowcount
+                else:
+                    async with con.execute(sql, params) as cur:
+                        result = (await cur.fetchone() if mode == "one" else
+                                  await cur.fetchall() if mode == "all" else cur.rowcount)
+            if not (isinstance(result, dict) and "error" in result):
+                await con.commit()
+        return result
+
+    async def close_all(self):
+        if self._cond is None: return
+        async with self._cond:
+            for con in self._idle:
+                await con.close()
+            self._opened -= len(self._idle)
+            self._idle = []
+
+adb = AsyncDatabase(sync.DB)
+# every fetchone/fetchall below is a plain read
+ardb = AsyncDatabase(sync.DB, readonly=True)
+
+async def retry_busy(fn, *args):
+    for attempt in range(BUSY_RETRIES):
+        try:
+            return await fn(*args)
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == BUSY_RETRIES - 1:
+                raise
+            await asyncio.sleep(BUSY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.0))
+
+# model: an app.Row subclass to build from each row, as the sync repositories do
+async def fetchone(sql, params=(), model=None):
+    async with ardb.connect() as con:
+        async with con.execute(sql, params) as cur:
+            row = await cur.fetchone()
+    return model(*row) if model and row else row
+
+async def fetchall(sql, params=(), model=None):
+    async with ardb.connect() as con:
+        async with con.execute(sql, params) as cur:
+            rows = await cur.fetchall()
+    return [model(*r) for r in rows] if model else rows
+
+class AsyncLoginService:
+    def __init__(self, adb): self.adb = adb
+    # mirrors LoginService.authenticate, raising HasherBusy the same way
+    async def authenticate(self, user_id, password, role):
+        if not password: return None
+        row = await fetchone(SQL.CREDENTIALS, (user_id, role))
+        hasher = sync.password_hasher
+        stored = row[5] if row else None
+        # hashing runs on the shared worker pool; the event loop only awaits it
+        if stored:
+            ok = await asyncio.wrap_future(hasher.verify(user_id, password, stored))
+        else:
+            ok = row is not None and hmac.compare_digest(row[6].encode(), password.encode())
+            if not ok:
+                await asyncio.wrap_future(hasher.verify(user_id, password, hasher.dummy()))
+        if not ok: return None
+        if hasher.needs_rehash(stored):
+            try:
+                new = await asyncio.wrap_future(hasher.hash(password))
+                await retry_busy(self._store_hash, user_id, stored, new)
+            except sync.HasherBusy:
+                pass
+            except sqlite3.OperationalError as e:
+                if not is_busy(e): raise
+        return User(*row[:5])
+
+    async def _store_hash(self, user_id, old, new):
+        async with self.adb.connect() as con:
+            await con.execute(SQL.STORE_PASSWORD_HASH, (new, user_id, old))
+            await con.commit()
+
+login_service = AsyncLoginService(adb)
+
+class AsyncBookCopyService:
+    def __init__(self, adb): self.adb = adb
+    async def get_by_qr(self, qr):
+        return await fetchone(SQL.COPY_BY_QR, (qr,), BookCopy)
+    async def mark_borrowed(self, copy_id):
+        async with self.adb.connect() as con:
+            await con.execute(SQL.MARK_BORROWED, (copy_id,))
+            await con.commit()
+
+copy_service = AsyncBookCopyService(adb)
+
+class AsyncNormalBorrow:
+    loan_days = sync.NormalBorrow.loan_days
+    def __init__(self, adb): self.adb = adb
+
+    async def create_borrow(self, user_id, copy_id, book_id):
+        now = datetime.now()
+        async with self.adb.connect() as con:
+            await con.execute(SQL.CREATE_BORROW, (user_id, copy_id, now, now + timedelta(days=self.loan_days)))
+            await con.commit()
+
+    async def borrow(self, user_id, qr_code):
+        result = (await self.borrow_batch(user_id, [qr_code]))[0]
+        del result["qr_code"]
+        return result
+
+    async def borrow_batch(self, user_id, qr_codes):
+        now = datetime.now()
+        results, claims, stock = await retry_busy(lambda: self.adb.transact(
+            sync.BorrowService.borrow_tx(user_id, qr_codes, now, now + timedelta(days=self.loan_days))))
+        # announcing can append to the events table (EVENT_BUS=sqlite) and back
+        # off on a busy lock, so it runs off the event loop, here and below
+        await asyncio.to_thread(sync.BorrowService.announce, user_id, claims, stock)
+        return results
+
+borrow_service = AsyncNormalBorrow(adb)
+
+class AsyncReturnService:
+    def __init__(self, adb): self.adb = adb
+
+    async def return_copy(self, user_id, qr_code, staff=False):
+        result = (await self.return_batch(user_id, [qr_code], staff))[0]
+        del result["qr_code"]
+        return result
+
+    async def return_batch(self, user_id, qr_codes, staff=False):
+        results, stock, served = await retry_busy(lambda: self.adb.transact(
+            sync.ReturnService.return_tx(user_id, qr_codes, staff, datetime.now())))
+        await asyncio.to_thread(sync.ReturnService.announce, stock, served)
+        return results
+
+    async def overdue(self, user_id=None):
+        now = datetime.now()
+        sql, params = (SQL.OVERDUE, (now,)) if user_id is None else (SQL.OVERDUE_FOR_USER, (now, user_id))
+        async with ardb.connect() as con:
+            async with con.execute(sql, params) as cur:
+                while rows := await cur.fetchmany(REPORT_FETCH_SIZE):
+                    for title, qr, due, borrower in rows:
+                        days, fine = sync.ReturnService.fine(due, now)
+                        yield {"title": title, "qr": qr, "due": datetime.fromisoformat(str(due)).isoformat(),
+                               "overdue_days": days, "fine": fine, "user_id": borrower}
+
+return_service = AsyncReturnService(adb)
+
+class AsyncPrebookService:
+    def __init__(self, adb): self.adb = adb
+
+    async def expire_prebooks(self):
+        return await retry_busy(self._expire)
+
+    async def _expire(self):
+        now = datetime.now()
+        if not await fetchone(SQL.ANY_EXPIRED, (now,)):
+            return 0
+        stock, expired, holders, served = await self.adb.transact(
+            sync.PrebookService.expire_tx(now, sync.event_hub.listening()))
+        await asyncio.to_thread(sync.PrebookService.announce_expired, stock, holders, served)
+        return expired
+
+    async def prebook(self, user_id, role, book_id):
+        await self.expire_prebooks()
+        limit = sync.PrebookService.limit(role)
+        result = await retry_busy(lambda: self.adb.transact(
+            sync.PrebookService.claim_tx(user_id, limit, book_id, datetime.now())))
+        await asyncio.to_thread(sync.PrebookService.announce, user_id, book_id, result)
+        return result
+
+prebook_service = AsyncPrebookService(adb)
+
+class AsyncHoldService:
+    def __init__(self, adb): self.adb = adb
+
+    async def place(self, user_id, role, book_id):
+        await prebook_service.expire_prebooks()
+        limit = sync.PrebookService.limit(role)
+        return await retry_busy(lambda: self.adb.transact(
+            sync.HoldService.place_tx(user_id, limit, book_id, datetime.now())))
+
+    async def cancel(self, user_id, book_id):
+        return await retry_busy(lambda: self.adb.transact(sync.HoldService.cancel_tx(user_id, book_id)))
+
+hold_service = AsyncHoldService(adb)
+
+# EventSubscription fed from publisher threads into this event loop
+class AsyncEventSubscription(sync.EventSubscription):
+    def __init__(self, user_id=None):
+        super().__init__(user_id)
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+
+    def deliver(self, payload):
+        super().deliver(payload)
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def next(self, timeout):
+        payload = self.get(0)
+        if payload is None:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            payload = self.get(0)
+        return payload
+
+@asgi_app.before_serving
+async def startup():
+    # background jobs stay on the threads shared with the sync app
+    sync.start_background_jobs()
+    # the stand-in hash for unknown users, made before the loop takes logins
+    await asyncio.to_thread(sync.password_hasher.dummy)
+
+@asgi_app.after_serving
+async def shutdown():
+    await adb.close_all()
+    await ardb.close_all()
+
+# =========================================================
+# SESSIONS
+# =========================================================
+
+# Same cookie ids and store as the sync app; a SQLite-backed store is
+# called off the event loop.
+class AsyncSessionInterface(SessionInterface):
+    def __init__(self, shared):
+        self.shared = shared
+
+    async def _call(self, fn, *args):
+        if isinstance(self.shared.store, sync.MemorySessionStore):
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def regenerate(self, session):
+        await self._call(self.shared.regenerate, session)
+
+    async def open_session(self, app, request):
+        return await self._call(self.shared.load, request.cookies.get(self.get_cookie_name(app)))
+
+    async def save_session(self, app, session, response):
+        if response is None: return
+        self.shared.write_cookie(app, session, response, await self._call(self.shared.commit, session))
+
+asgi_app.session_interface = AsyncSessionInterface(sync.app.session_interface)
+
+# =========================================================
+# VIEW
+# =========================================================
+
+@asgi_app.route("/")
+async def home(): return await render_template("login.html")
+
+@asgi_app.route("/dashboard")
+async def dashboard():
+    if "user" not in session: return redirect("/")
+    return await render_template("main.html", user=session["user"])
+
+@asgi_app.route("/borrow")
+async def borrow_page():
+    if "user" not in session: return redirect("/")
+    return await render_template("borrow.html", batch_max=sync.BORROW_BATCH_MAX)
+
+@asgi_app.route("/detail")
+async def detail_page():
+    if "user" not in session: return redirect("/")
+    prebooks = await my_prebooks(session["user"]["id"])
+    return await render_template("detail.html", user=session["user"], prebooks=prebooks)
+
+@asgi_app.after_request
+async def static_cache_headers(resp):
+    if request.path.startswith("/static/covers/"):
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = COVER_MAX_AGE
+    elif request.path.startswith("/static/qr/"):
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = QR_MAX_AGE
+        resp.cache_control.immutable = True
+    return resp
+
+# =========================================================
+# CONTROLLER
+# =========================================================
+
+@asgi_app.route("/qr/<code>.png")
+async def qr_image(code):
+    qr = sync.qr_service
+    if not qr.cached(code) and not await fetchone(SQL.COPY_BY_QR, (code,)):
+        return jsonify({"error": "Invalid QR"}), 404
+    # rendering and disk reads stay off the event loop
+    found = await asyncio.to_thread(qr.image, code)
+    if not found: return jsonify({"error": "Invalid QR"}), 404
+    etag, png = found
+    resp = asgi_app.response_class(png, mimetype="image/png")
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = QR_MAX_AGE
+    resp.cache_control.immutable = True
+    return await resp.make_conditional(request)
+
+@asgi_app.route("/api/book-by-qr/<qr>")
+async def book_by_qr(qr):
+    r = await fetchone(SQL.TITLE_BY_QR, (qr,))
+    if not r:
+        return jsonify({"error": "Invalid QR"}), 404
+    return jsonify({"title": r[0]})
+
+@asgi_app.route("/api/book-by-qr/batch", methods=["POST"])
+async def books_by_qr():
+    codes = sync.batch_codes(await request.get_json(silent=True))
+    if codes is None:
+        return jsonify({"error": f"Send 1-{BORROW_BATCH_MAX} qr_codes"}), 400
+    titles = dict(await fetchall(SQL.TITLES_BY_QR, (json.dumps(codes),)))
+    return jsonify({"books": [{"qr_code": c, "title": titles[c]} if c in titles else {"qr_code": c, "error": "Invalid QR"}
+                              for c in codes]})
+
+@asgi_app.route("/api/login", methods=["POST"])
+async def api_login():
+    fields = sync.login_fields(await request.get_json(silent=True))
+    if fields is None:
+        return jsonify({"error": "Send id, password and role as strings"}), 400
+    try:
+        user = await login_service.authenticate(*fields)
+    except sync.HasherBusy:
+        return jsonify({"error": "Too many logins, try again shortly"}), 503, {"Retry-After": "1"}
+    if not user: return jsonify({"status": "fail"}), 401
+    await asgi_app.session_interface.regenerate(session)
+    session["user"] = user.to_dict()
+    return jsonify({"status": "success", "user": user.to_dict()})
+
+@asgi_app.route("/api/me")
+async def api_me():
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(session["user"])
+
+@asgi_app.route("/api/books")
+async def get_books():
+    if any(arg in request.args for arg in CATALOG_ARGS):
+        return await get_books_page()
+    snap = sync.catalog_cache.peek()
+    if snap is None:
+        version = sync.catalog_cache.version
+        snap = sync.catalog_cache.offer(version, await fetchall(SQL.CATALOG))
+    resp = asgi_app.response_class(snap.body, mimetype="application/json")
+    resp.set_etag(snap.etag)
+    resp.cache_control.no_cache = True
+    return await resp.make_conditional(request)
+
+async def get_books_page():
+    args = request.args
+    available = args.get("available")
+    fields = args.get("fields")
+    try:
+        plan = sync.catalog_service.plan(
+            q=args.get("q"),
+            available=None if available is None else available.lower() in ("1", "true", "yes"),
+            sort=args.get("sort", "id"),
+            after=args.get("after"),
+            limit=args.get("limit", CATALOG_PAGE_SIZE, type=int),
+            fields=[f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    items, cursor = [], None
+    if plan is not None:
+        items, cursor = sync.catalog_service.shape(plan, await fetchall(plan.sql, plan.params))
+    resp = jsonify(items)
+    if cursor:
+        resp.headers["X-Next-Cursor"] = cursor
+        resp.headers["Link"] = f'<{url_for("get_books", **{**args.to_dict(), "after": cursor})}>; rel="next"'
+    return resp
+
+@asgi_app.route("/api/book/<int:bid>")
+async def get_book(bid):
+    book = await fetchone(SQL.BOOK_DETAIL, (bid,), Book)
+    if not book: return jsonify({"error": "Not found"}), 404
+    if request.if_none_match.contains(book.etag):
+        resp = asgi_app.response_class("", status=304)
+    else:
+        resp = jsonify(book.to_dict())
+    resp.set_etag(book.etag)
+    resp.cache_control.no_cache = True
+    return resp
+
+@asgi_app.route("/api/my-prebook/<int:book_id>")
+async def api_my_prebook(book_id):
+    if "user" not in session: return jsonify({})
+    prebook = await fetchone(SQL.MY_PREBOOK, (session["user"]["id"], book_id, datetime.now()), BorrowRequest)
+    return jsonify(prebook.to_dict() if prebook else {})
+
+@asgi_app.route("/api/prebook/<int:book_id>", methods=["POST"])
+async def api_prebook(book_id):
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    result = await prebook_service.prebook(session["user"]["id"], session["user"]["role"], book_id)
+    if "error" in result:
+        return jsonify(result), 400
+    return jsonify(result)
+
+async def my_prebooks(user_id):
+    return [BorrowRequest.LISTED(None, r) for r in await fetchall(SQL.MY_PREBOOKS, (user_id, datetime.now()))]
+
+@asgi_app.route("/api/my-prebooks")
+async def api_my_prebooks():
+    if "user" not in session:
+        return jsonify([])
+    return jsonify(await my_prebooks(session["user"]["id"]))
+
+@asgi_app.route("/api/hold/<int:book_id>", methods=["POST"])
+async def api_hold(book_id):
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    result = await hold_service.place(session["user"]["id"], session["user"]["role"], book_id)
+    if "error" in result:
+        return jsonify(result), 404 if result["error"] == "Book not found" else 400
+    return jsonify(result)
+
+@asgi_app.route("/api/hold/<int:book_id>", methods=["DELETE"])
+async def api_cancel_hold(book_id):
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    result = await hold_service.cancel(session["user"]["id"], book_id)
+    if "error" in result:
+        return jsonify(result), 404
+    return jsonify(result)
+
+@asgi_app.route("/api/my-holds")
+async def api_my_holds():
+    if "user" not in session:
+        return jsonify([])
+    return jsonify([Hold.API(None, r) for r in await fetchall(SQL.MY_HOLDS, (session["user"]["id"],))])
+
+@asgi_app.route("/api/borrow", methods=["POST"])
+async def api_borrow():
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    await prebook_service.expire_prebooks()
+    data = await request.get_json()
+    result = await borrow_service.borrow(session["user"]["id"], data.get("qr_code"))
+    if "error" in result:
+        return jsonify(result), 409 if result.pop("conflict", False) else 400
+    return jsonify(result)
+
+@asgi_app.route("/api/borrow/batch", methods=["POST"])
+async def api_borrow_batch():
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    codes = sync.batch_codes(await request.get_json(silent=True))
+    if codes is None:
+        return jsonify({"error": f"Send 1-{BORROW_BATCH_MAX} qr_codes"}), 400
+    await prebook_service.expire_prebooks()
+    results = await borrow_service.borrow_batch(session["user"]["id"], codes)
+    borrowed = sum(1 for r in results if "error" not in r)
+    return jsonify({"borrowed": borrowed, "results": results})
+
+@asgi_app.route("/api/return", methods=["POST"])
+async def api_return():
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    data = await request.get_json(silent=True) or {}
+    staff = session["user"]["role"] in sync.STAFF_ROLES
+    result = await return_service.return_copy(session["user"]["id"], data.get("qr_code"), staff)
+    if "error" in result:
+        return jsonify(result), 409 if result.pop("conflict", False) else 400
+    return jsonify(result)
+
+@asgi_app.route("/api/return/batch", methods=["POST"])
+async def api_return_batch():
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    codes = sync.batch_codes(await request.get_json(silent=True))
+    if codes is None:
+        return jsonify({"error": f"Send 1-{BORROW_BATCH_MAX} qr_codes"}), 400
+    staff = session["user"]["role"] in sync.STAFF_ROLES
+    results = await return_service.return_batch(session["user"]["id"], codes, staff)
+    returned = sum(1 for r in results if "error" not in r)
+    return jsonify({"returned": returned, "results": results})
+
+@asgi_app.route("/api/overdue")
+async def api_overdue():
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    user_id = None if session["user"]["role"] in sync.STAFF_ROLES else session["user"]["id"]
+
+    async def stream():
+        yield "["
+        n = 0
+        async for item in return_service.overdue(user_id):
+            yield ("," if n else "") + json.dumps(item)
+            n += 1
+        yield "]"
+    return stream(), 200, {"Content-Type": "application/json"}
+
+@asgi_app.route("/api/events")
+async def api_events():
+    user_id = session["user"]["id"] if "user" in session else None
+    sub = sync.event_hub.subscribe(AsyncEventSubscription(user_id))
+    if sub is None:
+        return jsonify({"error": "Too many event streams"}), 503
+
+    async def stream():
+        try:
+            yield f"retry: {EVENT_KEEPALIVE * 1000}\n\n".encode()
+            while True:
+                payload = await sub.next(EVENT_KEEPALIVE)
+                yield (payload if payload is not None else ": keepalive\n\n").encode()
+        finally:
+            sync.event_hub.unsubscribe(sub)
+
+    resp = asgi_app.response_class(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    resp.timeout = None
+    return resp
+
+async def history_response(endpoint, state=None):
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    args = request.args
+    try:
+        plan = sync.history_service.plan(session["user"]["id"], state, after=args.get("after"),
+                                         limit=args.get("limit", HISTORY_PAGE_SIZE, type=int))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    items, cursor = sync.history_service.shape(plan, await fetchall(plan.sql, plan.params))
+    resp = jsonify(items)
+    if cursor:
+        resp.headers["X-Next-Cursor"] = cursor
+        resp.headers["Link"] = f'<{url_for(endpoint, **{**args.to_dict(), "after": cursor})}>; rel="next"'
+    return resp
+
+@asgi_app.route("/api/history")
+async def api_history():
+    return await history_response("api_history")
+
+@asgi_app.route("/api/borrowed")
+async def api_borrowed():
+    return await history_response("api_borrowed", "borrowed")
+
+@asgi_app.route("/api/returned")
+async def api_returned():
+    return await history_response("api_returned", "returned")
+
+@asgi_app.route("/api/history/export")
+async def api_history_export():
+    if "user" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    if session["user"]["role"] not in sync.STAFF_ROLES:
+        return jsonify({"error": "Staff only"}), 403
+
+    async def stream():
+        async with ardb.connect() as con:
+            async with con.execute(SQL.HISTORY_EXPORT) as cur:
+                while rows := await cur.fetchmany(REPORT_FETCH_SIZE):
+                    for row in rows:
+                        yield json.dumps(Borrow.EXPORTED(None, row)) + "\n"
+    return stream(), 200, {"Content-Type": "application/x-ndjson",
+                           "Content-Disposition": "attachment; filename=history.ndjson"}
+
+
+# /metrics is served by prometheus_client; everything else goes to Quart
+metrics_app = make_asgi_app()
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == "/metrics":
+        return await metrics_app(scope, receive, send)
+    return await asgi_app(scope, receive, send)
@@ -0,0 +1,294 @@
+"""Throughput and p50/p95/p99 latency per route under a realistic request mix.
+
+Builds a synthetic database (see benchmarks.synth), points the app at it and
+drives /api/books, /api/prebook, /api/borrow and /api/history from several
+threads, either in-process through the Flask test client or over HTTP.
+Run from the repository root:
+
+    python -m benchmarks.bench_api [--driver client|http] [--mix rush|browse]
+        [--threads N] [--requests N] [--save BASELINE.json]
+        [--compare [BASELINE.json]]
+
+--url drives an already running server instead (e.g. gunicorn started in a
+directory whose library.db was built by benchmarks.synth with the same --db).
+Sessions are issued by this process, so both sides need SESSION_STORE=sqlite.
+--compare checks the run against a baseline (benchmarks/baseline.json when no
+file is named) and exits non-zero when a route's p95 or throughput is worse
+than the baseline by more than --tolerance. A baseline recorded with another
+driver, mix, thread count or scale is refused; one recorded on another host
+(name, CPU count, Python version) is skipped, since its timings say nothing
+about this machine. The committed baseline is a default-settings run; record
+your own with --save and compare against that.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from werkzeug.serving import make_server
+
+import app
+from benchmarks import synth
+
+# relative weights per route; "rush" is the start-of-term counter queue
+MIXES = {
+    "rush": {"books": 30, "books_search": 10, "history": 15, "prebook": 20, "borrow": 25},
+    "browse": {"books": 55, "books_search": 20, "history": 20, "prebook": 5},
+}
+THREADS = 8
+REQUESTS = 4_000
+WARMUP = 50
+TOLERANCE = 0.2
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+class Workload:
+    # ids and QR codes read from the database once, so requests hit real rows
+    def __init__(self, path):
+        con = sqlite3.connect(path)
+        self.users = con.execute("SELECT user_id,role FROM users").fetchall()
+        self.books = [r[0] for r in con.execute("SELECT id FROM books")]
+        self.codes = [r[0] for r in con.execute(
+            "SELECT qr_code FROM book_copies WHERE status='available'")]
+        self.prefixes = sorted({r[0][:3].lower() for r in con.execute("SELECT title FROM books")})
+        con.close()
+        # one server-side session per user, issued directly so scrypt stays out of the numbers
+        sessions = app.app.session_interface
+        self.cookies = ["session=" + sessions.issue({"user": {"id": uid, "role": role}})
+                        for uid, role in self.users]
+
+    def cookie(self, rng):
+        return rng.choice(self.cookies)
+
+    def request(self, route, rng):
+        # (method, path, json body) for one request on route
+        if route == "books":
+            return "GET", "/api/books", None
+        if route == "books_search":
+            return "GET", f"/api/books?q={rng.choice(self.prefixes)}&limit=20", None
+        if route == "history":
+            return "GET", "/api/history?limit=20", None
+        if route == "prebook":
+            return "POST", f"/api/prebook/{rng.choice(self.books)}", None
+        if route == "borrow":
+            return "POST", "/api/borrow", {"qr_code": rng.choice(self.codes)}
+        raise ValueError(route)
+
+
+class ClientDriver:
+    name = "client"
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __call__(self, method, path, body, cookie):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = app.app.test_client(use_cookies=False)
+        resp = client.open(path, method=method, json=body, headers={"Cookie": cookie})
+        resp.get_data()
+        return resp.status_code
+
+    def close(self):
+        pass
+
+
+class HttpDriver:
+    name = "http"
+
+    def __init__(self, url=None):
+        self.server = None
+        if url is None:
+            # threaded werkzeug server in this process, one thread per connection
+            self.server = make_server("127.0.0.1", 0, app.app, threaded=True)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{self.server.server_port}"
+        self.url = url.rstrip("/")
+
+    def __call__(self, method, path, body, cookie):
+        data = None if body is None else json.dumps(body).encode()
+        req = urllib.request.Request(self.url + path, data=data, method=method,
+                                     headers={"Cookie": cookie, "Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def use_database(path):
+    app.Database._instance = None
+    app.db = app.Database(path)
+    app.ReadOnlyDatabase._instance = None
+    app.read_db = app.report_db = app.ReadOnlyDatabase(path)
+    app.catalog_cache.invalidate()
+    # the deadline and reconcile threads would only add noise to a short run
+    app.app.config["EXPIRY_SCHEDULER"] = False
+    app.app.config["STOCK_RECONCILE"] = False
+
+
+def percentile(ordered, p):
+    # nearest-rank on an already sorted list
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def drive(driver, workload, mix, threads, requests, seed=0):
+    routes, weights = zip(*mix.items())
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+    samples = []
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        mine = []
+        while True:
+            with lock:
+                if next(remaining, None) is None: break
+            route = rng.choices(routes, weights)[0]
+            method, path, body = workload.request(route, rng)
+            cookie = workload.cookie(rng)
+            start = time.perf_counter()
+            try:
+                status = driver(method, path, body, cookie)
+            except OSError:
+                status = None
+            mine.append((route, time.perf_counter() - start, status))
+        with lock:
+            samples.extend(mine)
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in pool: t.start()
+    for t in pool: t.join()
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples, wall):
+    by_route = {}
+    for route, elapsed, status in samples:
+        by_route.setdefault(route, []).append((elapsed, status))
+    by_route["all"] = [(elapsed, status) for _, elapsed, status in samples]
+    report = {}
+    for route, rows in sorted(by_route.items()):
+        times = sorted(r[0] * 1000 for r in rows)
+        report[route] = {
+            "requests": len(rows),
+            "rps": len(rows) / wall,
+            "p50_ms": percentile(times, 50),
+            "p95_ms": percentile(times, 95),
+            "p99_ms": percentile(times, 99),
+            # 400/409 are business outcomes (limit reached, copy taken)
+            "rejected": sum(1 for r in rows if r[1] is not None and 400 <= r[1] < 500),
+            "errors": sum(1 for r in rows if r[1] is None or r[1] >= 500),
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{'route':>14} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'4xx':>6} {'errors':>7}")
+    for route, r in report.items():
+        print(f"{route:>14} {r['requests']:>9} {r['rps']:>9.1f} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f}"
+              f" {r['p99_ms']:>9.2f} {r['rejected']:>6} {r['errors']:>7}")
+
+
+def host():
+    # what a baseline's timings are only valid on
+    return {"node": platform.node(), "cpus": os.cpu_count(), "python": platform.python_version()}
+
+
+def compare(report, baseline, tolerance):
+    # a route regresses when its p95 grows or its throughput drops past tolerance
+    regressed = []
+    print(f"\n{'route':>14} {'p95 base':>9} {'p95 now':>9} {'change':>8} {'req/s base':>11} {'req/s now':>10}")
+    for route, r in report.items():
+        base = baseline["routes"].get(route)
+        if base is None: continue
+        change = r["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] else 0.0
+        slower = change > tolerance or r["rps"] < base["rps"] * (1 - tolerance)
+        if slower: regressed.append(route)
+        print(f"{route:>14} {base['p95_ms']:>9.2f} {r['p95_ms']:>9.2f} {change:>+7.0%} {base['rps']:>11.1f}"
+              f" {r['rps']:>10.1f}{'  REGRESSION' if slower else ''}")
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--driver", choices=("client", "http"), default="client")
+    parser.add_argument("--url", help="drive this running server instead of an in-process one")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="rush")
+    parser.add_argument("--threads", type=int, default=THREADS)
+    parser.add_argument("--requests", type=int, default=REQUESTS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="reuse or create this database instead of a fresh temporary one")
+    parser.add_argument("--users", type=int, default=synth.USERS)
+    parser.add_argument("--books", type=int, default=synth.BOOKS)
+    parser.add_argument("--copies", type=int, default=synth.COPIES)
+    parser.add_argument("--years", type=int, default=synth.YEARS)
+    parser.add_argument("--save", metavar="BASELINE", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="BASELINE", nargs="?", const=BASELINE,
+                        help="compare against this baseline (default: benchmarks/baseline.json)")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.db or os.path.join(workdir, "bench.db")
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            synth.build(path, args.users, args.books, args.copies, args.years, args.seed)
+            print(f"built {path} in {time.perf_counter() - start:.1f}s")
+        use_database(path)
+        workload = Workload(path)
+        driver = HttpDriver(args.url) if args.driver == "http" or args.url else ClientDriver()
+        try:
+            drive(driver, workload, MIXES[args.mix], args.threads, WARMUP, args.seed + 1)
+            samples, wall = drive(driver, workload, MIXES[args.mix], args.threads, args.requests, args.seed)
+        finally:
+            driver.close()
+            app.db.close_all()
+            app.read_db.close_all()
+
+    report = summarize(samples, wall)
+    print(f"\n{driver.name} driver, {args.mix} mix, {args.threads} threads, {len(samples)} requests in {wall:.2f}s\n")
+    print_report(report)
+
+    result = {"driver": driver.name, "mix": args.mix, "threads": args.threads, "requests": args.requests,
+              "scale": {"users": args.users, "books": args.books, "copies": args.copies, "years": args.years},
+              "host": host(), "routes": report}
+    regressed = []
+    # compared before --save, which may overwrite the same file
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline["driver"], baseline["mix"], baseline["threads"], baseline["scale"]) != (
+                driver.name, args.mix, args.threads, result["scale"]):
+            sys.exit(f"\n{args.compare} was recorded with a different driver, mix, thread count or scale")
+        if baseline.get("host") != result["host"]:
+            print(f"\nskipping comparison: {args.compare} was recorded on {baseline.get('host')}, "
+                  f"not {result['host']}")
+        else:
+            regressed = compare(report, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Prebook expiry cost: legacy row-by-row loop vs the set-based UPDATEs.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_expiry [N ...]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import app
+from benchmarks import synth
+
+SIZES = (10, 1_000, 100_000)
+BOOKS = 500
+
+
+def build(path, n):
+    # the pre-migration library.db schema brought up to date by the app's
+    # migrations, so the benchmark follows every schema change
+    con = sqlite3.connect(path)
+    con.executescript(synth.SCHEMA)
+    con.close()
+    synth.migrate(path)
+    con = sqlite3.connect(path)
+    past = datetime.now() - timedelta(hours=2)
+    con.executemany(
+        "INSERT INTO books (id,title,total_stock,available_stock) VALUES (?,?,?,0)",
+        ((b, f"Book {b}", n) for b in range(1, BOOKS + 1)))
+    con.executemany(
+        "INSERT INTO book_copies (copy_id,book_id,qr_code,status) VALUES (?,?,?,'prebooked')",
+        ((c, c % BOOKS + 1, f"QR{c}") for c in range(1, n + 1)))
+    con.executemany(
+        """INSERT INTO borrow_requests (user_id,copy_id,request_time,expires_at,status)
+           VALUES (?,?,?,?,'prebooked')""",
+        ((f"u{c}", c, past, past) for c in range(1, n + 1)))
+    con.commit()
+    con.close()
+
+
+# each variant opens its connection with the app's pragmas up front and
+# returns (run, cleanup), so only the expiry itself is timed
+
+
+def legacy_expire(path):
+    # the pre-set-based implementation: three statements per expired row
+    con = sqlite3.connect(path)
+    for pragma in app.DB_PRAGMAS:
+        con.execute(pragma)
+
+    def run():
+        cur = con.cursor()
+        cur.execute("""
+            SELECT id,copy_id FROM borrow_requests
+            WHERE status='prebooked' AND expires_at < ?
+        """, (datetime.now(),))
+        for rid, copy_id in cur.fetchall():
+            cur.execute("UPDATE borrow_requests SET status='expired' WHERE id=?", (rid,))
+            cur.execute("UPDATE book_copies SET status='available' WHERE copy_id=?", (copy_id,))
+            cur.execute("""
+                UPDATE books SET available_stock=available_stock+1
+                WHERE id=(SELECT book_id FROM book_copies WHERE copy_id=?)
+            """, (copy_id,))
+        con.commit()
+    return run, con.close
+
+
+def set_based_expire(path):
+    app.Database._instance = None
+    app.db = app.Database(path)
+    app.db.prefill(1)
+    return app.prebook_service.expire_prebooks, app.db.close_all
+
+
+def check(path, n):
+    con = sqlite3.connect(path)
+    restored = con.execute("SELECT SUM(available_stock) FROM books").fetchone()[0]
+    con.close()
+    assert restored == n, (restored, n)
+
+
+def timed(fn, n, workdir):
+    path = os.path.join(workdir, f"{fn.__name__}_{n}.db")
+    build(path, n)
+    run, cleanup = fn(path)
+    try:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+    finally:
+        cleanup()
+    check(path, n)
+    return elapsed
+
+
+def main(sizes):
+    print(f"{'expired':>10} {'legacy ms':>12} {'set-based ms':>14} {'speedup':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in sizes:
+            legacy = timed(legacy_expire, n, workdir)
+            batched = timed(set_based_expire, n, workdir)
+            print(f"{n:>10} {legacy * 1000:>12.1f} {batched * 1000:>14.1f} {legacy / batched:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or SIZES)
@@ -0,0 +1,170 @@
+"""Synthetic library.db at a configurable scale for the API benchmarks.
+
+Run from the repository root:
+
+    python -m benchmarks.synth OUT.db [--users N] [--books N] [--copies N] [--years N]
+"""
+import argparse
+import contextlib
+import random
+import sqlite3
+import types
+from datetime import datetime, timedelta
+
+import app
+
+USERS = 2_000
+BOOKS = 5_000
+COPIES = 3
+YEARS = 3
+# loans per user per year in the history, and the share of copies out right now
+LOANS_PER_YEAR = 12
+BORROWED = 0.15
+PREBOOKED = 0.05
+PASSWORD = "bench"
+
+SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    role TEXT NOT NULL,
+    department TEXT,
+    year INTEGER,
+    password TEXT NOT NULL
+);
+CREATE TABLE books (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT,
+    author TEXT,
+    description TEXT,
+    total_stock INTEGER,
+    available_stock INTEGER,
+    cover TEXT
+);
+CREATE TABLE borrow_requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT,
+    copy_id INTEGER,
+    request_time DATETIME,
+    status TEXT,
+    expires_at DATETIME
+);
+CREATE TABLE borrows (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT,
+    copy_id INTEGER,
+    borrowed_at DATETIME,
+    return_by DATETIME,
+    returned_at DATETIME
+);
+CREATE TABLE book_copies (
+    copy_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    book_id INTEGER,
+    qr_code TEXT UNIQUE,
+    status TEXT DEFAULT 'available',
+    FOREIGN KEY(book_id) REFERENCES books(id)
+);
+"""
+
+WORDS = ("data", "systems", "python", "networks", "theory", "design", "modern",
+         "applied", "machine", "learning", "algorithms", "compilers", "graphics",
+         "security", "databases", "signals", "physics", "calculus", "history", "art")
+SURNAMES = ("Rao", "Kumar", "Smith", "Garcia", "Chen", "Okafor", "Novak", "Haddad",
+            "Silva", "Ivanova", "Sato", "Nair", "Brown", "Müller", "Kowalski")
+
+
+def user_ids(users):
+    # ~5% teachers and one librarian per 500 users, the rest students
+    ids = []
+    for n in range(1, users + 1):
+        if n % 500 == 0:
+            ids.append((f"L{n:06d}", "librarian"))
+        elif n % 20 == 0:
+            ids.append((f"T{n:06d}", "teacher"))
+        else:
+            ids.append((f"S{n:06d}", "student"))
+    return ids
+
+
+def build(path, users=USERS, books=BOOKS, copies=COPIES, years=YEARS, seed=0):
+    rng = random.Random(seed)
+    now = datetime.now()
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+
+    people = user_ids(users)
+    con.executemany(
+        "INSERT INTO users (user_id,name,role,department,year,password) VALUES (?,?,?,?,?,?)",
+        ((uid, f"User {uid}", role, "Computer Science", rng.randint(1, 4) if role == "student" else None, PASSWORD)
+         for uid, role in people))
+
+    con.executemany(
+        "INSERT INTO books (id,title,author,description,total_stock,available_stock,cover) VALUES (?,?,?,?,?,0,?)",
+        ((b, " ".join(rng.sample(WORDS, 3)).title() + f" {b}", rng.choice(SURNAMES),
+          "Synthetic benchmark book", copies, "default.jpg")
+         for b in range(1, books + 1)))
+
+    n_copies = books * copies
+    status = ["available"] * n_copies
+    out = rng.sample(range(n_copies), int(n_copies * (BORROWED + PREBOOKED)))
+    split = int(n_copies * BORROWED)
+    for i in out[:split]: status[i] = "borrowed"
+    for i in out[split:]: status[i] = "prebooked"
+    con.executemany(
+        "INSERT INTO book_copies (copy_id,book_id,qr_code,status) VALUES (?,?,?,?)",
+        ((c + 1, c // copies + 1, f"BQ{c + 1:07d}", status[c]) for c in range(n_copies)))
+
+    def loans():
+        span = max(years * 365 - 30, 1)
+        for _ in range(users * years * LOANS_PER_YEAR):
+            uid = rng.choice(people)[0]
+            start = now - timedelta(days=30 + rng.random() * span)
+            yield (uid, rng.randint(1, n_copies), start, start + timedelta(days=7),
+                   start + timedelta(days=rng.randint(1, 10)))
+        # the open loans behind every borrowed copy, a few already overdue
+        for c in out[:split]:
+            start = now - timedelta(days=rng.random() * 10)
+            yield (rng.choice(people)[0], c + 1, start, start + timedelta(days=7), None)
+    con.executemany(
+        "INSERT INTO borrows (user_id,copy_id,borrowed_at,return_by,returned_at) VALUES (?,?,?,?,?)",
+        sorted(loans(), key=lambda r: r[2]))
+
+    con.executemany(
+        """INSERT INTO borrow_requests (user_id,copy_id,request_time,status,expires_at)
+           VALUES (?,?,?,'prebooked',?)""",
+        ((rng.choice(people)[0], c + 1, now, now + timedelta(hours=1)) for c in out[split:]))
+
+    con.execute("""
+        UPDATE books SET available_stock=(
+            SELECT COUNT(*) FROM book_copies WHERE book_id=books.id AND status='available')
+    """)
+    con.commit()
+    con.close()
+    migrate(path)
+    return people
+
+
+def migrate(path):
+    # indexes, FTS and triggers exactly as a migrated production database
+    app.Migrator(types.SimpleNamespace(connect=lambda: contextlib.closing(sqlite3.connect(path)))).migrate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out")
+    parser.add_argument("--users", type=int, default=USERS)
+    parser.add_argument("--books", type=int, default=BOOKS)
+    parser.add_argument("--copies", type=int, default=COPIES, help="copies per book")
+    parser.add_argument("--years", type=int, default=YEARS, help="years of loan history")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    build(args.out, args.users, args.books, args.copies, args.years, args.seed)
+    con = sqlite3.connect(args.out)
+    for table in ("users", "books", "book_copies", "borrows", "borrow_requests"):
+        print(f"{table:>16} {con.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]:>10}")
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
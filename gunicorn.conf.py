@@ -0,0 +1,66 @@
+# Production launcher:  gunicorn -c gunicorn.conf.py app:app
+#
+# Graceful reload: `kill -HUP <master pid>` starts fresh workers with the
+# new code and lets the old ones finish their in-flight requests.
+import glob
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# SQLite pool sized to the request threads of one worker
+# sessions live server-side; separate workers have to share them through SQLite
+# an /api/events stream holds one of the threads for as long as it is open,
+# so by default at most half of them stream and the rest keep serving
+# requests; raise GUNICORN_THREADS and EVENT_MAX_STREAMS together for more.
+# Refused clients poll the catalog instead. For push to every kiosk, route
+# /api/events to the ASGI app (uvicorn asgi:application), with EVENT_BUS=sqlite
+# on both, where a stream costs a coroutine instead of a thread
+raw_env = [
+    f"DB_POOL_SIZE={os.environ.get('DB_POOL_SIZE', threads)}",
+    f"SESSION_STORE={os.environ.get('SESSION_STORE', 'sqlite' if workers > 1 else 'memory')}",
+    f"EVENT_MAX_STREAMS={os.environ.get('EVENT_MAX_STREAMS', max(threads // 2, 1))}",
+    f"EVENT_BUS={os.environ.get('EVENT_BUS', 'sqlite' if workers > 1 else 'memory')}",
+]
+
+# the app is imported per worker so HUP picks up new code; set
+# GUNICORN_PRELOAD=1 to import once in the master and fork instead
+preload_app = os.environ.get("GUNICORN_PRELOAD") == "1"
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# recycle workers now and then, staggered so they never all restart together
+max_requests = 5000
+max_requests_jitter = 500
+
+accesslog = "-"
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/smart_library_metrics")
+
+
+def on_starting(server):
+    # stale files from a previous run would be summed into /metrics
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    os.makedirs(path, exist_ok=True)
+    for f in glob.glob(os.path.join(path, "*.db")):
+        os.remove(f)
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from app import reset_pools_after_fork
+        reset_pools_after_fork()
+
+
+def post_worker_init(worker):
+    from app import warm_up
+    warm_up(threads)
+
+
+def child_exit(server, worker):
+    from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+    GunicornInternalPrometheusMetrics.mark_process_dead_on_child_exit(worker.pid)
@@ -0,0 +1,15 @@
+import os
+import shutil
+import tempfile
+
+# importing app migrates its database, so the suite runs against a copy
+# and the tracked library.db stays untouched
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="library-tests-")
+os.environ["DATABASE"] = os.path.join(WORKDIR, "library.db")
+os.environ["QR_CACHE_DIR"] = os.path.join(WORKDIR, "qr_cache")
+shutil.copy(os.path.join(ROOT, "library.db"), os.environ["DATABASE"])
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(WORKDIR, ignore_errors=True)
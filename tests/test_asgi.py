@@ -0,0 +1,193 @@
+import asyncio
+import sqlite3
+import pytest
+
+pytest.importorskip("quart")
+pytest.importorskip("aiosqlite")
+
+import app
+import asgi
+
+
+# =========================================
+# Helper for readable output
+# =========================================
+def log_success(operation, layer):
+    print("\n" + "_"*70)
+    print(f" SUCCESS: {operation}")
+    print(f" ASGI CONTROLLER/API: {layer}")
+    print("_"*70)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def client():
+    app.app.config["EXPIRY_SCHEDULER"] = False
+    app.app.config["STOCK_RECONCILE"] = False
+    asgi.asgi_app.config["TESTING"] = True
+    # each test gets a fresh event loop, so start from an empty pool
+    asgi.adb = asgi.AsyncDatabase(app.DB)
+    asgi.ardb = asgi.AsyncDatabase(app.DB, readonly=True)
+    for service in (asgi.login_service, asgi.copy_service, asgi.borrow_service, asgi.return_service,
+                    asgi.prebook_service, asgi.hold_service):
+        service.adb = asgi.adb
+    return asgi.asgi_app.test_client()
+
+
+def add_book(book_id, qr_codes):
+    con = sqlite3.connect(app.DB)
+    con.execute("INSERT INTO books(id,title,total_stock,available_stock) VALUES(?,'Async',?,?)",
+                (book_id, len(qr_codes), len(qr_codes)))
+    con.executemany("INSERT INTO book_copies(book_id,qr_code) VALUES(?,?)", [(book_id, qr) for qr in qr_codes])
+    con.commit()
+    con.close()
+
+
+def stock(book_id):
+    con = sqlite3.connect(app.DB)
+    try:
+        return con.execute("SELECT available_stock FROM books WHERE id=?", (book_id,)).fetchone()[0]
+    finally:
+        con.close()
+
+
+async def close_pools():
+    await asgi.adb.close_all()
+    await asgi.ardb.close_all()
+
+
+# ======================
+# ASGI TESTS
+# ======================
+
+def test_async_login_required(client):
+    response = run(client.get("/api/me"))
+
+    log_success("Unauthorized Access Blocked", "/api/me")
+
+    assert response.status_code == 401
+
+
+def test_async_login_invalid(client):
+    async def go():
+        response = await client.post("/api/login", json={
+            "id": "wrong", "password": "wrong", "role": "student"
+        })
+        await asgi.adb.close_all()
+        await asgi.ardb.close_all()
+        return response
+
+    response = run(go())
+
+    log_success("Invalid Login API Handling", "/api/login")
+
+    assert response.status_code == 401
+
+
+def test_async_login_rejects_non_strings(client):
+    async def go():
+        return await client.post("/api/login", json={"id": 123, "password": "x", "role": "student"})
+
+    response = run(go())
+
+    log_success("Malformed Login Rejected", "/api/login")
+
+    assert response.status_code == 400
+
+
+def test_async_books_matches_sync(client):
+    async def go():
+        response = await client.get("/api/books")
+        body = await response.get_json()
+        again = await client.get("/api/books", headers={"If-None-Match": response.headers["ETag"]})
+        await asgi.adb.close_all()
+        await asgi.ardb.close_all()
+        return response, body, again
+
+    response, body, again = run(go())
+    expected = app.app.test_client().get("/api/books").json
+
+    log_success("Catalog Served Over ASGI", "/api/books")
+
+    assert response.status_code == 200
+    assert body == expected
+    assert again.status_code == 304
+
+
+def test_async_shares_server_side_sessions(client):
+    sid = app.app.session_interface.issue({"user": {"id": "u1", "name": "Ajay", "role": "student"}})
+
+    async def go():
+        response = await client.get("/api/me", headers={"Cookie": f"session={sid}"})
+        return response, await response.get_json()
+
+    response, body = run(go())
+
+    log_success("Session Shared With Sync App", "/api/me")
+
+    assert response.status_code == 200
+    assert body["id"] == "u1"
+
+
+def test_async_prebook_borrow_and_return(client):
+    add_book(9001, ["AQ1"])
+
+    async def go():
+        try:
+            prebooked = await asgi.prebook_service.prebook("a1", "student", 9001)
+            again = await asgi.prebook_service.prebook("a2", "student", 9001)
+            taken = await asgi.borrow_service.borrow("a2", "AQ1")
+            borrowed = await asgi.borrow_service.borrow("a1", "AQ1")
+            held = stock(9001)
+            wrong = await asgi.return_service.return_copy("a2", "AQ1")
+            returned = await asgi.return_service.return_copy("a1", "AQ1")
+            return prebooked, again, taken, borrowed, held, wrong, returned
+        finally:
+            await close_pools()
+
+    prebooked, again, taken, borrowed, held, wrong, returned = run(go())
+
+    log_success("Prebook, Borrow And Return Over ASGI", "AsyncPrebookService")
+
+    assert prebooked["status"] == "prebooked"
+    assert again == {"error": "No copy available"}
+    assert taken.get("conflict")
+    assert borrowed["status"] == "borrowed"
+    assert held == 0
+    assert wrong.get("conflict")
+    assert returned["status"] == "returned"
+    assert stock(9001) == 1
+    assert app.copy_service.get_by_qr("AQ1").status == "available"
+
+
+def test_async_hold_served_on_return(client):
+    add_book(9002, ["AQ2"])
+
+    async def go():
+        try:
+            free = await asgi.hold_service.place("a3", "staff", 9002)
+            await asgi.borrow_service.borrow("a3", "AQ2")
+            queued = await asgi.hold_service.place("a4", "staff", 9002)
+            cancelled = await asgi.hold_service.cancel("a4", 9002)
+            missing = await asgi.hold_service.cancel("a4", 9002)
+            await asgi.hold_service.place("a4", "staff", 9002)
+            await asgi.return_service.return_copy("a3", "AQ2")
+            return free, queued, cancelled, missing
+        finally:
+            await close_pools()
+
+    free, queued, cancelled, missing = run(go())
+
+    log_success("Hold Served Over ASGI", "AsyncHoldService")
+
+    assert free["error"].startswith("A copy is available")
+    assert queued == {"status": "queued", "book_id": 9002, "position": 1}
+    assert cancelled == {"status": "cancelled"}
+    assert missing == {"error": "No hold"}
+    assert app.copy_service.get_by_qr("AQ2").status == "prebooked"
+    assert app.prebook_repository.for_book("a4", 9002).qr_code == "AQ2"
+    assert stock(9002) == 0
+    assert app.hold_repository.mine("a4") == []
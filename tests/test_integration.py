@@ -1,4 +1,8 @@
+import base64
+import json
+
 import pytest
+import app as app_module
 from app import app
 
 
@@ -16,6 +20,8 @@ def log_success(operation, layer):
 def client():
     app.config["TESTING"] = True
     app.config["SECRET_KEY"] = "test_secret"
+    app.config["EXPIRY_SCHEDULER"] = False
+    app.config["STOCK_RECONCILE"] = False
 
     with app.test_client() as client:
         yield client
@@ -45,6 +51,16 @@ def test_login_api_invalid(client):
     assert response.status_code == 401
 
 
+def test_login_api_rejects_non_strings(client):
+    for body in ({"id": 123, "password": "x", "role": "student"},
+                 {"id": "u1", "password": ["x"], "role": "student"},
+                 {"id": "u1", "password": "x"}, ["u1", "x", "student"]):
+        response = client.post("/api/login", json=body)
+        assert response.status_code == 400
+
+    log_success("Malformed Login Rejected", "/api/login")
+
+
 def test_session_flow(client):
     with client.session_transaction() as sess:
         sess["user"] = {"id": "u1", "role": "student"}
@@ -64,3 +80,177 @@ def test_books_endpoint(client):
 
     assert response.status_code == 200
     assert isinstance(response.json, list)
+    assert response.headers["ETag"]
+
+
+def test_books_conditional_get(client):
+    etag = client.get("/api/books").headers["ETag"]
+    response = client.get("/api/books", headers={"If-None-Match": etag})
+
+    log_success("Catalog Conditional GET", "/api/books")
+
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_book_detail_conditional_get(client):
+    first = client.get("/api/book/1")
+    response = client.get("/api/book/1", headers={"If-None-Match": first.headers["ETag"]})
+
+    log_success("Book Detail Conditional GET", "/api/book/<id>")
+
+    assert first.status_code == 200
+    assert response.status_code == 304
+
+
+def test_static_image_cache_headers(client):
+    cover = client.get("/static/covers/Python.jpg")
+    qr = client.get("/static/qr/PY001.png")
+
+    log_success("Static Image Cache Headers", "/static")
+
+    assert cover.cache_control.max_age == 86400
+    assert qr.cache_control.immutable
+    assert not qr.cache_control.no_cache
+    cover.close()
+    qr.close()
+
+
+def test_qr_image_on_demand(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "qr_service", app_module.QRCodeService(cache_dir=str(tmp_path)))
+    first = client.get("/qr/PY001.png")
+    again = client.get("/qr/PY001.png", headers={"If-None-Match": first.headers["ETag"]})
+    missing = client.get("/qr/NOPE.png")
+
+    log_success("On-Demand QR Image", "/qr/<code>.png")
+
+    assert first.status_code == 200
+    assert first.mimetype == "image/png"
+    assert first.cache_control.immutable
+    assert again.status_code == 304
+    assert missing.status_code == 404
+
+
+def test_book_by_qr_batch(client):
+    response = client.post("/api/book-by-qr/batch", json={"qr_codes": ["PY001", "NOPE"]})
+    unauthenticated = client.post("/api/borrow/batch", json={"qr_codes": ["PY001"]})
+
+    log_success("Batch QR Lookup", "/api/book-by-qr/batch")
+
+    assert response.status_code == 200
+    first, second = response.get_json()["books"]
+    assert first["qr_code"] == "PY001" and first["title"]
+    assert second == {"qr_code": "NOPE", "error": "Invalid QR"}
+    assert client.post("/api/book-by-qr/batch", json={"qr_codes": "PY001"}).status_code == 400
+    assert unauthenticated.status_code == 401
+
+
+def test_return_and_overdue_require_login(client):
+    log_success("Return/Overdue Login Required", "/api/return")
+
+    assert client.post("/api/return", json={"qr_code": "PY001"}).status_code == 401
+    assert client.get("/api/overdue").status_code == 401
+
+
+def test_hold_endpoints(client):
+    anonymous = client.post("/api/hold/1")
+    with client.session_transaction() as sess:
+        sess["user"] = {"id": "s1", "name": "S", "role": "student", "department": "CSE", "year": 1}
+    missing = client.post("/api/hold/999999")
+    cancel = client.delete("/api/hold/1")
+
+    log_success("Hold Queue Endpoints", "/api/hold")
+
+    assert anonymous.status_code == 401
+    assert missing.status_code == 404
+    assert cancel.status_code == 404
+    assert client.get("/api/my-holds").get_json() == []
+
+
+def test_history_export_requires_staff(client):
+    anonymous = client.get("/api/history/export")
+    with client.session_transaction() as sess:
+        sess["user"] = {"id": "s1", "name": "S", "role": "student", "department": "CSE", "year": 1}
+    student = client.get("/api/history/export")
+    history = client.get("/api/history?limit=5")
+
+    log_success("History Export Access", "/api/history/export")
+
+    assert anonymous.status_code == 401
+    assert student.status_code == 403
+    assert history.status_code == 200
+    assert history.get_json() == []
+
+
+def test_books_keyset_pagination(client):
+    first = client.get("/api/books?limit=3")
+    second = client.get(f"/api/books?limit=3&after={first.headers['X-Next-Cursor']}")
+
+    log_success("Keyset Paged Catalog", "/api/books")
+
+    assert first.status_code == 200
+    assert len(first.json) == 3
+    assert second.json[0]["id"] > first.json[-1]["id"]
+
+
+def test_books_prefix_search_and_projection(client):
+    response = client.get("/api/books?q=pyth&fields=id,title")
+
+    log_success("Catalog Prefix Search", "/api/books")
+
+    assert response.status_code == 200
+    assert [b["title"] for b in response.json] == ["Python"]
+    assert set(response.json[0]) == {"id", "title"}
+
+
+def test_books_invalid_cursor(client):
+    response = client.get("/api/books?after=not-a-cursor")
+    assert response.status_code == 400
+
+    # right length, but values sqlite can't bind
+    for key in ([{"a": 1}], [[1]], [None], [True]):
+        after = base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+        assert client.get(f"/api/books?sort=id&after={after}").status_code == 400
+
+    log_success("Invalid Catalog Cursor Rejected", "/api/books")
+
+    assert response.status_code == 400
+
+
+def test_borrow_page_caps_basket_at_batch_max(client):
+    with client.session_transaction() as sess:
+        sess["user"] = {"id": "u1", "role": "student"}
+
+    response = client.get("/borrow")
+
+    log_success("Borrow Basket Capped", "/borrow")
+
+    assert response.status_code == 200
+    assert f"const BATCH_MAX = {app_module.BORROW_BATCH_MAX};".encode() in response.data
+
+
+def test_session_cookie_is_opaque_and_pages_embed_user(client):
+    with client.session_transaction() as sess:
+        sess["user"] = {"id": "u1", "name": "Ajay", "role": "student"}
+
+    cookie = client.get_cookie("session").value
+    dashboard = client.get("/dashboard")
+    detail = client.get("/detail")
+
+    log_success("Server-Side Session & Page Bootstrap", "/dashboard")
+
+    assert "u1" not in cookie and len(cookie) < 64
+    assert app_module.app.session_interface.load(cookie)["user"]["id"] == "u1"
+    assert b'"id": "u1"' in dashboard.data
+    assert b"const PREBOOKS = [" in detail.data
+
+
+def test_event_stream_opens(client):
+    response = client.get("/api/events", buffered=False)
+    first = next(response.response)
+    response.close()
+
+    log_success("Event Stream Opened", "/api/events")
+
+    assert response.mimetype == "text/event-stream"
+    assert first.startswith(b"retry:")
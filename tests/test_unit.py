@@ -1,6 +1,10 @@
 import pytest
 import sqlite3
+import json
 import os
+import threading
+import time
+from datetime import datetime, timedelta
 import app
 
 TEST_DB = "test_library.db"
@@ -32,40 +36,56 @@ def setup_environment():
 
     cur.executescript("""
     CREATE TABLE users(
-        user_id TEXT,
-        name TEXT,
-        password TEXT,
-        role TEXT,
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        role TEXT NOT NULL,
         department TEXT,
-        year TEXT
+        year INTEGER,
+        password TEXT NOT NULL
     );
 
     CREATE TABLE books(
-        id INTEGER PRIMARY KEY,
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
         title TEXT,
+        author TEXT,
+        description TEXT,
+        total_stock INTEGER,
         available_stock INTEGER,
         cover TEXT
     );
 
     CREATE TABLE book_copies(
-        copy_id INTEGER PRIMARY KEY,
+        copy_id INTEGER PRIMARY KEY AUTOINCREMENT,
         book_id INTEGER,
-        qr_code TEXT,
-        status TEXT
+        qr_code TEXT UNIQUE,
+        status TEXT DEFAULT 'available'
     );
 
     CREATE TABLE borrow_requests(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id TEXT,
         copy_id INTEGER,
-        request_time TEXT,
-        expires_at TEXT,
-        status TEXT
+        request_time DATETIME,
+        status TEXT,
+        expires_at DATETIME
+    );
+
+    CREATE TABLE borrows(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        copy_id INTEGER,
+        borrowed_at DATETIME,
+        return_by DATETIME,
+        returned_at DATETIME
     );
     """)
 
-    cur.execute("INSERT INTO users VALUES('u1','Ajay','123','student','CSE','3')")
-    cur.execute("INSERT INTO books VALUES(1,'Python',5,'cover.jpg')")
+    cur.execute("""
+        INSERT INTO users(user_id,name,password,role,department,year)
+        VALUES('u1','Ajay','123','student','CSE',3)
+    """)
+    cur.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(1,'Python',5,'cover.jpg')")
     cur.execute("INSERT INTO book_copies VALUES(1,1,'QR1','available')")
 
     con.commit()
@@ -73,16 +93,24 @@ def setup_environment():
 
     # ✅ STEP 3: replace GLOBAL db used everywhere
     app.db = app.Database(TEST_DB)
+    app.ReadOnlyDatabase._instance = None
+    app.read_db = app.report_db = app.ReadOnlyDatabase(TEST_DB)
 
     # ✅ STEP 4: recreate services using SAME architecture
     app.login_service = app.LoginService(app.db)
     app.copy_service = app.BookCopyService(app.db)
     app.borrow_service = app.BorrowFactory.get_service(app.db)
     app.prebook_service = app.PrebookFactory.get_service(app.db, "student")
+    app.catalog_cache = app.CatalogCache()
+    app.password_hasher = app.PasswordHasher()
+    app.migrator = app.Migrator(app.db)
+    app.migrator.migrate()
 
     yield
 
     print("\nCleaning up Test Database...")
+    app.db.close_all()
+    app.read_db.close_all()
     if os.path.exists(TEST_DB):
         os.remove(TEST_DB)
 
@@ -106,13 +134,99 @@ def test_login_fail():
     assert user is None
 
 
+def test_login_rehashes_plaintext_password():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("""
+        INSERT INTO users(user_id,name,password,role,department,year)
+        VALUES('u7','Hash','secret','student','CSE',2)
+    """)
+    con.commit()
+
+    assert app.login_service.authenticate("u7", "secret", "student").name == "Hash"
+    stored, plain = con.execute("SELECT password_hash,password FROM users WHERE user_id='u7'").fetchone()
+    log_success("Password Rehash On Login", "LoginService")
+
+    assert stored.startswith("scrypt$") and plain == ""
+    assert app.password_hasher.check("secret", stored)
+    # the cleared plaintext column must not become a way in
+    assert app.login_service.authenticate("u7", "", "student") is None
+    assert app.login_service.authenticate("u7", "wrong", "student") is None
+    con.close()
+
+
+def test_login_cache_skips_hash():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("""
+        INSERT INTO users(user_id,name,password,role,department,year)
+        VALUES('u10','Cache','secret','student','CSE',2)
+    """)
+    con.commit()
+    con.close()
+    # the first login rehashes the plaintext; the second verifies the hash
+    app.login_service.authenticate("u10", "secret", "student")
+    app.login_service.authenticate("u10", "secret", "student")
+    before = app.LOGIN_HASH_SECONDS._sum.get()
+
+    assert app.login_service.authenticate("u10", "secret", "student") is not None
+    log_success("Recent Login Cache", "PasswordHasher")
+
+    assert app.LOGIN_HASH_SECONDS._sum.get() == before
+    app.password_hasher.forget()
+    assert app.login_service.authenticate("u10", "secret", "student") is not None
+    assert app.LOGIN_HASH_SECONDS._sum.get() > before
+
+
+def test_login_unknown_user_pays_for_a_hash():
+    app.password_hasher.dummy()
+    before = app.LOGIN_HASH_SECONDS._sum.get()
+
+    assert app.login_service.authenticate("nobody", "guess", "student") is None
+    log_success("Unknown User Login Timing", "LoginService")
+
+    assert app.LOGIN_HASH_SECONDS._sum.get() > before
+
+
+def test_login_busy_hasher_fails_fast():
+    hasher = app.PasswordHasher(workers=1, backlog=1)
+    gate = threading.Event()
+    blocked = hasher._submit(gate.wait)
+    app.password_hasher, saved = hasher, app.password_hasher
+    try:
+        with pytest.raises(app.HasherBusy):
+            hasher.verify("u7", "secret", "scrypt$1$1$1$AA==$AA==")
+        response = app.app.test_client().post("/api/login", json={"id": "u7", "password": "secret", "role": "student"})
+    finally:
+        app.password_hasher = saved
+        gate.set()
+    blocked.result(1)
+    log_success("Login Rejected While Hashing Is Saturated", "PasswordHasher")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    # the freed slot lets the next hash through
+    assert hasher.verify("u7", "secret", "scrypt$1$1$1$AA==$AA==").result(1) is False
+
+
+def test_qr_render_and_cache(tmp_path):
+    qr = app.QRCodeService(cache_dir=str(tmp_path), memory_items=1)
+    etag, png = qr.get("QR1")
+    log_success("QR Rendering With Disk Cache", "QRCodeService")
+
+    assert png.startswith(b"\x89PNG")
+    assert os.path.exists(qr.path(etag))
+    assert qr.get("QR1") == (etag, png)
+    assert qr.get("NOPE") is None
+    # already on disk, so a bulk run skips it
+    assert qr.pregenerate(["QR1", "QR-NEW"]) == 1
+
+
 def test_get_book_copy():
     copy = app.copy_service.get_by_qr("QR1")
     log_success("Book Copy Lookup", "BookCopyService")
 
     assert copy is not None
-    assert copy[0] == 1
-    assert copy[2] == "available"
+    assert copy == app.BookCopy(copy_id=1, book_id=1, status="available")
+    assert not hasattr(copy, "__dict__")
 
 
 def test_prebook_success():
@@ -121,3 +235,790 @@ def test_prebook_success():
 
     assert result["status"] == "prebooked"
     assert result["copy_id"] == 1
+
+
+def test_catalog_cache_invalidated_by_prebook():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(3,'Go',1,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(3,3,'QR3','available')")
+    con.commit()
+    con.close()
+    app.catalog_cache.invalidate()
+
+    before = app.catalog_cache.get()
+    assert app.catalog_cache.get() is before
+
+    app.prebook_service.prebook("u9", "staff", 3)
+    after = app.catalog_cache.get()
+    log_success("Catalog Cache Invalidation", "CatalogCache")
+
+    assert after.etag != before.etag
+    book = next(b for b in json.loads(after.body) if b["id"] == 3)
+    assert book["available"] == 0
+
+
+def test_catalog_cache_patches_changed_books():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(13,'Zig',2,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(600,13,'ZG1','available')")
+    con.execute("INSERT INTO book_copies VALUES(601,13,'ZG2','available')")
+    con.commit()
+    con.close()
+    app.catalog_cache.invalidate()
+    before = app.catalog_cache.get()
+
+    app.borrow_service.borrow("z1", "ZG1")
+    after = app.catalog_cache.get()
+    log_success("Catalog Cache Patched In Place", "CatalogCache")
+
+    # same load, one entry re-encoded
+    assert after.built_at == before.built_at and after.etag != before.etag
+    book = next(b for b in json.loads(after.body) if b["id"] == 13)
+    assert book["available"] == 1
+    # an update that lost the race to a newer one changes nothing
+    app.catalog_cache.update({13: (2, 0)})
+    assert app.catalog_cache.get() is after
+
+
+def test_connection_pool_reuse():
+    con = app.db.connect()
+    raw = con._raw
+    con.close()
+    con = app.db.connect()
+    log_success("Pooled Connection Reuse", "Database")
+
+    assert con._raw is raw
+    assert con.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert app.db.stats()["in_use"] == 1
+    con.close()
+    assert app.db.stats()["in_use"] == 0
+
+
+def test_pool_releases_connection_on_error():
+    def fail():
+        with app.db.connect() as con:
+            con.execute("BEGIN IMMEDIATE")
+            raise RuntimeError("boom")
+
+    errors = []
+    def worker():
+        try:
+            fail()
+        except RuntimeError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker) for _ in range(app.db.pool_size)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    log_success("Connection Released After Error", "Database")
+
+    assert len(errors) == app.db.pool_size
+    assert app.db.stats()["in_use"] == 0
+    with app.db.connect() as con:
+        assert not con.in_transaction
+        assert con.execute("SELECT COUNT(*) FROM books").fetchone()[0] >= 1
+
+
+def test_pool_prefill_and_fork_reset():
+    app.db.prefill(3)
+    assert app.db.stats()["idle"] >= 3
+
+    inherited = app.db.stats()["open"]
+    app.db.reset_after_fork()
+    log_success("Worker Pool Warm-up And Fork Reset", "Database")
+
+    assert app.db.stats()["open"] == 0
+    assert len(app.db._inherited) == inherited
+    con = app.db.connect()
+    assert con.execute("SELECT COUNT(*) FROM books").fetchone()[0] >= 1
+    con.close()
+    for raw in app.db._inherited:
+        raw.close()
+
+
+def test_expiry_scheduler_expires_due_prebooks():
+    past = datetime.now() - timedelta(minutes=1)
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(2,'Rust',0,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(2,2,'QR2','prebooked')")
+    con.execute("""
+        INSERT INTO borrow_requests(user_id,copy_id,request_time,expires_at,status)
+        VALUES('u2',2,?,?,'prebooked')
+    """, (past, past))
+    con.commit()
+    con.close()
+
+    app.catalog_cache.get()
+    scheduler = app.ExpiryScheduler(app.prebook_service, max_sleep=0.1)
+    scheduler.ensure_started()
+    try:
+        deadline = time.time() + 5
+        while app.copy_service.get_by_qr("QR2").status != "available" and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        scheduler.stop()
+    log_success("Background Prebook Expiry", "ExpiryScheduler")
+
+    assert app.copy_service.get_by_qr("QR2").status == "available"
+    book = next(b for b in json.loads(app.catalog_cache.get().body) if b["id"] == 2)
+    assert book["available"] == 1
+    con = sqlite3.connect(TEST_DB)
+    assert con.execute("SELECT available_stock FROM books WHERE id=2").fetchone()[0] == 1
+    con.close()
+
+
+# statements on the hot paths; each must be answered from an index
+TS = "2024-01-01"
+HOT_QUERIES = {
+    "ANY_EXPIRED": (TS,),
+    "EXPIRE_RESTORE_STOCK": (TS,),
+    "EXPIRE_RELEASE_COPIES": (TS,),
+    "EXPIRE_REQUESTS": (TS,),
+    "NEXT_EXPIRY": (),
+    "ACTIVE_PREBOOKS": ("u1",),
+    "CLAIM_FOR_PREBOOK": (1,),
+    "CLAIM_FOR_BORROW": (1, 1, "u1"),
+    "COMPLETE_PREBOOK": (1, "u1"),
+    "MY_PREBOOK": ("u1", 1, TS),
+    "MY_PREBOOKS": ("u1", TS),
+    "COPY_BY_QR": ("QR1",),
+    "TITLE_BY_QR": ("QR1",),
+    "TITLES_BY_QR": ('["QR1"]',),
+    "COPIES_FOR_BORROW": ("u1", '["QR1"]'),
+    "OPEN_LOANS_BY_QR": ('["QR1"]',),
+    "OVERDUE": (TS,),
+    "OVERDUE_FOR_USER": (TS, "u1"),
+    "HISTORY_EXPORT": (),
+    "STOCK_DRIFT_ALL": (),
+    "STOCK_DRIFT_BOOKS": ("[1]",),
+    "SESSION_GET": ("k", 0),
+    "CREDENTIALS": ("u1", "student"),
+    "IMPORT_COPY": ("QR1", "978-1"),
+    "HOLD_CHECK": ("u1", "u1", 1),
+    "HOLD_POSITION": (1, "u1", 1),
+    "NEXT_HOLD": (1,),
+    "HELD_BOOKS": ("[1]",),
+    "MY_HOLDS": ("u1",),
+    "EVENTS_SINCE": (0,),
+    "EXPIRED_HOLDERS": (TS,),
+}
+
+
+def test_migrations_recorded():
+    log_success("Schema Migrations Applied", "Migrator")
+
+    assert app.migrator.version() == app.MIGRATIONS[-1][0]
+    assert app.migrator.migrate() == app.MIGRATIONS[-1][0]
+
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_index(name):
+    con = sqlite3.connect(TEST_DB)
+    plan = [row[3] for row in con.execute("EXPLAIN QUERY PLAN " + getattr(app.SQL, name), HOT_QUERIES[name])]
+    con.close()
+    log_success(f"Index Plan: {name}", "Migrator")
+
+    # scanning a materialized subquery is fine; scanning a table is not
+    derived = {step.split()[1] for step in plan if step.startswith("MATERIALIZE")}
+    full_scans = [step for step in plan
+                  if step.startswith("SCAN") and "INDEX" not in step and step.split()[1] not in derived]
+    assert not full_scans, plan
+
+
+
+def test_concurrent_borrow_single_winner():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(4,'C',1,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(4,4,'QR4','available')")
+    con.commit()
+    con.close()
+
+    threads_count = 16
+    barrier = threading.Barrier(threads_count)
+    results = []
+
+    def scan(n):
+        barrier.wait()
+        results.append(app.borrow_service.borrow(f"s{n}", "QR4"))
+
+    threads = [threading.Thread(target=scan, args=(n,)) for n in range(threads_count)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    log_success("Concurrent Borrow Of One Copy", "BorrowService")
+
+    assert sum(1 for r in results if r.get("status") == "borrowed") == 1
+    assert sum(1 for r in results if r.get("conflict")) == threads_count - 1
+    con = sqlite3.connect(TEST_DB)
+    assert con.execute("SELECT COUNT(*) FROM borrows WHERE copy_id=4").fetchone()[0] == 1
+    assert con.execute("SELECT available_stock FROM books WHERE id=4").fetchone()[0] == 0
+    con.close()
+
+
+def test_borrow_prebooked_copy_by_holder_only():
+    assert app.borrow_service.borrow("u2", "QR1").get("conflict")
+    result = app.borrow_service.borrow("u1", "QR1")
+    log_success("Borrow Of Prebooked Copy", "BorrowService")
+
+    assert result["status"] == "borrowed"
+    assert app.copy_service.get_by_qr("QR1").status == "borrowed"
+
+
+def test_concurrent_prebook_never_oversells():
+    copies = 5
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(5,'Hot',?,'cover.jpg')", (copies,))
+    con.executemany("INSERT INTO book_copies VALUES(?,5,?,'available')",
+                    [(100 + n, f"HOT{n}") for n in range(copies)])
+    con.commit()
+    con.close()
+
+    threads_count = 40
+    barrier = threading.Barrier(threads_count)
+    results = []
+
+    def request_prebook(n):
+        barrier.wait()
+        # every other request comes from the same student, who may hold one
+        user = "greedy" if n % 2 else f"p{n}"
+        results.append(app.prebook_service.prebook(user, "student", 5))
+
+    threads = [threading.Thread(target=request_prebook, args=(n,)) for n in range(threads_count)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    log_success("Concurrent Prebook Load", "PrebookService")
+
+    won = [r for r in results if r.get("status") == "prebooked"]
+    assert len(won) == copies
+    assert len({r["copy_id"] for r in won}) == copies
+    con = sqlite3.connect(TEST_DB)
+    assert con.execute("SELECT available_stock FROM books WHERE id=5").fetchone()[0] == 0
+    assert con.execute("""
+        SELECT COUNT(*) FROM borrow_requests WHERE user_id='greedy' AND status='prebooked'
+    """).fetchone()[0] <= 1
+    assert con.execute("""
+        SELECT MAX(n) FROM (SELECT COUNT(*) AS n FROM borrow_requests
+                            WHERE status='prebooked' GROUP BY copy_id)
+    """).fetchone()[0] == 1
+    con.close()
+
+
+def test_retry_busy_backs_off_then_succeeds():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return "ok"
+
+    log_success("SQLITE_BUSY Retry", "retry_busy")
+
+    assert app.retry_busy(flaky) == "ok"
+    assert len(calls) == 3
+
+
+def test_batch_borrow_and_return_retry_when_busy(monkeypatch):
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(18,'Contended',1,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(640,18,'BZ1','available')")
+    con.commit()
+    con.close()
+    calls = []
+    real = app.transact
+
+    def locked_once(body):
+        calls.append(1)
+        if len(calls) == 1:
+            body.close()
+            raise sqlite3.OperationalError("database is locked")
+        return real(body)
+
+    monkeypatch.setattr(app, "transact", locked_once)
+    monkeypatch.setattr(app, "BUSY_BACKOFF", 0.001)
+    results = app.borrow_service.borrow_batch("u13", ["BZ1"])
+    log_success("Busy Batch Checkout Retried", "BorrowService")
+
+    assert results[0]["status"] == "borrowed" and len(calls) == 2
+
+    calls.clear()
+    results = app.return_service.return_batch("u13", ["BZ1"])
+    assert results[0]["status"] == "returned" and len(calls) == 2
+
+
+def test_expiry_busy_releases_connection_and_retries(monkeypatch):
+    past = datetime.now() - timedelta(minutes=1)
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(12,'Locked',0,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(500,12,'LK1','prebooked')")
+    con.execute("""
+        INSERT INTO borrow_requests(user_id,copy_id,request_time,expires_at,status)
+        VALUES('x1',500,?,?,'prebooked')
+    """, (past, past))
+    con.commit()
+
+    pooled = app.db.connect()
+    pooled.execute("PRAGMA busy_timeout=0")
+    pooled.close()
+    monkeypatch.setattr(app, "BUSY_RETRIES", 2)
+    monkeypatch.setattr(app, "BUSY_BACKOFF", 0.001)
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            app.prebook_service.expire_prebooks()
+        assert app.db.stats()["in_use"] == 0
+    finally:
+        con.rollback()
+    log_success("Busy Expiry Released And Retried", "PrebookService")
+
+    assert app.prebook_service.expire_prebooks() == 1
+    assert app.copy_service.get_by_qr("LK1").status == "available"
+    pooled = app.db.connect()
+    pooled.execute("PRAGMA busy_timeout=5000")
+    pooled.close()
+    con.close()
+
+
+def test_event_hub_fans_out_stock_and_user_events():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(6,'Events',1,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(6,6,'QR6','available')")
+    con.commit()
+    con.close()
+
+    watcher = app.event_hub.subscribe(app.EventSubscription())
+    holder = app.event_hub.subscribe(app.EventSubscription("ev1"))
+    try:
+        app.prebook_service.prebook("ev1", "staff", 6)
+    finally:
+        app.event_hub.unsubscribe(watcher)
+        app.event_hub.unsubscribe(holder)
+    log_success("Stock And Prebook Events Published", "EventHub")
+
+    assert watcher.get(0) == 'event: stock\ndata: {"book_id": 6, "available": 0}\n\n'
+    assert watcher.get(0) is None
+    assert holder.get(0).startswith("event: stock")
+    assert holder.get(0).startswith("event: prebook")
+
+
+def test_event_subscription_overflow_resyncs():
+    sub = app.EventSubscription(maxsize=2)
+    for n in range(5):
+        sub.deliver(f"event: stock\ndata: {n}\n\n")
+    log_success("Slow Event Consumer Resync", "EventSubscription")
+
+    assert sub.get(0) == app.EventSubscription.RESYNC
+    assert sub.get(0) is None
+
+
+def test_batch_borrow_per_item_results():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(7,'Stack',3,'cover.jpg')")
+    con.executemany("INSERT INTO book_copies VALUES(?,7,?,?)",
+                    [(200, "ST1", "available"), (201, "ST2", "available"), (202, "ST3", "prebooked")])
+    con.execute("""
+        INSERT INTO borrow_requests(user_id,copy_id,request_time,expires_at,status)
+        VALUES('other',202,?,?,'prebooked')
+    """, (datetime.now(), datetime.now() + timedelta(hours=1)))
+    con.commit()
+
+    results = app.borrow_service.borrow_batch("u8", ["ST1", "ST2", "ST1", "ST3", "NOPE"])
+    log_success("Batch Checkout", "BorrowService")
+
+    assert [r["qr_code"] for r in results] == ["ST1", "ST2", "ST1", "ST3", "NOPE"]
+    assert [r.get("status") for r in results[:2]] == ["borrowed", "borrowed"]
+    assert results[2]["error"] == "Scanned twice"
+    assert results[3]["conflict"]
+    assert results[4]["error"] == "Invalid QR"
+    assert con.execute("SELECT available_stock FROM books WHERE id=7").fetchone()[0] == 1
+    assert con.execute("SELECT COUNT(*) FROM borrows WHERE user_id='u8'").fetchone()[0] == 2
+    con.close()
+
+
+def test_return_restores_stock_and_reports_overdue():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(16,'Shelf',3,'cover.jpg')")
+    con.executemany("INSERT INTO book_copies VALUES(?,16,?,'available')",
+                    [(620, "RT1"), (621, "RT2"), (622, "RT3")])
+    con.commit()
+    app.borrow_service.borrow_batch("u11", ["RT1", "RT2"])
+
+    results = app.return_service.return_batch("u11", ["RT1", "RT2", "RT3"])
+    log_success("Return Restores Copy And Stock", "ReturnService")
+
+    assert [r.get("status") for r in results[:2]] == ["returned", "returned"]
+    assert results[2]["error"] == "Copy is not on loan"
+    assert con.execute("SELECT available_stock FROM books WHERE id=16").fetchone()[0] == 3
+    assert app.copy_service.get_by_qr("RT1").status == "available"
+
+    app.borrow_service.borrow("u11", "RT1")
+    assert app.return_service.return_copy("u9", "RT1")["conflict"]
+    con.execute("UPDATE borrows SET return_by=? WHERE user_id='u11' AND returned_at IS NULL",
+                (datetime.now() - timedelta(days=2, hours=12),))
+    con.commit()
+    con.close()
+
+    report = list(app.return_service.overdue("u11"))
+    assert [(r["qr"], r["overdue_days"], r["fine"]) for r in report] == [("RT1", 3, 3 * app.FINE_PER_DAY)]
+    # staff can take back anyone's copy
+    assert app.return_service.return_copy("staff", "RT1", staff=True)["fine"] == 3 * app.FINE_PER_DAY
+    assert list(app.return_service.overdue("u11")) == []
+
+
+def test_return_of_copy_not_out_leaves_stock():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(19,'Lost',1,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(650,19,'LS1','available')")
+    con.commit()
+    app.borrow_service.borrow("u14", "LS1")
+    # written off while the loan is still open
+    con.execute("UPDATE book_copies SET status='lost' WHERE copy_id=650")
+    con.commit()
+
+    result = app.return_service.return_copy("u14", "LS1")
+    log_success("Return Without A Borrowed Copy", "ReturnService")
+
+    assert result["status"] == "returned"
+    assert con.execute("SELECT available_stock FROM books WHERE id=19").fetchone()[0] == 0
+    assert con.execute("SELECT status FROM book_copies WHERE copy_id=650").fetchone()[0] == "lost"
+    con.close()
+
+
+def test_history_keyset_pages_and_export():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(17,'Ledger',2,'cover.jpg')")
+    con.executemany("INSERT INTO book_copies VALUES(?,17,?,'available')", [(630, "HK1"), (631, "HK2")])
+    con.commit()
+    con.close()
+    # HK1 and HK2 in one batch, then HK1 again
+    app.borrow_service.borrow_batch("u12", ["HK1", "HK2"])
+    app.return_service.return_batch("u12", ["HK1", "HK2"])
+    app.borrow_service.borrow("u12", "HK1")
+    app.return_service.return_copy("u12", "HK1")
+
+    first, cursor = app.history_service.page("u12", limit=2)
+    rest, end = app.history_service.page("u12", after=cursor, limit=2)
+    log_success("Keyset Paged History", "HistoryService")
+
+    # the first two loans share borrowed_at; id breaks the tie
+    assert [r["qr"] for r in first + rest] == ["HK1", "HK2", "HK1"]
+    assert len({r["id"] for r in first + rest}) == 3 and end is None
+    assert all(r["returned_at"] for r in first + rest)
+    assert app.history_service.page("u12", "borrowed")[0] == []
+
+    plan = app.history_service.plan("u12", after=cursor)
+    con = sqlite3.connect(TEST_DB)
+    steps = [row[3] for row in con.execute("EXPLAIN QUERY PLAN " + plan.sql, plan.params)]
+    con.close()
+    assert not any("TEMP B-TREE" in step for step in steps), steps
+
+    lines = [json.loads(line) for line in app.history_service.export()]
+    assert {"user_id", "title", "qr", "borrowed_at", "returned_at"} <= set(lines[0])
+    assert [l["borrowed_at"] for l in lines] == sorted(l["borrowed_at"] for l in lines)
+    with pytest.raises(ValueError):
+        app.history_service.page("u12", after="garbage")
+
+
+def test_stock_reconciler_fixes_drift():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("DELETE FROM stock_changes")
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(9,'Drift',2,'cover.jpg')")
+    con.executemany("INSERT INTO book_copies VALUES(?,9,?,'available')", [(300, "DR1"), (301, "DR2")])
+    con.commit()
+    # a copy goes out without its stock being taken
+    con.execute("UPDATE book_copies SET status='borrowed' WHERE copy_id=300")
+    con.commit()
+
+    assert app.stock_reconciler.run(fix=False) == [(9, 2, 1)]
+    drift = app.stock_reconciler.run()
+    log_success("Incremental Stock Reconciliation", "StockReconciler")
+
+    assert drift == [(9, 2, 1)]
+    assert app.STOCK_DRIFT._value.get() == 1
+    assert con.execute("SELECT available_stock FROM books WHERE id=9").fetchone()[0] == 1
+    assert con.execute("SELECT COUNT(*) FROM stock_changes").fetchone()[0] == 0
+    assert app.stock_reconciler.run() == []
+
+    # edits that bypass book_copies only show up in a full pass
+    con.execute("UPDATE books SET available_stock=7 WHERE id=9")
+    con.commit()
+    assert app.stock_reconciler.run() == []
+    assert (9, 7, 1) in app.stock_reconciler.run(full=True)
+    assert con.execute("SELECT available_stock FROM books WHERE id=9").fetchone()[0] == 1
+    con.close()
+
+
+def test_read_only_and_snapshot_pools(tmp_path):
+    con = app.read_db.connect()
+    with pytest.raises(sqlite3.OperationalError):
+        con.execute("UPDATE books SET title='x' WHERE id=1")
+    con.close()
+
+    app.SnapshotDatabase._instance = None
+    snap = app.SnapshotDatabase(str(tmp_path / "snapshot.db"), TEST_DB)
+    count = "SELECT COUNT(*) FROM books"
+    held = snap.connect()
+    before = held.execute(count).fetchone()[0]
+
+    primary = sqlite3.connect(TEST_DB)
+    primary.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(10,'Snap',0,'cover.jpg')")
+    primary.commit()
+    snap.refresh()
+    log_success("Snapshot Read Pool Refresh", "SnapshotDatabase")
+
+    # a connection checked out before the refresh finishes on the old copy
+    assert held.execute(count).fetchone()[0] == before
+    held.close()
+    assert snap.stats()["open"] == 0
+    fresh = snap.connect()
+    assert fresh.execute(count).fetchone()[0] == before + 1
+    fresh.close()
+    snap.close_all()
+
+    primary.execute("DELETE FROM books WHERE id=10")
+    primary.commit()
+    primary.close()
+
+
+def test_snapshot_copied_once_across_workers(tmp_path, monkeypatch):
+    path = str(tmp_path / "shared.db")
+    app.SnapshotDatabase._instance = None
+    first = app.SnapshotDatabase(path, TEST_DB)
+    app.SnapshotDatabase._instance = None
+    second = app.SnapshotDatabase(path, TEST_DB)
+    assert first is not second
+    count = "SELECT COUNT(*) FROM books"
+    con = second.connect()
+    before = con.execute(count).fetchone()[0]
+    con.close()
+
+    primary = sqlite3.connect(TEST_DB)
+    primary.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(15,'Shared',0,'cover.jpg')")
+    primary.commit()
+    first.refresh()
+
+    # the other worker finds a copy younger than the interval and only reopens
+    copies = []
+    monkeypatch.setattr(second, "_backup", lambda: copies.append(1))
+    second.refresh(60)
+    assert copies == []
+    con = second.connect()
+    assert con.execute(count).fetchone()[0] == before + 1
+    con.close()
+    log_success("Snapshot Shared Across Workers", "SnapshotDatabase")
+
+    first.close_all(); second.close_all()
+    app.SnapshotDatabase._instance = None
+    primary.execute("DELETE FROM books WHERE id=15")
+    primary.commit()
+    primary.close()
+
+
+def test_query_metrics_and_slow_log(monkeypatch, caplog):
+    from prometheus_client import REGISTRY
+    def sample(metric, query):
+        return REGISTRY.get_sample_value(metric, {"query": query}) or 0
+
+    timed = sample("smart_library_db_query_seconds_count", "BOOK_DETAIL")
+    changed = sample("smart_library_db_query_rows_total", "UPDATE books")
+    monkeypatch.setattr(app, "SLOW_QUERY_MS", 1e-9)
+
+    con = app.read_db.connect()
+    con.execute(app.SQL.BOOK_DETAIL, (1,)).fetchone()
+    con.close()
+    con = app.db.connect()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("UPDATE books SET version=version WHERE id IN (1,2)")
+    cur.execute("UPDATE books SET version=version WHERE id=3 RETURNING id").fetchall()
+    con.close()
+    log_success("Per-Query Metrics & Slow Log", "TracedCursor")
+
+    assert sample("smart_library_db_query_seconds_count", "BOOK_DETAIL") == timed + 1
+    assert sample("smart_library_db_query_rows_total", "UPDATE books") == changed + 3
+    assert sample("smart_library_db_query_seconds_count", "BEGIN IMMEDIATE") >= 1
+    slow = [r.getMessage() for r in caplog.records if r.getMessage().startswith("slow query BOOK_DETAIL")]
+    assert slow and "SEARCH books USING INTEGER PRIMARY KEY" in slow[0]
+
+
+def test_session_stores_expire_and_share():
+    memory = app.MemorySessionStore(size=2)
+    memory.set("a", {"n": 1}, 60)
+    memory.set("b", {"n": 2}, 60)
+    memory.get("a")
+    memory.set("c", {"n": 3}, 60)
+    assert memory.get("b") is None
+    assert memory.get("a") == {"n": 1}
+    memory.set("old", {"n": 4}, -1)
+    assert memory.get("old") is None
+
+    store = app.SqliteSessionStore()
+    store.set("k1", {"user": {"id": "u1"}}, 60)
+    store.set("k2", {"user": {"id": "u2"}}, -1)
+    # another worker has no local copy and reads the row
+    assert app.SqliteSessionStore().get("k1") == {"user": {"id": "u1"}}
+    assert store.purge() == 1
+    store.delete("k1")
+    log_success("Server-Side Session Stores", "MemorySessionStore / SqliteSessionStore")
+
+    assert store.get("k1") is None
+    assert app.SqliteSessionStore().get("k2") is None
+
+
+def test_holds_served_in_order_on_return_and_expiry():
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(11,'Queue',1,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(400,11,'HQ1','available')")
+    # h1 is at the student limit through a prebook on another book
+    con.execute("""
+        INSERT INTO borrow_requests(user_id,copy_id,request_time,expires_at,status)
+        VALUES('h1',999,?,?,'prebooked')
+    """, (datetime.now(), datetime.now() + timedelta(hours=1)))
+    con.commit()
+
+    assert app.hold_service.place("h1", "student", 11)["error"].startswith("A copy is available")
+    app.borrow_service.borrow("h0", "HQ1")
+    assert app.hold_service.place("h1", "student", 11) == {"status": "queued", "book_id": 11, "position": 1}
+    assert app.hold_service.place("h2", "staff", 11)["position"] == 2
+    assert app.hold_service.place("h1", "student", 11)["position"] == 1
+    assert app.hold_service.place("h1", "student", 404) == {"error": "Book not found"}
+
+    # the returned copy skips h1, who is at the limit, and goes to h2
+    holder = app.event_hub.subscribe(app.EventSubscription("h2"))
+    try:
+        app.return_service.return_copy("h0", "HQ1")
+    finally:
+        app.event_hub.unsubscribe(holder)
+    log_success("Hold Served On Return", "HoldService")
+
+    assert app.copy_service.get_by_qr("HQ1").status == "prebooked"
+    assert con.execute("SELECT available_stock FROM books WHERE id=11").fetchone()[0] == 0
+    assert app.prebook_repository.for_book("h2", 11).qr_code == "HQ1"
+    assert holder.get(0).startswith("event: stock")
+    event = holder.get(0)
+    assert event.startswith("event: prebook") and '"hold": true' in event
+    assert [(h["book_id"], h["position"]) for h in app.hold_repository.mine("h1")] == [(11, 1)]
+
+    # h2's prebook lapses and h1, now under the limit, is next
+    con.execute("UPDATE borrow_requests SET status='completed' WHERE user_id='h1'")
+    con.execute("UPDATE borrow_requests SET expires_at=? WHERE user_id='h2'",
+                (datetime.now() - timedelta(minutes=1),))
+    con.commit()
+    assert app.prebook_service.expire_prebooks() == 1
+    log_success("Hold Served On Expiry", "HoldService")
+
+    assert app.prebook_repository.for_book("h1", 11).qr_code == "HQ1"
+    assert con.execute("SELECT available_stock FROM books WHERE id=11").fetchone()[0] == 0
+    assert con.execute("SELECT COUNT(*) FROM holds WHERE book_id=11").fetchone()[0] == 0
+    assert app.hold_service.cancel("h1", 11) == {"error": "No hold"}
+    con.close()
+
+
+def test_expiry_tells_only_the_holders():
+    past = datetime.now() - timedelta(minutes=1)
+    con = sqlite3.connect(TEST_DB)
+    con.execute("INSERT INTO books(id,title,available_stock,cover) VALUES(14,'Lisp',0,'cover.jpg')")
+    con.execute("INSERT INTO book_copies VALUES(610,14,'EX1','prebooked')")
+    con.execute("""
+        INSERT INTO borrow_requests(user_id,copy_id,request_time,expires_at,status)
+        VALUES('x1',610,?,?,'prebooked')
+    """, (past, past))
+    con.commit()
+    con.close()
+
+    holder = app.event_hub.subscribe(app.EventSubscription("x1"))
+    other = app.event_hub.subscribe(app.EventSubscription("x2"))
+    try:
+        assert app.prebook_service.expire_prebooks() == 1
+    finally:
+        app.event_hub.unsubscribe(holder)
+        app.event_hub.unsubscribe(other)
+    log_success("Expiry Sent To Holders", "PrebookService")
+
+    assert holder.get(0).startswith("event: stock")
+    event = holder.get(0)
+    assert event.startswith("event: prebook") and '"status": "expired"' in event and '"book_id": 14' in event
+    assert other.get(0).startswith("event: stock")
+    assert other.get(0) is None
+
+
+def test_sqlite_event_bus_reaches_other_processes():
+    # two hubs on one database stand in for two worker processes
+    publisher, listener = app.SqliteEventHub(), app.SqliteEventHub()
+    everyone = listener.subscribe(app.EventSubscription())
+    mine = listener.subscribe(app.EventSubscription("e1"))
+    try:
+        assert listener.poll() == 0
+        publisher.publish_stock([(1, 4)])
+        publisher.publish("prebook", {"status": "prebooked"}, user_id="e1")
+        assert listener.poll() == 2
+        log_success("Events Shared Through SQLite", "SqliteEventHub")
+
+        assert everyone.get(0).startswith("event: stock")
+        assert everyone.get(0) is None
+        assert mine.get(0).startswith("event: stock")
+        assert mine.get(0).startswith("event: prebook")
+        assert listener.poll() == 0
+    finally:
+        listener.unsubscribe(everyone)
+        listener.unsubscribe(mine)
+
+    # with nobody listening the backlog is skipped, not replayed later
+    publisher.publish("expiry", {"count": 1})
+    assert listener.poll() == 0
+    late = listener.subscribe(app.EventSubscription())
+    try:
+        assert listener.poll() == 0
+        assert late.get(0) is None
+    finally:
+        listener.unsubscribe(late)
+
+    con = sqlite3.connect(TEST_DB)
+    con.execute("UPDATE events SET created_at=created_at-?", (app.EVENT_RETENTION + 1,))
+    con.commit()
+    con.close()
+    assert publisher.purge() == 3
+
+
+def test_catalog_import_upserts_and_recounts():
+    import io
+    rows = io.StringIO(
+        "isbn,title,author,description,cover,qr_codes\n"
+        "978-1,Compilers,Aho,,c.jpg,IMP1;IMP2 IMP3\n"
+        ",No Isbn,,,,IMP9\n"
+        "978-404,,,,,IMP4\n"
+    )
+    stats = app.CatalogImporter(app.db, batch_size=2).run(app.read_import_rows(rows, "csv"))
+    log_success("Streaming Catalog Import", "CatalogImporter")
+
+    assert stats == {"rows": 3, "books": 1, "copies": 3, "skipped": 2, "recounted": 1}
+    con = sqlite3.connect(TEST_DB)
+    book = con.execute("SELECT id,total_stock,available_stock,version FROM books WHERE isbn='978-1'").fetchone()
+    assert book[1:3] == (3, 3)
+
+    # re-running updates in place and only adds the new copy
+    con.execute("UPDATE book_copies SET status='borrowed' WHERE qr_code='IMP1'")
+    con.commit()
+    more = io.StringIO('{"isbn": "978-1", "title": "Compilers 2e", "qr_codes": ["IMP3", "IMP5"]}\n')
+    stats = app.CatalogImporter(app.db).run(app.read_import_rows(more, "jsonl"))
+    assert stats["copies"] == 2
+    assert con.execute("SELECT title,total_stock,available_stock FROM books WHERE id=?",
+                       (book[0],)).fetchone() == ("Compilers 2e", 4, 3)
+    version = con.execute("SELECT version FROM books WHERE id=?", (book[0],)).fetchone()[0]
+    assert version > book[3]
+
+    # an unchanged row writes nothing
+    again = io.StringIO('{"isbn": "978-1", "title": "Compilers 2e"}\n')
+    app.CatalogImporter(app.db).run(app.read_import_rows(again, "jsonl"))
+    assert con.execute("SELECT version FROM books WHERE id=?", (book[0],)).fetchone()[0] == version
+
+    # copies moving to another book are recounted on both sides
+    moved = io.StringIO('{"isbn": "978-2", "title": "Dragon", "qr_codes": ["IMP1", "IMP2", "IMP3", "IMP5"]}\n')
+    stats = app.CatalogImporter(app.db).run(app.read_import_rows(moved, "jsonl"))
+    assert stats["recounted"] == 2
+    assert con.execute("SELECT total_stock,available_stock FROM books WHERE id=?", (book[0],)).fetchone() == (0, 0)
+    assert con.execute("SELECT total_stock,available_stock FROM books WHERE isbn='978-2'").fetchone() == (4, 3)
+
+    # imported rows took the next free ids; give them back for later tests
+    con.execute("DELETE FROM book_copies WHERE book_id IN (SELECT id FROM books WHERE isbn IN ('978-1','978-2'))")
+    con.execute("DELETE FROM books WHERE isbn IN ('978-1','978-2')")
+    con.commit()
+    con.close()